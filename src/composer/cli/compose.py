@@ -188,7 +188,7 @@ def compose_status(socket_path, api_version, args, show_json=False, testmode=0,
 
     # Sort the status in a specific order
     def sort_status(a):
-        order = ["RUNNING", "WAITING", "FINISHED", "FAILED"]
+        order = ["RUNNING", "WAITING", "PENDING", "FINISHED", "FAILED"]
         return (order.index(a["status"]), a["blueprint"], a["version"], a["compose_type"])
 
     status = []
@@ -430,11 +430,15 @@ def compose_log(socket_path, api_version, args, show_json=False, testmode=0, api
     :param testmode: unused in this function
     :type testmode: int
 
-    compose log <uuid> [<size>kB]
+    compose log <uuid> [<size>kB] [--follow]
 
     This will display the last 1kB of the compose's log file. Can be used to follow progress
-    during the build.
+    during the build. With --follow it keeps displaying the new lines of the log until
+    the build has finished.
     """
+    follow = "--follow" in args
+    if follow:
+        args = [a for a in args if a != "--follow"]
     if len(args) == 0:
         log.error("log is missing the compose build id")
         return 1
@@ -448,6 +452,16 @@ def compose_log(socket_path, api_version, args, show_json=False, testmode=0, api
         log_size = 1024
 
     api_route = client.api_url(api_version, "/compose/log/%s?size=%d" % (args[0], log_size))
+    if follow:
+        try:
+            client.follow_url_raw(socket_path, client.append_query(api_route, "follow=1"))
+        except RuntimeError as e:
+            print(str(e))
+            return 1
+        except KeyboardInterrupt:
+            print("")
+        return 0
+
     try:
         result = client.get_url_raw(socket_path, api_route)
     except RuntimeError as e:
@@ -675,7 +689,8 @@ def compose_image(socket_path, api_version, args, show_json=False, testmode=0, a
     compose image <uuid>
 
     This downloads only the result image, saving it as the image name, which depends on the type
-    of compose that was selected.
+    of compose that was selected. An interrupted download is resumed, and the image is not
+    downloaded again if it already exists.
     """
     if len(args) == 0:
         log.error("logs is missing the compose build id")
@@ -683,7 +698,7 @@ def compose_image(socket_path, api_version, args, show_json=False, testmode=0, a
 
     api_route = client.api_url(api_version, "/compose/image/%s" % args[0])
     try:
-        rc = client.download_file(socket_path, api_route, sys.stdout.isatty())
+        rc = client.download_image(socket_path, api_route, sys.stdout.isatty())
     except RuntimeError as e:
         print(str(e))
         rc = 1
@@ -33,8 +33,9 @@ compose status
 compose list [waiting|running|finished|failed]
     List basic information about composes.
 
-compose log <UUID> [<SIZE>]
-    Show the last SIZE kB of the compose log.
+compose log <UUID> [<SIZE>] [--follow]
+    Show the last SIZE kB of the compose log. With --follow keep showing the
+    new lines of the log until the compose has finished.
 
 compose cancel <UUID>
     Cancel a running compose and delete any intermediate results.
@@ -110,8 +111,8 @@ modules list
 """
 
 projects_help = """
-projects list
-    List the available projects.
+projects list [SEARCH]
+    List the available projects, or only the ones with SEARCH in their name.
 
 projects info <PROJECT,...>
     Show details about the listed projects.
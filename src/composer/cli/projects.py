@@ -18,6 +18,7 @@ import logging
 log = logging.getLogger("composer-cli")
 
 import textwrap
+from urllib.parse import quote
 
 from composer import http_client as client
 from composer.cli.help import projects_help
@@ -56,9 +57,11 @@ def projects_list(socket_path, api_version, args, show_json=False):
     :param show_json: Set to True to show the JSON output instead of the human readable output
     :type show_json: bool
 
-    projects list
+    projects list [SEARCH]
     """
     api_route = client.api_url(api_version, "/projects/list")
+    if args:
+        api_route = client.append_query(api_route, "search=%s" % quote(args[0]))
     result = client.get_url_json_unlimited(socket_path, api_route)
     (rc, exit_now) = handle_api_result(result, show_json)
     if exit_now:
@@ -17,6 +17,7 @@
 import logging
 log = logging.getLogger("composer-cli")
 
+import codecs
 import os
 import sys
 import json
@@ -79,6 +80,36 @@ def get_url_raw(socket_path, url):
 
     return r.data.decode('utf-8')
 
+def follow_url_raw(socket_path, url, f=sys.stdout):
+    """Write the raw results of a GET request as they are received
+
+    :param socket_path: Path to the Unix socket to use for API communication
+    :type socket_path: str
+    :param url: URL to request
+    :type url: str
+    :param f: File to write the text to
+    :type f: file object
+    :returns: None
+    :raises: RuntimeError if there was an error
+
+    There is no timeout, the server may not send anything for a long time
+    while it waits for new data.
+    """
+    http = UnixHTTPConnectionPool(socket_path, timeout=None)
+    r = http.request("GET", url, preload_content=False)
+    if r.status == 400:
+        err = json.loads(r.data.decode("utf-8"))
+        if "status" in err and err["status"] == False:
+            msgs = [e["msg"] for e in err["errors"]]
+            raise RuntimeError(", ".join(msgs))
+
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    for data in r.stream(decode_content=True):
+        f.write(decoder.decode(data))
+        f.flush()
+    f.write(decoder.decode(b"", final=True))
+    r.release_conn()
+
 def get_url_json(socket_path, url):
     """Return the JSON results of a GET request
 
@@ -240,21 +271,102 @@ def download_file(socket_path, url, progress=True):
         raise RuntimeError(msg)
 
     with open(filename, "wb") as f:
-        while True:
-            data = r.read(10 * 1024**2)
-            if not data:
-                break
-            f.write(data)
-
-            if progress:
-                data_written = f.tell()
-                if data_written > 5 * 1024**2:
-                    sys.stdout.write("%s: %0.2f MB    \r" % (filename, data_written / 1024**2))
-                else:
-                    sys.stdout.write("%s: %0.2f kB\r" % (filename, data_written / 1024))
-                sys.stdout.flush()
+        write_response(r, f, filename, progress)
 
     print("")
     r.release_conn()
 
     return 0
+
+def write_response(r, f, filename, progress=True):
+    """Write the body of a response to a file, showing the progress
+
+    :param r: The urllib3 response, opened with preload_content=False
+    :type r: HTTPResponse
+    :param f: The file to write to, the progress includes any data already in it
+    :type f: file object
+    :param filename: The filename to show in the progress
+    :type filename: str
+    :param progress: Show the progress on stdout
+    :type progress: bool
+    """
+    while True:
+        data = r.read(10 * 1024**2)
+        if not data:
+            break
+        f.write(data)
+
+        if progress:
+            data_written = f.tell()
+            if data_written > 5 * 1024**2:
+                sys.stdout.write("%s: %0.2f MB    \r" % (filename, data_written / 1024**2))
+            else:
+                sys.stdout.write("%s: %0.2f kB\r" % (filename, data_written / 1024))
+            sys.stdout.flush()
+
+def download_image(socket_path, url, progress=True):
+    """Download a compose image, resuming an earlier download if possible
+
+    :param socket_path: Path to the Unix socket to use for API communication
+    :type socket_path: str
+    :param url: URL of the image
+    :type url: str
+    :param progress: Show the progress on stdout
+    :type progress: bool
+    :returns: 0
+    :rtype: int
+    :raises: RuntimeError if there was a problem, or a different file already exists
+
+    The image is downloaded to filename.part and renamed when it is complete. If
+    the .part file already exists the rest of the image is requested with Range,
+    and If-Range makes sure that it is still the same image. If the image already
+    exists, and is the same size, it is not downloaded again. If the .part file
+    is already complete it is renamed without downloading anything.
+    """
+    http = UnixHTTPConnectionPool(socket_path)
+    r = http.request("HEAD", url)
+    if r.status != 200:
+        # HEAD has no body with the error, GET it instead
+        return download_file(socket_path, url, progress)
+
+    filename = get_filename(r.headers)
+    size = int(r.headers.get("content-length", -1))
+    etag = r.headers.get("etag")
+    if os.path.exists(filename):
+        if os.path.getsize(filename) == size:
+            print("%s exists, skipping download" % filename)
+            return 0
+        msg = "%s exists, skipping download" % filename
+        log.error(msg)
+        raise RuntimeError(msg)
+
+    part_filename = filename + ".part"
+    headers = {}
+    if etag and os.path.exists(part_filename):
+        headers = {"Range": "bytes=%d-" % os.path.getsize(part_filename), "If-Range": etag}
+
+    r = http.request("GET", url, headers=headers, preload_content=False)
+    if r.status == 416:
+        r.release_conn()
+        if r.headers.get("content-range") == "bytes */%d" % os.path.getsize(part_filename):
+            # The .part file is all of the image, If-Range would have returned all of it otherwise
+            os.rename(part_filename, filename)
+            return 0
+        # The .part file is not part of this image, start again
+        r = http.request("GET", url, preload_content=False)
+    if r.status not in (200, 206):
+        r.release_conn()
+        raise RuntimeError("Downloading %s failed with status %d" % (filename, r.status))
+
+    with open(part_filename, "ab" if r.status == 206 else "wb") as f:
+        write_response(r, f, filename, progress)
+        written = f.tell()
+
+    print("")
+    r.release_conn()
+
+    if size >= 0 and written != size:
+        raise RuntimeError("Downloaded %d of %d bytes of %s, run it again to resume the download" % (written, size, filename))
+    os.rename(part_filename, filename)
+
+    return 0
@@ -33,3 +33,4 @@ def configure(conf):
     conf.set("upload", "providers_dir", joinpaths(share_dir, "/lifted/providers/"))
     conf.set("upload", "queue_dir", joinpaths(lib_dir, "/upload/queue/"))
     conf.set("upload", "settings_dir", joinpaths(lib_dir, "/upload/settings/"))
+    conf.set("upload", "events_dir", joinpaths(lib_dir, "/events/"))
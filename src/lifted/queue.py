@@ -32,8 +32,9 @@ from multiprocessing.dummy import Process
 from operator import attrgetter
 import os
 import stat
-import time
 
+from pylorax.api.dirwatch import DirWatch, IN_CLOSE_WRITE, IN_MOVED_TO
+from pylorax.api.events import publish_event
 import pylorax.api.toml as toml
 
 from lifted.upload import Upload
@@ -42,6 +43,9 @@ from lifted.providers import resolve_playbook_path, validate_settings
 # the maximum number of simultaneous uploads
 SIMULTANEOUS_UPLOADS = 1
 
+# how often to re-read all of the uploads when inotify is watching the queue
+MONITOR_TIMEOUT = 60
+
 log = logging.getLogger("lifted")
 multiprocessing.log_to_stderr().setLevel(logging.INFO)
 
@@ -55,13 +59,11 @@ def _get_queue_path(ucfg):
     return path
 
 
-def _get_upload_path(ucfg, uuid, write=False):
+def _get_upload_path(ucfg, uuid):
     # Make sure no path elements are present
     uuid = os.path.basename(uuid)
 
     path = os.path.join(_get_queue_path(ucfg), f"{uuid}.toml")
-    if write and not os.path.exists(path):
-        open(path, "a").close()
     if os.path.exists(path):
         # make sure uploads aren't readable by others, as they will contain
         # sensitive credentials
@@ -75,9 +77,40 @@ def _list_upload_uuids(ucfg):
     return [os.path.splitext(os.path.basename(path))[0] for path in paths]
 
 
+# The status of each unfinished upload the last time this process wrote it
+_written_status = {}
+
+# Nothing is written to an upload after it reaches one of these, unless it is reset
+_FINAL_STATUS = ("FINISHED", "FAILED", "CANCELLED", "DELETED")
+
+def _publish_upload_event(ucfg, upload_uuid, status, upload=None):
+    """Publish an upload event if this process has not already published its status"""
+    if _written_status.get(upload_uuid) == status:
+        return
+    if status in _FINAL_STATUS:
+        _written_status.pop(upload_uuid, None)
+    else:
+        _written_status[upload_uuid] = status
+    data = {"uuid": upload_uuid, "status": status}
+    if upload:
+        # The settings are not included, they have the provider's credentials
+        data.update(provider_name=upload.provider_name, image_name=upload.image_name,
+                    creation_time=upload.creation_time)
+    publish_event(ucfg.get("events_dir"), "upload", data)
+
+
 def _write_upload(ucfg, upload):
-    with open(_get_upload_path(ucfg, upload.uuid, write=True), "w") as upload_file:
+    # Write to a hidden file and rename it so that the monitor never reads a partial upload
+    path = _get_upload_path(ucfg, upload.uuid)
+    tmp_path = os.path.join(os.path.dirname(path), "." + os.path.basename(path))
+    with open(tmp_path, "w") as upload_file:
+        # make sure uploads aren't readable by others, as they will contain
+        # sensitive credentials
+        current = stat.S_IMODE(os.fstat(upload_file.fileno()).st_mode)
+        os.fchmod(upload_file.fileno(), current & ~stat.S_IROTH)
         toml.dump(upload.serializable(), upload_file)
+    os.rename(tmp_path, path)
+    _publish_upload_event(ucfg, upload.uuid, upload.status, upload)
 
 
 def _write_callback(ucfg):
@@ -163,7 +196,7 @@ def create_upload(ucfg, provider_name, image_name, settings):
     )
 
 
-def ready_upload(ucfg, uuid, image_path):
+def ready_upload(ucfg, uuid, image_path, image_sha256=None):
     """Pass an image_path to an upload and mark it ready to execute
 
     :param ucfg: upload config
@@ -172,8 +205,10 @@ def ready_upload(ucfg, uuid, image_path):
     :type uuid: str
     :param image_path: the path of the image to pass to the upload
     :type image_path: str
+    :param image_sha256: the SHA-256 of the image, if it is known
+    :type image_sha256: str
     """
-    get_upload(ucfg, uuid).ready(image_path, _write_callback(ucfg))
+    get_upload(ucfg, uuid).ready(image_path, _write_callback(ucfg), image_sha256)
 
 
 def reset_upload(ucfg, uuid, new_image_name=None, new_settings=None):
@@ -225,6 +260,7 @@ def delete_upload(ucfg, uuid):
     if upload and upload.is_cancellable():
         upload.cancel()
     os.remove(_get_upload_path(ucfg, uuid))
+    _publish_upload_event(ucfg, uuid, "DELETED")
 
 
 def start_upload_monitor(ucfg):
@@ -250,11 +286,19 @@ def _monitor(ucfg):
     def remover(uuid):
         return lambda _: pool_uuids.remove(uuid)
 
+    # Uploads are written to a hidden file and then renamed into place
+    watch = DirWatch(_get_queue_path(ucfg), mask=IN_MOVED_TO|IN_CLOSE_WRITE)
+    changed = None
     while True:
-        # Every second, scoop up READY uploads from the filesystem and throw
-        # them in the pool
-        all_uploads = get_all_uploads(ucfg)
-        for upload in sorted(all_uploads, key=attrgetter("creation_time")):
+        # Scoop up READY uploads from the filesystem and throw them in the pool.
+        # Only the changed uploads are read when the watch reports them, everything
+        # is checked when it times out (or every second if inotify isn't available).
+        if changed is None:
+            uploads = get_all_uploads(ucfg)
+        else:
+            uuids = [os.path.splitext(name)[0] for name in changed if not name.startswith(".")]
+            uploads = get_uploads(ucfg, uuids)
+        for upload in sorted(uploads, key=attrgetter("creation_time")):
             ready = upload.status == "READY"
             if ready and upload.uuid not in pool_uuids:
                 log.info("Starting upload %s...", upload.uuid)
@@ -266,4 +310,4 @@ def _monitor(ucfg):
                     callback=callback,
                     error_callback=callback,
                 )
-        time.sleep(1)
+        changed = watch.wait(1 if watch.polling else MONITOR_TIMEOUT)
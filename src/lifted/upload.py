@@ -46,6 +46,7 @@ class Upload:
         image_path=None,
         status_callback=None,
         status=None,
+        image_sha256=None,
     ):
         self.uuid = uuid or str(uuid4())
         self.provider_name = provider_name
@@ -56,6 +57,7 @@ class Upload:
         self.upload_log = upload_log or ""
         self.upload_pid = upload_pid
         self.image_path = image_path
+        self.image_sha256 = image_sha256
         if status:
             self.status = status
         else:
@@ -117,16 +119,19 @@ class Upload:
         if status_callback:
             status_callback(self)
 
-    def ready(self, image_path, status_callback):
+    def ready(self, image_path, status_callback, image_sha256=None):
         """Provide an image_path and mark the upload as ready to execute
 
         :param image_path: path of the image to upload
         :type image_path: str
         :param status_callback: a function of the form callback(self)
         :type status_callback: function
+        :param image_sha256: SHA-256 of the image, if it is known
+        :type image_sha256: str
         """
         self._log("Setting image_path to %s" % image_path)
         self.image_path = image_path
+        self.image_sha256 = image_sha256
         if self.status == "WAITING":
             self.set_status("READY", status_callback)
 
@@ -183,12 +188,15 @@ class Upload:
             # NOTE: event_handler doesn't seem to be called for playbook errors
             logger = lambda e: self._log(e["stdout"], status_callback)
 
+            # The provided playbooks still name the uploaded images with the
+            # SHA-1 from stat so that images uploaded before can be found again
             runner = ansible_run(
                 playbook=self.playbook_path,
                 extravars={
                     **self.settings,
                     "image_name": self.image_name,
                     "image_path": self.image_path,
+                    "image_sha256": self.image_sha256,
                 },
                 event_handler=logger,
                 verbosity=2,
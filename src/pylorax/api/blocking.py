@@ -0,0 +1,122 @@
+#
+# Copyright (C) 2020  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Call functions that block, without blocking the other requests
+
+The API is served by gevent in the main thread, without monkey patching, so a
+call that blocks there, eg. waiting for a lock or for sqlite, stops all of the
+requests. `call_blocking()` runs it in a thread pool instead, and the request's
+greenlet waits for the result.
+"""
+import os
+import threading
+
+from gevent.threadpool import ThreadPool
+
+# Calls that wait for locks can take a long time, so they have their own pool
+# instead of using up the threads of the hub's pool
+MAX_THREADS = 64
+_threadpool = None
+_threadpool_pid = None
+
+def _get_threadpool():
+    """Return the thread pool for this process, threads do not survive a fork"""
+    global _threadpool, _threadpool_pid
+    if _threadpool is None or _threadpool_pid != os.getpid():
+        _threadpool = ThreadPool(MAX_THREADS)
+        _threadpool_pid = os.getpid()
+    return _threadpool
+
+def call_blocking(func, *args, undo=None):
+    """Call a function that may block, without blocking the other greenlets
+
+    :param func: The function to call
+    :type func: callable
+    :param args: The arguments to pass to it
+    :param undo: Called with the result if the caller stops waiting before func returns
+    :type undo: callable
+    :returns: The result of func
+    :raises: The exception raised by func
+
+    In the main thread func is called in a thread, and the caller's greenlet waits
+    for it. Other threads are not running gevent, so they call it directly.
+
+    If the greenlet is killed while it waits, func still runs to the end. Pass undo,
+    eg. to release a lock that func acquired, so that the result is not lost.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return func(*args)
+
+    result = _get_threadpool().spawn(_call, func, args)
+    try:
+        ok, value = result.get()
+    except BaseException:
+        if undo is not None and not result.ready():
+            result.rawlink(lambda r: r.successful() and r.value[0] and undo(r.value[1]))
+        raise
+    if not ok:
+        raise value
+    return value
+
+def _call(func, args):
+    """Return (True, result) or (False, exception)
+
+    The exception is passed back to the caller instead of being raised in the
+    thread, which would make gevent log it as an error.
+    """
+    try:
+        return (True, func(*args))
+    except Exception as e:                                  # pylint: disable=broad-except
+        return (False, e)
+
+class GeventLock(object):
+    """A lock shared by threads and by the greenlets of the main thread
+
+    A greenlet that waits for a threading.Lock blocks all of the others, this one
+    waits for it in a thread instead. It can be used as a context manager, like
+    threading.Lock.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def acquire(self, blocking=True):
+        """Take the lock
+
+        :param blocking: Wait for the lock if it is held
+        :type blocking: bool
+        :returns: True if the lock was taken
+        :rtype: bool
+        """
+        if self._lock.acquire(False):
+            return True
+        if not blocking:
+            return False
+        return call_blocking(self._lock.acquire, undo=lambda _: self._lock.release())
+
+    def release(self):
+        """Release the lock"""
+        self._lock.release()
+
+    def locked(self):
+        """Return True if the lock is held"""
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
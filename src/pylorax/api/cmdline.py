@@ -57,6 +57,8 @@ def lorax_composer_parser():
                         help="Set proxy for DNF, overrides configuration file setting.")
     parser.add_argument("--no-system-repos", action="store_true", default=False,
                         help="Do not copy over system repos from /etc/yum.repos.d/ at startup")
+    parser.add_argument("--workers", type=int, default=1, metavar="WORKERS",
+                        help="Number of processes handling the API requests")
     parser.add_argument("BLUEPRINTS", metavar="BLUEPRINTS",
                         help="Path to the blueprints")
 
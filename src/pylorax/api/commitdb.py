@@ -0,0 +1,206 @@
+#
+# Copyright (C) 2020 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Persistent index of the blueprint commit history
+
+The git repository is still the canonical source of the history, this index is a
+copy of the commits that changed each file on each branch so that listing the
+changes to a blueprint does not need to walk and diff every commit on the branch.
+
+The index is a sqlite database stored in the blueprint git directory. Each branch
+records the head commit that it has been updated to, and the commits are numbered
+in branch order so that a page of them can be read directly. It is updated after
+each commit, see `pylorax.api.recipes.update_commit_index()`.
+"""
+from contextlib import contextmanager
+import fcntl
+import sqlite3
+from threading import Lock
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS heads (
+    branch TEXT PRIMARY KEY,
+    head TEXT NOT NULL,
+    seq INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS commits (
+    branch TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    commit_id TEXT NOT NULL,
+    time INTEGER NOT NULL,
+    utc_offset INTEGER NOT NULL,
+    message TEXT NOT NULL,
+    revision INTEGER,
+    PRIMARY KEY (branch, filename, commit_id)
+);
+CREATE INDEX IF NOT EXISTS commits_file ON commits(branch, filename, seq);
+"""
+
+class CommitIndex(object):
+    """Store and retrieve the commit history in a sqlite database
+
+    :param path: Path to the database file
+    :type path: str
+
+    A new connection is used for each operation, the callers hold the git lock.
+    Updates also need to hold `updating()`, readers may be updating it at the same time.
+    """
+    # Paths that have had the schema created by this process
+    _initialized = set()
+    # The last head read or written by this process for each (path, branch)
+    _heads = {}
+    # The thread lock used by updating() for each path
+    _update_locks = {}
+    _update_locks_lock = Lock()
+
+    def __init__(self, path):
+        self.path = path
+
+    @contextmanager
+    def _connect(self):
+        """Return a connection that commits on success, and is always closed"""
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            if self.path not in self._initialized:
+                conn.executescript(SCHEMA)
+                self._initialized.add(self.path)
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def updating(self):
+        """Hold the exclusive lock for updating the index
+
+        This is held by one thread, in one process, at a time. Check the head again
+        after taking it, another thread may have already made the update.
+        """
+        with self._update_locks_lock:
+            lock = self._update_locks.setdefault(self.path, Lock())
+        with lock:
+            with open(self.path + ".lock", "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield self
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def is_current(self, branch, head):
+        """Return True if the branch has been indexed up to head
+
+        :param branch: Branch name
+        :type branch: str
+        :param head: The branch's head commit id
+        :type head: str
+        :returns: True if head is the indexed head
+        :rtype: bool
+
+        The head last seen by this process is checked first, the database is only
+        read when it is different, eg. after another process has updated it.
+        """
+        if self._heads.get((self.path, branch)) == head:
+            return True
+        return self.get_head(branch)[0] == head
+
+    def get_head(self, branch):
+        """Return the commit the branch has been indexed up to
+
+        :param branch: Branch name
+        :type branch: str
+        :returns: The head commit id and its sequence number, or (None, 0)
+        :rtype: tuple
+        """
+        with self._connect() as conn:
+            row = conn.execute("SELECT head, seq FROM heads WHERE branch=?", (branch,)).fetchone()
+        if row is None:
+            return (None, 0)
+        self._heads[(self.path, branch)] = row[0]
+        return (row[0], row[1])
+
+    def add(self, branch, head, seq, commits, replace=False):
+        """Add new commits to a branch and move its head
+
+        :param branch: Branch name
+        :type branch: str
+        :param head: The branch's new head commit id
+        :type head: str
+        :param seq: The sequence number of the new head
+        :type seq: int
+        :param commits: filename, seq, commit id, time, utc offset, message, and revision of each change
+        :type commits: list of tuples
+        :param replace: Remove the branch's existing commits first
+        :type replace: bool
+        """
+        with self._connect() as conn:
+            if replace:
+                conn.execute("DELETE FROM commits WHERE branch=?", (branch,))
+            conn.executemany("INSERT OR REPLACE INTO commits (branch, filename, seq, commit_id, time, utc_offset, "
+                             "message, revision) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                             [(branch,) + tuple(c) for c in commits])
+            conn.execute("INSERT OR REPLACE INTO heads (branch, head, seq) VALUES (?, ?, ?)",
+                         (branch, head, seq))
+        self._heads[(self.path, branch)] = head
+
+    def set_revision(self, branch, filename, commit_id, revision):
+        """Set the revision of a commit after it has been tagged
+
+        :param branch: Branch name
+        :type branch: str
+        :param filename: The file the tag is for
+        :type filename: str
+        :param commit_id: The commit id
+        :type commit_id: str
+        :param revision: The revision, or None
+        :type revision: int or None
+        """
+        with self._connect() as conn:
+            conn.execute("UPDATE commits SET revision=? WHERE branch=? AND filename=? AND commit_id=?",
+                         (revision, branch, filename, commit_id))
+
+    def count(self, branch, filename):
+        """Return the number of commits that changed the file
+
+        :param branch: Branch name
+        :type branch: str
+        :param filename: Filename
+        :type filename: str
+        :returns: The number of commits
+        :rtype: int
+        """
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM commits WHERE branch=? AND filename=?",
+                                (branch, filename)).fetchone()[0]
+
+    def list(self, branch, filename, offset=0, limit=0):
+        """Return the commits that changed the file, newest first
+
+        :param branch: Branch name
+        :type branch: str
+        :param filename: Filename
+        :type filename: str
+        :param offset: Number of commits to skip
+        :type offset: int
+        :param limit: Number of commits to return (0=all)
+        :type limit: int
+        :returns: The commit id, time, utc offset, message, and revision of each commit
+        :rtype: list of tuples
+        """
+        with self._connect() as conn:
+            return conn.execute("SELECT commit_id, time, utc_offset, message, revision FROM commits "
+                                "WHERE branch=? AND filename=? ORDER BY seq DESC LIMIT ? OFFSET ?",
+                                (branch, filename, limit or -1, max(offset, 0))).fetchall()
@@ -33,29 +33,41 @@ parameters needed to generate the desired output. Other types should be set to F
 import logging
 log = logging.getLogger("lorax-composer")
 
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
 import os
 from glob import glob
 from io import StringIO
 from math import ceil
 import shutil
+import subprocess
 from uuid import uuid4
 
 # Use pykickstart to calculate disk image size
 from pykickstart.parser import KickstartParser
 from pykickstart.version import makeVersion
 
-from pylorax import ArchData, find_templates, get_buildarch
+from pylorax import ArchData, find_templates, get_buildarch, vernum
+from pylorax.api.composedb import compose_index, get_image_name, index_compose
+from pylorax.api.composedb import read_image_checksum, write_image_checksum
 from pylorax.api.gitrpm import create_gitrpm_repo
-from pylorax.api.projects import projects_depsolve, projects_depsolve_with_size, dep_nevra
-from pylorax.api.projects import ProjectsError
+from pylorax.api.projects import projects_depsolve_with_size, dep_nevra
+from pylorax.api.projects import ProjectsError, repos_revision
 from pylorax.api.recipes import read_recipe_and_id
-from pylorax.api.timestamp import TS_CREATED, write_timestamp
+from pylorax.api.rpmcache import create_cache_repo
+from pylorax.api.timestamp import TS_CREATED, TS_STARTED, TS_FINISHED, write_timestamp
 import pylorax.api.toml as toml
 from pylorax.base import DataHolder
 from pylorax.imgutils import default_image_name
 from pylorax.ltmpl import LiveTemplateRunner
 from pylorax.sysutils import joinpaths, flatconfig
 
+from lifted.queue import ready_upload
+
+# start_build() returns right away, the builds are prepared in the order they were started
+_prepare_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prepare-build")
 
 def test_templates(dbo, share_dir):
     """ Try depsolving each of the the templates and report any errors
@@ -66,24 +78,17 @@ def test_templates(dbo, share_dir):
     :rtype: List of errors
 
     Return a list of templates and errors encountered or an empty list
+
+    This also stores the `TemplateInfo` for each of the templates, so that
+    `start_build()` does not need to depsolve them.
     """
     template_errors = []
     for compose_type, enabled in compose_types(share_dir):
         if not enabled:
             continue
 
-        # Read the kickstart template for this type
-        ks_template_path = joinpaths(share_dir, "composer", compose_type) + ".ks"
-        ks_template = open(ks_template_path, "r").read()
-
-        # How much space will the packages in the default template take?
-        ks_version = makeVersion()
-        ks = KickstartParser(ks_version, errorsAreFatal=False, missingIncludeIsFatal=False)
-        ks.readKickstartFromString(ks_template+"\n%end\n")
-        pkgs = [(name, "*") for name in ks.handler.packages.packageList]
-        grps = [grp.name for grp in ks.handler.packages.groupList]
         try:
-            projects_depsolve(dbo, pkgs, grps)
+            get_template_info(dbo, share_dir, compose_type)
         except ProjectsError as e:
             template_errors.append("Error depsolving %s: %s" % (compose_type, str(e)))
 
@@ -674,7 +679,169 @@ def get_extra_pkgs(dbo, share_dir, compose_type):
     return runner.pkgnames
 
 
-def start_build(cfg, dnflock, gitlock, branch, recipe_name, compose_type, test_mode=0):
+# The parsed kickstart template for a compose type, and the size of its packages
+TemplateInfo = namedtuple("TemplateInfo", ["ks_template", "packages", "groups", "nocore",
+                                           "template_size", "template_deps", "extra_pkgs", "revision"])
+
+# TemplateInfo for each template, keyed by the template paths and their mtimes
+_template_info = {}
+
+def _template_key(share_dir, compose_type):
+    """Return the paths of the templates and their modification times
+
+    :returns: A key that changes when the templates are replaced or modified
+    :rtype: tuple
+    """
+    paths = [joinpaths(share_dir, "composer", compose_type) + ".ks"]
+    if compose_type == "live-iso":
+        paths.append(joinpaths(find_templates(share_dir), "live", "live-install.tmpl"))
+    return tuple((p, os.stat(p).st_mtime_ns) for p in paths if os.path.exists(p))
+
+def get_template_info(dbo, share_dir, compose_type):
+    """Return the kickstart template details for a compose type
+
+    :param dbo: dnf base object
+    :type dbo: dnf.Base
+    :param share_dir: Path to the top level share directory
+    :type share_dir: str
+    :param compose_type: The type of output to create from the recipe
+    :type compose_type: str
+    :returns: The template, its packages and groups, the size of the depsolved packages,
+              the depsolved packages, and the extra packages needed by the output type
+    :rtype: TemplateInfo
+    :raises: ProjectsError if the template's packages cannot be depsolved
+
+    The result is reused until the templates or the repository metadata change. Make
+    sure access to the dbo has been locked before calling this.
+    """
+    key = _template_key(share_dir, compose_type)
+    revision = repos_revision(dbo)
+    info = _template_info.get(key)
+    if info is not None and info.revision == revision:
+        return info
+
+    # Read the kickstart template for this type
+    ks_template_path = joinpaths(share_dir, "composer", compose_type) + ".ks"
+    ks_template = open(ks_template_path, "r").read()
+
+    # How much space will the packages in the default template take?
+    ks_version = makeVersion()
+    ks = KickstartParser(ks_version, errorsAreFatal=False, missingIncludeIsFatal=False)
+    ks.readKickstartFromString(ks_template+"\n%end\n")
+    pkgs = [(name, "*") for name in ks.handler.packages.packageList]
+    grps = [grp.name for grp in ks.handler.packages.groupList]
+    nocore = ks.handler.packages.nocore
+    (template_size, template_deps) = projects_depsolve_with_size(dbo, pkgs, grps, with_core=not nocore)
+
+    # Some image types (live-iso) need extra packages for composer to execute the output template
+    extra_pkgs = get_extra_pkgs(dbo, share_dir, compose_type)
+    log.debug("Extra packages needed for %s: %s", compose_type, extra_pkgs)
+
+    info = TemplateInfo(ks_template, pkgs, grps, nocore, template_size, template_deps, extra_pkgs, revision)
+    # Drop the details of older versions of the same template
+    paths = [p for p, _ in key]
+    for k in [k for k in _template_info if [p for p, _ in k] == paths]:
+        del _template_info[k]
+    _template_info[key] = info
+    return info
+
+def compose_cache_key(deps, ks_path, cfg_args):
+    """ Return a key that identifies the output of a compose
+
+    :param deps: The depsolved packages for the compose
+    :type deps: list of dicts
+    :param ks_path: Path to the final kickstart
+    :type ks_path: str
+    :param cfg_args: The compose settings written to config.toml
+    :type cfg_args: dict
+    :returns: sha256 hex digest of the compose's inputs
+    :rtype: str
+
+    The paths that include the build's uuid are not included in the key.
+    """
+    h = hashlib.sha256()
+    h.update(vernum.encode("utf-8"))
+    for nevra in sorted(dep_nevra(d) for d in deps):
+        h.update(nevra.encode("utf-8") + b"\n")
+    with open(ks_path, "rb") as f:
+        h.update(f.read())
+    args = dict((k, v) for k, v in cfg_args.items() if k not in ("ks", "logfile"))
+    h.update(json.dumps(args, sort_keys=True).encode("utf-8"))
+    return h.hexdigest()
+
+def link_cached_image(src_path, dst_path):
+    """ Hardlink or reflink an image from another build
+
+    :param src_path: Path to the image in the cached build's results
+    :type src_path: str
+    :param dst_path: Path to the image in the new build's results
+    :type dst_path: str
+    :returns: True if the image was linked
+    :rtype: bool
+    """
+    try:
+        os.link(src_path, dst_path)
+        return True
+    except OSError as e:
+        log.debug("Cannot hardlink %s: %s", src_path, e)
+    try:
+        subprocess.check_call(["cp", "--reflink=always", src_path, dst_path])
+        return True
+    except (subprocess.CalledProcessError, OSError) as e:
+        log.debug("Cannot reflink %s: %s", src_path, e)
+    return False
+
+def use_cached_build(lib_dir, results_dir, cache_key, image_name):
+    """ Finish a build using the image from a previous build with the same cache key
+
+    :param lib_dir: The composer lib_dir
+    :type lib_dir: str
+    :param results_dir: The new build's results directory
+    :type results_dir: str
+    :param cache_key: The key from compose_cache_key()
+    :type cache_key: str
+    :param image_name: The name of the image file
+    :type image_name: str
+    :returns: The uuid of the build that was used, or None
+    :rtype: str or None
+
+    The cached build's CACHE_HITS counter is incremented, and the new build's
+    CACHED_FROM is set to its uuid.
+    """
+    cached_id = compose_index(lib_dir).find_cached(cache_key)
+    if not cached_id:
+        return None
+
+    cached_dir = joinpaths(lib_dir, "results", cached_id)
+    cached_image = joinpaths(cached_dir, image_name)
+    if not os.path.exists(cached_image):
+        return None
+    if not link_cached_image(cached_image, joinpaths(results_dir, image_name)):
+        return None
+    checksum = read_image_checksum(cached_dir)
+    if checksum:
+        with open(joinpaths(results_dir, "IMAGE_SHA256"), "w") as f:
+            f.write(checksum + "\n")
+    else:
+        write_image_checksum(results_dir, joinpaths(results_dir, image_name))
+
+    hits_path = joinpaths(cached_dir, "CACHE_HITS")
+    try:
+        with open(hits_path, "r") as f:
+            hits = int(f.read())
+    except (IOError, ValueError):
+        hits = 0
+    with open(hits_path, "w") as f:
+        f.write("%d\n" % (hits + 1))
+    with open(joinpaths(results_dir, "CACHED_FROM"), "w") as f:
+        f.write(cached_id)
+
+    os.makedirs(joinpaths(results_dir, "logs"), exist_ok=True)
+    with open(joinpaths(results_dir, "logs", "combined.log"), "w") as f:
+        f.write("Using the image from build %s with the same packages, kickstart, and settings\n" % cached_id)
+    return cached_id
+
+def start_build(cfg, dnflock, gitlock, branch, recipe_name, compose_type, test_mode=0, use_cache=True):
     """ Start the build
 
     :param cfg: Configuration object
@@ -685,8 +852,14 @@ def start_build(cfg, dnflock, gitlock, branch, recipe_name, compose_type, test_m
     :type recipe: str
     :param compose_type: The type of output to create from the recipe
     :type compose_type: str
+    :param use_cache: Use the image from an identical FINISHED build if there is one
+    :type use_cache: bool
     :returns: Unique ID for the build that can be used to track its status
     :rtype: str
+
+    This creates the results directory with the blueprint, and sets the build's status
+    to PENDING. The git rpms, depsolving, and kickstart generation are done by
+    `prepare_build()` in the background, which moves it to WAITING (or FAILED).
     """
     share_dir = cfg.get("composer", "share_dir")
     lib_dir = cfg.get("composer", "lib_dir")
@@ -698,18 +871,189 @@ def start_build(cfg, dnflock, gitlock, branch, recipe_name, compose_type, test_m
     if not type_enabled:
         raise RuntimeError("Compose type '%s' is disabled on this architecture" % compose_type)
 
-    # Some image types (live-iso) need extra packages for composer to execute the output template
-    with dnflock.lock:
-        extra_pkgs = get_extra_pkgs(dnflock.dbo, share_dir, compose_type)
-    log.debug("Extra packages needed for %s: %s", compose_type, extra_pkgs)
-
-    with gitlock.lock:
+    with gitlock.lock.read():
         (commit_id, recipe) = read_recipe_and_id(gitlock.repo, branch, recipe_name)
 
+    # Create the results directory
+    build_id = str(uuid4())
+    results_dir = joinpaths(lib_dir, "results", build_id)
+    os.makedirs(results_dir)
+
+    # Write the recipe commit hash
+    commit_path = joinpaths(results_dir, "COMMIT")
+    with open(commit_path, "w") as f:
+        f.write(commit_id)
+
+    # Write the original recipe
+    recipe_path = joinpaths(results_dir, "blueprint.toml")
+    with open(recipe_path, "w") as f:
+        f.write(recipe.toml())
+
+    # Save a copy of the original kickstart
+    ks_template_path = joinpaths(share_dir, "composer", compose_type) + ".ks"
+    shutil.copy(ks_template_path, results_dir)
+
+    # Set the initial status, and note which process is preparing it
+    open(joinpaths(results_dir, "STATUS"), "w").write("PENDING")
+    with open(joinpaths(results_dir, "PREPARE_PID"), "w") as f:
+        f.write(str(os.getpid()))
+    write_timestamp(results_dir, TS_CREATED)
+    index_compose(lib_dir, results_dir)
+
+    log.info("Preparing %s (%s %s)", build_id, recipe["name"], compose_type)
+    _prepare_executor.submit(prepare_build, cfg, dnflock, results_dir, recipe, compose_type, test_mode, use_cache)
+
+    return build_id
+
+def prepare_build(cfg, dnflock, results_dir, recipe, compose_type, test_mode=0, use_cache=True):
+    """ Prepare a PENDING build and add it to the queue
+
+    :param cfg: Configuration object
+    :type cfg: ComposerConfig
+    :param dnflock: Lock and YumBase for depsolving
+    :type dnflock: YumLock
+    :param results_dir: The build's results directory, created by `start_build()`
+    :type results_dir: str
+    :param recipe: The blueprint to build
+    :type recipe: Recipe
+    :param compose_type: The type of output to create from the recipe
+    :type compose_type: str
+    :param use_cache: Use the image from an identical FINISHED build if there is one
+    :type use_cache: bool
+    :returns: None
+
+    If there is a problem the build's status is set to FAILED and the error is
+    written to its logs/combined.log
+
+    If a FINISHED build has the same packages, kickstart, and settings its image is
+    linked into the new build's results and the new build is FINISHED without being
+    added to the queue.
+    """
+    lib_dir = cfg.get("composer", "lib_dir")
+    build_id = os.path.basename(results_dir)
+    cancel_path = joinpaths(results_dir, "CANCEL")
+    try:
+        if os.path.exists(cancel_path):
+            raise RuntimeError("Build was canceled")
+
+        status = _prepare_build(cfg, dnflock, results_dir, recipe, compose_type, test_mode, use_cache)
+    except Exception as e:
+        log.error("Preparing %s failed: %s", build_id, str(e))
+        log_dir = joinpaths(results_dir, "logs")
+        if not os.path.exists(log_dir):
+            os.makedirs(log_dir)
+        with open(joinpaths(log_dir, "combined.log"), "a") as f:
+            f.write("Preparing the build failed: %s\n" % str(e))
+        open(joinpaths(results_dir, "STATUS"), "w").write("FAILED")
+        write_timestamp(results_dir, TS_FINISHED)
+        status = "FAILED"
+
+    index_compose(lib_dir, results_dir)
+    if status == "WAITING":
+        log.info("Adding %s (%s %s) to compose queue", build_id, recipe["name"], compose_type)
+        os.symlink(results_dir, joinpaths(lib_dir, "queue/new/", build_id))
+
+    # uuid_cancel() leaves the deletion of a PENDING build to us. It writes CANCEL before
+    # reading the status, so checking after the status has been written cannot miss it.
+    if status != "FINISHED" and os.path.exists(cancel_path):
+        if status == "WAITING":
+            try:
+                os.unlink(joinpaths(lib_dir, "queue/new/", build_id))
+            except FileNotFoundError:
+                # The queue monitor has started it, and will see the CANCEL file
+                return
+        log.info("Deleting canceled build %s", build_id)
+        # queue imports compose, so this cannot be imported at the top
+        from pylorax.api.queue import uuid_delete
+        try:
+            uuid_delete(cfg, build_id)
+        except FileNotFoundError:
+            # uuid_cancel() saw that it FAILED and deleted it
+            pass
+    elif status == "FINISHED":
+        # Start any uploads that were scheduled while it was PENDING
+        try:
+            upload_ids = open(joinpaths(results_dir, "UPLOADS")).read().split()
+        except FileNotFoundError:
+            upload_ids = []
+        for upload_id in upload_ids:
+            log.info("Readying upload %s", upload_id)
+            ready_upload(cfg["upload"], upload_id, get_image_name(results_dir)[1], read_image_checksum(results_dir))
+
+def fail_prepares(cfg, pid):
+    """ Fail the PENDING builds that an exited process was preparing
+
+    :param cfg: Configuration object
+    :type cfg: ComposerConfig
+    :param pid: The pid of the process that started the builds
+    :type pid: int
+    :returns: None
+
+    Each API worker process prepares the builds it started, so when one exits
+    its PENDING builds would never leave the PENDING state. Canceled ones are
+    deleted, like `prepare_build()` would have done.
+    """
+    lib_dir = cfg.get("composer", "lib_dir")
+    for results_dir in glob(joinpaths(lib_dir, "results/*")):
+        try:
+            if open(joinpaths(results_dir, "PREPARE_PID")).read().strip() != str(pid):
+                continue
+            if open(joinpaths(results_dir, "STATUS")).read().strip() != "PENDING":
+                continue
+        except FileNotFoundError:
+            continue
+
+        build_id = os.path.basename(results_dir)
+        if os.path.exists(joinpaths(results_dir, "CANCEL")):
+            log.info("Deleting canceled build %s", build_id)
+            # queue imports compose, so this cannot be imported at the top
+            from pylorax.api.queue import uuid_delete
+            try:
+                uuid_delete(cfg, build_id)
+            except FileNotFoundError:
+                pass
+            continue
+
+        log.error("Setting build %s to FAILED, process %d exited while preparing it", build_id, pid)
+        log_dir = joinpaths(results_dir, "logs")
+        if not os.path.exists(log_dir):
+            os.makedirs(log_dir)
+        with open(joinpaths(log_dir, "combined.log"), "a") as f:
+            f.write("Preparing the build failed: process %d exited\n" % pid)
+        with open(joinpaths(results_dir, "STATUS"), "w") as f:
+            f.write("FAILED")
+        write_timestamp(results_dir, TS_FINISHED)
+        index_compose(lib_dir, results_dir)
+
+def _prepare_build(cfg, dnflock, results_dir, recipe, compose_type, test_mode, use_cache):
+    """ Create the git rpms, depsolve the build, and write its kickstart and config.toml
+
+    :returns: The new status of the build, WAITING or FINISHED
+    :rtype: str
+    :raises: RuntimeError if there is a problem with the build
+
+    See `prepare_build()` for the parameters.
+    """
+    share_dir = cfg.get("composer", "share_dir")
+    lib_dir = cfg.get("composer", "lib_dir")
+    build_id = os.path.basename(results_dir)
+
+    # Create the git rpms, if any. Cloning the repositories can take a while, so
+    # this is not done by start_build()
+    create_gitrpm_repo(results_dir, recipe)
+
+    # The template's packages and the extra packages needed by the output type
+    try:
+        with dnflock.lock:
+            template = get_template_info(dnflock.dbo, share_dir, compose_type)
+    except ProjectsError as e:
+        log.error("start_build depsolve: %s", str(e))
+        raise RuntimeError("Problem depsolving %s: %s" % (recipe["name"], str(e)))
+
     # Combine modules and packages and depsolve the list
     module_nver = recipe.module_nver
     package_nver = recipe.package_nver
-    package_nver.extend([(name, '*') for name in extra_pkgs])
+    package_nver.extend([(name, '*') for name in template.extra_pkgs])
 
     projects = sorted(set(module_nver+package_nver), key=lambda p: p[0].lower())
     deps = []
@@ -722,43 +1066,12 @@ def start_build(cfg, dnflock, gitlock, branch, recipe_name, compose_type, test_m
         log.error("start_build depsolve: %s", str(e))
         raise RuntimeError("Problem depsolving %s: %s" % (recipe["name"], str(e)))
 
-    # Read the kickstart template for this type
-    ks_template_path = joinpaths(share_dir, "composer", compose_type) + ".ks"
-    ks_template = open(ks_template_path, "r").read()
-
-    # How much space will the packages in the default template take?
-    ks_version = makeVersion()
-    ks = KickstartParser(ks_version, errorsAreFatal=False, missingIncludeIsFatal=False)
-    ks.readKickstartFromString(ks_template+"\n%end\n")
-    pkgs = [(name, "*") for name in ks.handler.packages.packageList]
-    grps = [grp.name for grp in ks.handler.packages.groupList]
-    try:
-        with dnflock.lock:
-            (template_size, _) = projects_depsolve_with_size(dnflock.dbo, pkgs, grps, with_core=not ks.handler.packages.nocore)
-    except ProjectsError as e:
-        log.error("start_build depsolve: %s", str(e))
-        raise RuntimeError("Problem depsolving %s: %s" % (recipe["name"], str(e)))
-    log.debug("installed_size = %d, template_size=%d", installed_size, template_size)
+    log.debug("installed_size = %d, template_size=%d", installed_size, template.template_size)
 
     # Minimum LMC disk size is 1GiB, and anaconda bumps the estimated size up by 10% (which doesn't always work).
-    installed_size = int((installed_size+template_size)) * 1.2
+    installed_size = int((installed_size+template.template_size)) * 1.2
     log.debug("/ partition size = %d", installed_size)
 
-    # Create the results directory
-    build_id = str(uuid4())
-    results_dir = joinpaths(lib_dir, "results", build_id)
-    os.makedirs(results_dir)
-
-    # Write the recipe commit hash
-    commit_path = joinpaths(results_dir, "COMMIT")
-    with open(commit_path, "w") as f:
-        f.write(commit_id)
-
-    # Write the original recipe
-    recipe_path = joinpaths(results_dir, "blueprint.toml")
-    with open(recipe_path, "w") as f:
-        f.write(recipe.toml())
-
     # Write the frozen recipe
     frozen_recipe = recipe.freeze(deps)
     recipe_path = joinpaths(results_dir, "frozen.toml")
@@ -770,27 +1083,29 @@ def start_build(cfg, dnflock, gitlock, branch, recipe_name, compose_type, test_m
     with open(deps_path, "w") as f:
         f.write(toml.dumps({"packages":deps}))
 
-    # Save a copy of the original kickstart
-    shutil.copy(ks_template_path, results_dir)
-
     with dnflock.lock:
         repos = list(dnflock.dbo.repos.iter_enabled())
     if not repos:
         raise RuntimeError("No enabled repos, canceling build.")
 
-    # Create the git rpms, if any, and return the path to the repo under results_dir
-    gitrpm_repo = create_gitrpm_repo(results_dir, recipe)
+    # The git rpms, if any, were created above
+    gitrpm_repo = joinpaths(results_dir, "repo/")
+    if not os.path.isdir(gitrpm_repo):
+        gitrpm_repo = ""
+
+    # The repositories to install from
+    ks_url = repo_to_ks(repos[0], "url")
+    log.debug("url = %s", ks_url)
+    ks_repos = 'url %s\n' % ks_url
+    for idx, r in enumerate(repos[1:]):
+        ks_repo = repo_to_ks(r, "baseurl")
+        log.debug("repo composer-%s = %s", idx, ks_repo)
+        ks_repos += 'repo --name="composer-%s" %s\n' % (idx, ks_repo)
 
     # Create the final kickstart with repos and package list
     ks_path = joinpaths(results_dir, "final-kickstart.ks")
     with open(ks_path, "w") as f:
-        ks_url = repo_to_ks(repos[0], "url")
-        log.debug("url = %s", ks_url)
-        f.write('url %s\n' % ks_url)
-        for idx, r in enumerate(repos[1:]):
-            ks_repo = repo_to_ks(r, "baseurl")
-            log.debug("repo composer-%s = %s", idx, ks_repo)
-            f.write('repo --name="composer-%s" %s\n' % (idx, ks_repo))
+        f.write(ks_repos)
 
         if gitrpm_repo:
             log.debug("repo gitrpms = %s", gitrpm_repo)
@@ -804,7 +1119,7 @@ def start_build(cfg, dnflock, gitlock, branch, recipe_name, compose_type, test_m
         f.write('part / --size=%d\n' % ceil(installed_size / 1024**2))
 
         # Some customizations modify the template before writing it
-        f.write(customize_ks_template(ks_template, recipe))
+        f.write(customize_ks_template(template.ks_template, recipe))
 
         for d in deps:
             f.write(dep_nevra(d)+"\n")
@@ -850,18 +1165,78 @@ def start_build(cfg, dnflock, gitlock, branch, recipe_name, compose_type, test_m
     with open(joinpaths(results_dir, "config.toml"), "w") as f:
         f.write(toml.dumps(cfg_args))
 
-    # Set the initial status
-    open(joinpaths(results_dir, "STATUS"), "w").write("WAITING")
+    # Builds using rpms from git repos are not cached, and fake composes only match other fake composes
+    cache_key = None
+    if not gitrpm_repo:
+        key_args = dict(cfg_args, test_mode=test_mode) if test_mode else cfg_args
+        cache_key = compose_cache_key(deps, ks_path, key_args)
+        with open(joinpaths(results_dir, "CACHE_KEY"), "w") as f:
+            f.write(cache_key)
+
+    if cache_key and use_cache:
+        cached_id = use_cached_build(lib_dir, results_dir, cache_key, cfg_args["image_name"])
+        if cached_id:
+            open(joinpaths(results_dir, "STATUS"), "w").write("FINISHED")
+            for ts in (TS_STARTED, TS_FINISHED):
+                write_timestamp(results_dir, ts)
+            log.info("Finished %s (%s %s) using the image from %s", build_id, recipe["name"], compose_type, cached_id)
+            return "FINISHED"
 
     # Set the test mode, if requested
     if test_mode > 0:
         open(joinpaths(results_dir, "TEST"), "w").write("%s" % test_mode)
+    else:
+        # Cache the template's packages too, Anaconda installs them along with the blueprint's
+        cache_deps = dict((dep_nevra(d), d) for d in template.template_deps + deps)
+        use_cache_repo(cfg, dnflock, list(cache_deps.values()), results_dir, ks_path, ks_repos)
 
-    write_timestamp(results_dir, TS_CREATED)
-    log.info("Adding %s (%s %s) to compose queue", build_id, recipe["name"], compose_type)
-    os.symlink(results_dir, joinpaths(lib_dir, "queue/new/", build_id))
+    open(joinpaths(results_dir, "STATUS"), "w").write("WAITING")
+    return "WAITING"
 
-    return build_id
+def use_cache_repo(cfg, dnflock, deps, results_dir, ks_path, ks_repos):
+    """ Install the packages from the rpm cache, before the remote repositories
+
+    :param cfg: Configuration
+    :type cfg: ComposerConfig
+    :param dnflock: Lock and YumBase for depsolving
+    :type dnflock: YumLock
+    :param deps: The depsolved packages to cache
+    :type deps: list of dicts
+    :param results_dir: The build's results directory
+    :type results_dir: str
+    :param ks_path: Path to the final kickstart
+    :type ks_path: str
+    :param ks_repos: The url and repo lines at the start of the kickstart
+    :type ks_repos: str
+    :returns: True if the kickstart was changed to use the rpm cache
+    :rtype: bool
+
+    This is done after the compose cache key has been calculated, so that the
+    path to the build's repository is not part of it. If the packages cannot be
+    cached the remote repositories are used.
+
+    The cache's repository is added with a lower cost than the remote ones, which
+    are kept for the packages and groups that it does not have. Anaconda resolves
+    @core and the template's groups, and these can pull in packages that are not
+    in the depsolved list.
+    """
+    try:
+        cache_repo = create_cache_repo(cfg, dnflock, deps, results_dir)
+    except (RuntimeError, OSError) as e:
+        log.error("Not using the rpm cache for %s: %s", os.path.basename(results_dir), str(e))
+        return False
+    if not cache_repo:
+        return False
+
+    with open(ks_path, "r") as f:
+        ks = f.read()
+    if not ks.startswith(ks_repos):
+        raise RuntimeError("Unexpected repositories in %s" % ks_path)
+    with open(ks_path, "w") as f:
+        f.write(ks_repos)
+        f.write('repo --name="rpmcache" --baseurl="file://%s" --cost=1\n' % cache_repo)
+        f.write(ks[len(ks_repos):])
+    return True
 
 # Supported output types
 def compose_types(share_dir):
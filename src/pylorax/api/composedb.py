@@ -0,0 +1,462 @@
+#
+# Copyright (C) 2020 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Persistent index of the compose details
+
+The results directories are still the canonical source of a build's details, this
+index is a copy of the details so that the status routes do not need to read and
+parse several files from every results directory on every request.
+
+The index is a sqlite database stored in the lib_dir, it is shared between the API
+server and the queue monitor processes. The details are stored as JSON so that new
+fields can be added without changing the schema. It can be rebuilt from the results
+directories at any time.
+"""
+import logging
+log = logging.getLogger("lorax-composer")
+
+from contextlib import contextmanager
+from glob import glob
+import hashlib
+import json
+import os
+import sqlite3
+
+from pylorax.api.events import event_log, publish_event
+from pylorax.api.recipes import recipe_from_file
+from pylorax.api.timestamp import TS_CREATED, TS_STARTED, TS_FINISHED, timestamp_dict
+import pylorax.api.toml as toml
+from pylorax.sysutils import joinpaths
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS composes (
+    id TEXT PRIMARY KEY,
+    queue_status TEXT NOT NULL,
+    created REAL,
+    detail TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS composes_status ON composes(queue_status);
+CREATE TABLE IF NOT EXISTS uploads (
+    build_id TEXT NOT NULL,
+    upload_id TEXT NOT NULL,
+    PRIMARY KEY (build_id, upload_id)
+);
+CREATE TABLE IF NOT EXISTS cache_keys (
+    build_id TEXT PRIMARY KEY,
+    cache_key TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cache_keys_key ON cache_keys(cache_key);
+"""
+
+def compose_index(lib_dir):
+    """Return the index of compose details
+
+    :param lib_dir: The composer lib_dir
+    :type lib_dir: str
+    :returns: The compose index
+    :rtype: ComposeIndex
+    """
+    return ComposeIndex(joinpaths(lib_dir, "composes.db"))
+
+def get_compose_type(results_dir):
+    """Return the type of composition.
+
+    :param results_dir: The directory containing the metadata and results for the build
+    :type results_dir: str
+    :returns: The type of compose (eg. 'tar')
+    :rtype: str
+    :raises: RuntimeError if no kickstart template can be found.
+    """
+    # Should only be 2 kickstarts, the final-kickstart.ks and the template
+    t = [os.path.basename(ks)[:-3] for ks in glob(joinpaths(results_dir, "*.ks"))
+                                   if "final-kickstart" not in ks]
+    if len(t) != 1:
+        raise RuntimeError("Cannot find ks template for build %s" % os.path.basename(results_dir))
+    return t[0]
+
+def get_image_name(uuid_dir):
+    """Return the filename and full path of the build's image file
+
+    :param uuid: The UUID of the build
+    :type uuid: str
+    :returns: The image filename and full path
+    :rtype: tuple of strings
+    :raises: RuntimeError if there was a problem (eg. invalid uuid, missing config file)
+    """
+    uuid = os.path.basename(os.path.abspath(uuid_dir))
+    if not os.path.exists(uuid_dir):
+        raise RuntimeError("%s is not a valid build_id" % uuid)
+
+    # Load the compose configuration
+    cfg_path = joinpaths(uuid_dir, "config.toml")
+    if not os.path.exists(cfg_path):
+        raise RuntimeError("Missing config.toml for %s" % uuid)
+    cfg_dict = toml.loads(open(cfg_path, "r").read())
+    image_name = cfg_dict["image_name"]
+
+    return (image_name, joinpaths(uuid_dir, image_name))
+
+def write_image_checksum(results_dir, image_path):
+    """Calculate the SHA-256 of the build's image and store it in the results directory
+
+    :param results_dir: The directory containing the metadata and results for the build
+    :type results_dir: str
+    :param image_path: Path to the image
+    :type image_path: str
+    :returns: The hex digest of the image
+    :rtype: str
+
+    The image is read once, so that the API and the uploads can use the stored
+    checksum instead of reading the whole image again.
+    """
+    h = hashlib.sha256()
+    with open(image_path, "rb") as f:
+        while True:
+            data = f.read(4 * 1024**2)
+            if not data:
+                break
+            h.update(data)
+    checksum = h.hexdigest()
+    with open(joinpaths(results_dir, "IMAGE_SHA256"), "w") as f:
+        f.write(checksum + "\n")
+    return checksum
+
+def read_image_checksum(results_dir):
+    """Return the SHA-256 of the build's image
+
+    :param results_dir: The directory containing the metadata and results for the build
+    :type results_dir: str
+    :returns: The hex digest of the image, or None if it has not been stored
+    :rtype: str or None
+    """
+    try:
+        with open(joinpaths(results_dir, "IMAGE_SHA256")) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def read_compose_detail(results_dir):
+    """Read the details about the build from its results directory
+
+    :param results_dir: The directory containing the metadata and results for the build
+    :type results_dir: str
+    :returns: A dictionary with details about the compose, without the uploads
+    :rtype: dict
+    :raises: IOError if it cannot read the directory, STATUS, or blueprint file.
+
+    See `compose_detail()` for the fields. This reads and parses several files, use
+    `compose_detail()` to read them from the index instead.
+    """
+    build_id = os.path.basename(os.path.abspath(results_dir))
+    status = open(joinpaths(results_dir, "STATUS")).read().strip()
+    blueprint = recipe_from_file(joinpaths(results_dir, "blueprint.toml"))
+
+    compose_type = get_compose_type(results_dir)
+
+    # PENDING builds do not have a config.toml yet
+    image_size = 0
+    image_sha256 = None
+    if status == "FINISHED":
+        image_path = get_image_name(results_dir)[1]
+        if os.path.exists(image_path):
+            image_size = os.stat(image_path).st_size
+            image_sha256 = read_image_checksum(results_dir)
+
+    times = timestamp_dict(results_dir)
+
+    return {"id":           build_id,
+            "queue_status": status,
+            "job_created":  times.get(TS_CREATED),
+            "job_started":  times.get(TS_STARTED),
+            "job_finished": times.get(TS_FINISHED),
+            "compose_type": compose_type,
+            "blueprint":    blueprint["name"],
+            "version":      blueprint["version"],
+            "image_size":   image_size,
+            "image_sha256": image_sha256,
+           }
+
+def index_compose(lib_dir, results_dir, replace=True, publish=True):
+    """Read the details of a build from its results directory and store them in the index
+
+    :param lib_dir: The composer lib_dir
+    :type lib_dir: str
+    :param results_dir: The directory containing the metadata and results for the build
+    :type results_dir: str
+    :param replace: Replace an existing entry in the index
+    :type replace: bool
+    :param publish: Publish a compose event if the build's state changed
+    :type publish: bool
+    :returns: The details of the build, without the uploads
+    :rtype: dict
+    :raises: IOError if it cannot read the directory, STATUS, or blueprint file.
+
+    This needs to be called whenever the files used by `read_compose_detail()` change.
+    Use replace=False when the caller is not the process changing the build's state,
+    only the process changing it publishes the event.
+    """
+    detail = read_compose_detail(results_dir)
+    index = compose_index(lib_dir)
+    previous = index.put(detail, replace)
+    if publish and replace and previous != detail["queue_status"]:
+        publish_compose_event(lib_dir, detail, previous)
+    try:
+        with open(joinpaths(results_dir, "UPLOADS")) as uploads_file:
+            index.set_uploads(detail["id"], uploads_file.read().split())
+    except FileNotFoundError:
+        pass
+    try:
+        with open(joinpaths(results_dir, "CACHE_KEY")) as key_file:
+            index.set_cache_key(detail["id"], key_file.read().strip())
+    except FileNotFoundError:
+        pass
+    return detail
+
+def publish_compose_event(lib_dir, detail, previous=None):
+    """Publish a change to a build's state
+
+    :param lib_dir: The composer lib_dir
+    :type lib_dir: str
+    :param detail: The details of the build, from `read_compose_detail()`
+    :type detail: dict
+    :param previous: The build's previous queue_status, None if it is new
+    :type previous: str or None
+
+    The event's data is the build's details and its previous_status. When a build
+    is deleted the details are just its id and a queue_status of DELETED.
+    """
+    publish_event(event_log(lib_dir).path, "compose", dict(detail, previous_status=previous))
+
+def rebuild_compose_index(lib_dir):
+    """Rebuild the index of compose details from the results directories
+
+    :param lib_dir: The composer lib_dir
+    :type lib_dir: str
+    :returns: None
+    """
+    index = compose_index(lib_dir)
+    index.clear()
+    for results_dir in glob(joinpaths(lib_dir, "results/*")):
+        try:
+            index_compose(lib_dir, results_dir, publish=False)
+        except Exception as e:
+            log.error("Cannot add build %s to the index: %s", os.path.basename(results_dir), e)
+
+def sync_compose_index(lib_dir):
+    """Add new builds to the index, and remove deleted ones
+
+    :param lib_dir: The composer lib_dir
+    :type lib_dir: str
+    :returns: The compose index
+    :rtype: ComposeIndex
+
+    Only the names of the results directories are read, builds that are already
+    in the index are not read from disk.
+    """
+    index = compose_index(lib_dir)
+    on_disk = set(os.listdir(joinpaths(lib_dir, "results")))
+    indexed = index.ids()
+    for build_id in on_disk - indexed:
+        try:
+            index_compose(lib_dir, joinpaths(lib_dir, "results", build_id), replace=False)
+        except IOError:
+            # It may still be in the process of being created by start_build()
+            pass
+    for build_id in indexed - on_disk:
+        index.delete(build_id)
+    return index
+
+class ComposeIndex(object):
+    """Store and retrieve the compose details in a sqlite database
+
+    :param path: Path to the database file
+    :type path: str
+
+    A new connection is used for each operation so that it can be used from
+    the API server's greenlets as well as from the compose processes.
+    """
+    # Paths that have had the schema created by this process
+    _initialized = set()
+
+    def __init__(self, path):
+        self.path = path
+
+    @contextmanager
+    def _connect(self):
+        """Return a connection that commits on success, and is always closed"""
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            if self.path not in self._initialized:
+                conn.executescript(SCHEMA)
+                self._initialized.add(self.path)
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def init(self, gid=None):
+        """Create the database and make sure the group can write to it
+
+        :param gid: Group ID that needs write access, or None
+        :type gid: int
+        """
+        with self._connect():
+            pass
+        if gid is not None:
+            os.chown(self.path, 0, gid)
+            os.chmod(self.path, 0o660)
+
+    def get(self, build_id):
+        """Return the details of a build
+
+        :param build_id: The UUID of the build
+        :type build_id: str
+        :returns: The details stored by put() or None
+        :rtype: dict or None
+        """
+        with self._connect() as conn:
+            row = conn.execute("SELECT detail FROM composes WHERE id=?", (build_id,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def put(self, detail, replace=True):
+        """Store the details of a build
+
+        :param detail: Details from compose_detail(), must include id and queue_status
+        :type detail: dict
+        :param replace: Replace an existing entry, otherwise only add it if it is missing
+        :type replace: bool
+        :returns: The queue_status the build had before, or None if it was not in the index
+        :rtype: str or None
+
+        The queue monitor replaces the entry when the build changes state. Details that
+        are read from disk by the API server are only added when they are missing so that
+        they do not overwrite a newer state written by the compose process.
+        """
+        verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+        with self._connect() as conn:
+            row = conn.execute("SELECT queue_status FROM composes WHERE id=?", (detail["id"],)).fetchone()
+            conn.execute(verb + " INTO composes (id, queue_status, created, detail) VALUES (?, ?, ?, ?)",
+                         (detail["id"], detail["queue_status"], detail.get("job_created"), json.dumps(detail)))
+        return row[0] if row else None
+
+    def delete(self, build_id):
+        """Remove a build and its uploads from the index
+
+        :param build_id: The UUID of the build
+        :type build_id: str
+        """
+        with self._connect() as conn:
+            conn.execute("DELETE FROM composes WHERE id=?", (build_id,))
+            conn.execute("DELETE FROM uploads WHERE build_id=?", (build_id,))
+            conn.execute("DELETE FROM cache_keys WHERE build_id=?", (build_id,))
+
+    def clear(self):
+        """Remove everything from the index"""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM composes")
+            conn.execute("DELETE FROM uploads")
+            conn.execute("DELETE FROM cache_keys")
+
+    def ids(self):
+        """Return the UUIDs of all the builds in the index
+
+        :returns: Set of build UUIDs
+        :rtype: set
+        """
+        with self._connect() as conn:
+            return set(row[0] for row in conn.execute("SELECT id FROM composes"))
+
+    def list(self, statuses=None):
+        """Return the details of the builds, oldest first
+
+        :param statuses: Only return builds with these queue_status values, or None for all
+        :type statuses: list of str
+        :returns: List of build details
+        :rtype: list of dicts
+        """
+        query = "SELECT detail FROM composes"
+        args = ()
+        if statuses:
+            query += " WHERE queue_status IN (%s)" % ",".join("?" * len(statuses))
+            args = tuple(statuses)
+        query += " ORDER BY created"
+        with self._connect() as conn:
+            return [json.loads(row[0]) for row in conn.execute(query, args)]
+
+    def set_uploads(self, build_id, upload_ids):
+        """Set the upload UUIDs associated with a build
+
+        :param build_id: The UUID of the build
+        :type build_id: str
+        :param upload_ids: The upload UUIDs
+        :type upload_ids: iterable of str
+        """
+        with self._connect() as conn:
+            conn.execute("DELETE FROM uploads WHERE build_id=?", (build_id,))
+            conn.executemany("INSERT INTO uploads (build_id, upload_id) VALUES (?, ?)",
+                             [(build_id, upload_id) for upload_id in upload_ids])
+
+    def get_uploads(self, build_id):
+        """Return the upload UUIDs associated with a build
+
+        :param build_id: The UUID of the build
+        :type build_id: str
+        :returns: The upload UUIDs
+        :rtype: frozenset
+        """
+        with self._connect() as conn:
+            rows = conn.execute("SELECT upload_id FROM uploads WHERE build_id=?", (build_id,))
+            return frozenset(row[0] for row in rows)
+
+    def upload_build(self, upload_id):
+        """Return the build UUID that an upload is associated with
+
+        :param upload_id: The UUID of the upload
+        :type upload_id: str
+        :returns: The build UUID or None
+        :rtype: str or None
+        """
+        with self._connect() as conn:
+            row = conn.execute("SELECT build_id FROM uploads WHERE upload_id=?", (upload_id,)).fetchone()
+        return row[0] if row else None
+
+    def set_cache_key(self, build_id, cache_key):
+        """Set the cache key for a build
+
+        :param build_id: The UUID of the build
+        :type build_id: str
+        :param cache_key: The key from compose_cache_key()
+        :type cache_key: str
+        """
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO cache_keys (build_id, cache_key) VALUES (?, ?)",
+                         (build_id, cache_key))
+
+    def find_cached(self, cache_key):
+        """Return the newest FINISHED build with a cache key
+
+        :param cache_key: The key from compose_cache_key()
+        :type cache_key: str
+        :returns: The build UUID or None
+        :rtype: str or None
+        """
+        with self._connect() as conn:
+            row = conn.execute("SELECT composes.id FROM cache_keys JOIN composes ON composes.id = cache_keys.build_id "
+                               "WHERE cache_keys.cache_key=? AND composes.queue_status='FINISHED' "
+                               "ORDER BY composes.created DESC LIMIT 1", (cache_key,)).fetchone()
+        return row[0] if row else None
@@ -52,6 +52,11 @@ def configure(conf_file="/etc/lorax/composer.conf", root_dir="/", test_config=Fa
     conf.set("composer", "dnf_root", os.path.realpath(joinpaths(root_dir, "/var/tmp/composer/dnf/root/")))
     conf.set("composer", "cache_dir", os.path.realpath(joinpaths(root_dir, "/var/tmp/composer/cache/")))
     conf.set("composer", "tmp", os.path.realpath(joinpaths(root_dir, "/var/tmp/")))
+    conf.set("composer", "max_concurrent_composes", "1")
+    conf.set("composer", "depsolve_cache_size", "128")
+    conf.set("composer", "dnf_query_workers", "2")
+    conf.set("composer", "rpm_cache_size", "10240")
+    conf.set("composer", "git_maintenance_interval", "24")
 
     conf.add_section("users")
     conf.set("users", "root", "1")
@@ -134,7 +139,7 @@ def make_queue_dirs(conf, gid):
     """
     errors = []
     lib_dir = conf.get("composer", "lib_dir")
-    for p in ["queue/run", "queue/new", "results"]:
+    for p in ["queue/run", "queue/new", "results", "events"]:
         p_dir = joinpaths(lib_dir, p)
         errors.extend(make_owned_dir(p_dir, 0, gid))
     return errors
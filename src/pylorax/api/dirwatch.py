@@ -0,0 +1,161 @@
+#
+# Copyright (C) 2020 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Wait for changes to a queue directory using inotify
+
+The compose queue monitor and the upload monitor use this to wake up as soon as
+a new entry is added to their directory. If inotify is not available it falls back
+to sleeping for the timeout passed to `DirWatch.wait()`.
+"""
+import logging
+log = logging.getLogger("lorax-composer")
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+# From /usr/include/sys/inotify.h
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# struct inotify_event is wd, mask, cookie, len, followed by len bytes of name
+EVENT_HEADER = struct.Struct("iIII")
+
+_libc = None
+
+def _get_libc():
+    """Return the libc library, or None if it cannot be loaded"""
+    global _libc
+    if _libc is None:
+        try:
+            _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        except OSError:
+            _libc = False
+    return _libc or None
+
+def parse_events(buf):
+    """Parse the names out of a buffer of inotify events
+
+    :param buf: Data read from the inotify file descriptor
+    :type buf: bytes
+    :returns: The names of the files that changed
+    :rtype: set of str
+    """
+    names = set()
+    offset = 0
+    while offset + EVENT_HEADER.size <= len(buf):
+        _wd, _mask, _cookie, length = EVENT_HEADER.unpack_from(buf, offset)
+        offset += EVENT_HEADER.size
+        name = buf[offset:offset+length].rstrip(b"\0")
+        offset += length
+        if name:
+            names.add(os.fsdecode(name))
+    return names
+
+class DirWatch(object):
+    """Watch a directory for new or changed files
+
+    The watch is setup when the object is created, so any changes made after that
+    will be returned by the next call to wait(), even if they happen before it is called.
+    """
+    def __init__(self, path, mask=IN_CREATE|IN_MOVED_TO|IN_CLOSE_WRITE):
+        self.path = path
+        self._fd = None
+
+        libc = _get_libc()
+        if libc is None:
+            log.warning("Cannot load libc, polling %s for changes", path)
+            return
+
+        fd = libc.inotify_init1(IN_NONBLOCK|IN_CLOEXEC)
+        if fd < 0:
+            log.warning("inotify_init1 failed (%s), polling %s for changes",
+                        os.strerror(ctypes.get_errno()), path)
+            return
+        if libc.inotify_add_watch(fd, os.fsencode(path), mask) < 0:
+            log.warning("inotify_add_watch failed (%s), polling %s for changes",
+                        os.strerror(ctypes.get_errno()), path)
+            os.close(fd)
+            return
+        self._fd = fd
+
+    @property
+    def polling(self):
+        """True if inotify is not available and wait() just sleeps"""
+        return self._fd is None
+
+    def wait(self, timeout):
+        """Wait for files in the directory to change
+
+        :param timeout: Maximum number of seconds to wait
+        :type timeout: float
+        :returns: The names of the changed files, or None if it timed out
+        :rtype: set of str or None
+
+        When polling this always sleeps for timeout seconds and returns None.
+        """
+        if self._fd is None:
+            time.sleep(timeout)
+            return None
+
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return None
+        return self.read()
+
+    def fileno(self):
+        """Return the inotify file descriptor
+
+        :returns: The file descriptor, or None when polling
+        :rtype: int or None
+
+        This can be used to wait for changes with something other than select,
+        eg. gevent.socket.wait_read in the API server, and then call read().
+        """
+        return self._fd
+
+    def read(self):
+        """Read the changes without waiting
+
+        :returns: The names of the changed files
+        :rtype: set of str
+        """
+        names = set()
+        if self._fd is None:
+            return names
+        while True:
+            try:
+                buf = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            if not buf:
+                break
+            names.update(parse_events(buf))
+        return names
+
+    def close(self):
+        """Stop watching the directory"""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
@@ -19,57 +19,423 @@
 import logging
 log = logging.getLogger("lorax-composer")
 
+from contextlib import contextmanager
 import dnf
 import dnf.logging
+import fcntl
+from gevent.lock import BoundedSemaphore
+from gevent.socket import wait_read, wait_write
 from glob import glob
 import os
+import pickle
 import shutil
-from threading import Lock
+import signal
+import socket
+import struct
+import threading
+from threading import Event, Lock, Thread
 import time
 
 from pylorax import DEFAULT_PLATFORM_ID
-from pylorax.sysutils import flatconfig
+from pylorax.api.blocking import GeventLock
+from pylorax.api.projects import DEPSOLVE_CACHE, repos_revision
+from pylorax.dnfbase import fill_loaded_sack, load_repos
+from pylorax.sysutils import flatconfig, joinpaths
 
 class DNFLock(object):
     """Hold the dnf.Base object and a Lock to control access to it.
 
     self.dbo is a property that returns the dnf.Base object, but it *may* change
     from one call to the next if the upstream repositories have changed.
+
+    All users of self.dbo, the API requests and the builds being prepared, need to
+    hold the lock while using it, so they wait for each other. The API runs under
+    gevent without monkey patching, so a request that is depsolving also blocks the
+    other requests handled by the same process. Waiting for the lock does not, the
+    requests wait for the builds being prepared in a thread, see `GeventLock`.
+
+    A background thread checks the repositories for new metadata every expire_secs,
+    see `refresh()`.
+
+    When lorax-composer runs several worker processes each one has its own DNFLock.
+    `invalidate()` updates a file in the cache directory, and the other processes
+    load the metadata again when they see that it has changed.
+
+    The read-only queries made by the API requests, see `query()`, are run by
+    forked copies of the process so that they do not wait for each other.
     """
     def __init__(self, conf, expire_secs=6*60*60):
         self._conf = conf
-        self._lock = Lock()
-        self.dbo = get_base_object(self._conf)
+        self._lock = GeventLock()
+        self._refresh_lock = Lock()
         self._expire_secs = expire_secs
         self._expire_time = time.time() + self._expire_secs
+        DEPSOLVE_CACHE.max_size = conf.getint("composer", "depsolve_cache_size")
+        DEPSOLVE_CACHE.clear()
+
+        self._sources_stamp = joinpaths(conf.get("composer", "cache_dir"), "sources-changed")
+        self._sources_mtime = self._stamp_mtime()
+        self.dbo = get_base_object(self._conf)
+        self._revision = repos_revision(self.dbo)
+
+        # Incremented when the sources change, so that refresh() does not replace them
+        self._generation = 0
+
+        # The idle query workers, and the number that may be running, see query()
+        self._max_query_workers = conf.getint("composer", "dnf_query_workers")
+        self._query_workers = []
+        self._query_slots = None
+        self._query_pid = None
+
+        self._wake = Event()
+        Thread(target=self._refresh_loop, name="dnf-refresh", daemon=True).start()
 
     @property
     def lock(self):
-        """Check for repo updates (using expiration time) and return the lock
+        """Return the lock
 
-        If the repository has been updated, tear down the old dnf.Base and
-        create a new one. This is the only way to force dnf to use the new
-        metadata.
+        If the metadata has expired this wakes up the background refresh, it does not
+        wait for it.
         """
         if time.time() > self._expire_time:
-            return self.lock_check
+            self._wake.set()
+        self._check_sources()
         return self._lock
 
     @property
     def lock_check(self):
-        """Force a check for repo updates and return the lock
+        """Check for repo updates and return the lock
 
-        Use this method sparingly, it removes the repodata and downloads a new copy every time.
+        The repositories' repomd.xml files are downloaded and compared to the ones that
+        were loaded. Only if they have changed is the rest of the metadata downloaded and
+        new dnf.Base objects created. This blocks until that is finished.
         """
-        self._expire_time = time.time() + self._expire_secs
-        self.dbo.update_cache()
+        self._check_sources()
+        self.refresh()
         return self._lock
 
-def get_base_object(conf):
+    def _stamp_mtime(self):
+        """Return the modification time of the sources stamp file, or 0"""
+        try:
+            return os.stat(self._sources_stamp).st_mtime_ns
+        except OSError:
+            return 0
+
+    def _check_sources(self):
+        """Load the metadata again if another process has changed the sources"""
+        if self._stamp_mtime() == self._sources_mtime:
+            return
+        with self._lock:
+            mtime = self._stamp_mtime()
+            if mtime == self._sources_mtime:
+                return
+            log.info("The sources have been changed by another process, loading the metadata")
+            try:
+                self.dbo = get_base_object(self._conf)
+            except RuntimeError as e:
+                # Try again next time
+                log.error("Failed to load the new sources: %s", str(e))
+                return
+            self._sources_mtime = mtime
+            self._revision = repos_revision(self.dbo)
+            self._generation += 1
+            DEPSOLVE_CACHE.clear()
+
+    def _refresh_loop(self):
+        """Call refresh() when the metadata expires, or when woken up"""
+        while True:
+            woken = self._wake.wait(max(0, self._expire_time - time.time()))
+            if woken or time.time() >= self._expire_time:
+                self.refresh()
+
+    def refresh(self):
+        """Check for new metadata and replace the dnf.Base object if it has changed
+
+        :returns: True if the dnf.Base object was replaced
+        :rtype: bool
+
+        The new object is created without holding the lock, and then self.dbo is replaced.
+        Users of the old object finish with it before it is freed.
+        """
+        with self._refresh_lock:
+            self._wake.clear()
+            self._expire_time = time.time() + self._expire_secs
+            generation = self._generation
+            try:
+                if not metadata_changed(self._conf, self._revision):
+                    log.debug("Repository metadata has not changed")
+                    return False
+
+                log.info("Repository metadata has changed, loading the new metadata")
+                dbo = get_base_object(self._conf, use_cache=True)
+            except (dnf.exceptions.Error, RuntimeError) as e:
+                log.error("Failed to refresh the repository metadata: %s", str(e))
+                return False
+
+            with self._lock:
+                if generation != self._generation:
+                    # The sources changed while it was loading, try again
+                    self._wake.set()
+                    return False
+                self.dbo = dbo
+                self._revision = repos_revision(dbo)
+                self._generation = generation + 1
+                DEPSOLVE_CACHE.clear()
+            return True
+
+    def invalidate(self):
+        """Clear the depsolve cache and tell the other processes about the changed sources
+
+        Call this, while holding the lock, after changing the sources of self.dbo.
+        """
+        self._revision = repos_revision(self.dbo)
+        self._generation += 1
+        DEPSOLVE_CACHE.clear()
+
+        # Tell the other processes about the change
+        with open(self._sources_stamp, "a"):
+            os.utime(self._sources_stamp)
+        self._sources_mtime = self._stamp_mtime()
+
+    def query(self, func, *args):
+        """Call func(dbo, *args) on a copy of the dnf.Base object, and return its result
+
+        :param func: The function to call, it must not change the dnf.Base object
+        :type func: callable
+        :param args: The other arguments to pass to func, they must be picklable
+        :returns: The result of func, it must be picklable
+        :raises: The exception raised by func
+
+        When called by the API, from the main thread, func is run by a worker process
+        forked while holding the lock, so it has a copy of the current dnf.Base object
+        that is not shared with anything else. Up to dnf_query_workers of them run
+        at the same time, the others wait for a free worker without blocking the other
+        requests. A worker is reused until the dnf.Base object is replaced or its
+        sources are changed.
+
+        The depsolve results cached by a worker are added to DEPSOLVE_CACHE.
+
+        Threads, or dnf_query_workers = 0, call func with the lock held.
+        """
+        if self._max_query_workers < 1 or threading.current_thread() is not threading.main_thread():
+            with self.lock:
+                return func(self.dbo, *args)
+
+        # Forked API processes do not share the workers
+        if self._query_pid != os.getpid():
+            self._query_workers = []
+            self._query_slots = BoundedSemaphore(self._max_query_workers)
+            self._query_pid = os.getpid()
+
+        with self._query_slots:
+            # If the worker has died, eg. it was killed for using too much memory, try a new one
+            for attempt in range(2):
+                worker = self._get_query_worker()
+                try:
+                    ok, result = worker.call(func, args)
+                except (EOFError, OSError, pickle.UnpicklingError) as e:
+                    log.error("DNF query worker %d failed: %s", worker.pid, str(e))
+                    worker.close()
+                    if attempt:
+                        raise
+                    continue
+                except BaseException:
+                    # The reply may be half read, or the greenlet was killed
+                    worker.close()
+                    raise
+                break
+
+            if worker.generation == self._generation:
+                self._query_workers.append(worker)
+            else:
+                worker.close()
+
+        if not ok:
+            raise result
+        return result
+
+    def _get_query_worker(self):
+        """Return an idle query worker with the current dnf.Base object, or fork a new one"""
+        # Check for changed sources, and expired metadata, like the other users of the lock
+        lock = self.lock
+        while self._query_workers:
+            worker = self._query_workers.pop()
+            if worker.generation == self._generation:
+                return worker
+            worker.close()
+        with lock:
+            return QueryWorker(self.dbo, self._generation)
+
+class QueryWorker(object):
+    """A forked process that runs queries on its copy of a dnf.Base object
+
+    The requests and replies are pickled and sent over a socket, the parent waits
+    for them without blocking the other greenlets. Create it while holding the
+    lock on the dnf.Base object, so that the copy is not in the middle of a change.
+    This also means that the other locks used while depsolving, eg. DEPSOLVE_CACHE's,
+    are not held by other threads.
+    """
+    def __init__(self, dbo, generation):
+        self.generation = generation
+        parent_sock, child_sock = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                parent_sock.close()
+                _run_query_worker(child_sock, dbo)
+                status = 0
+            except BaseException:
+                log.exception("DNF query worker %d failed", os.getpid())
+            finally:
+                os._exit(status)
+
+        child_sock.close()
+        parent_sock.setblocking(False)
+        self.pid = pid
+        self._sock = parent_sock
+        log.debug("Started DNF query worker %d", pid)
+
+    def call(self, func, args):
+        """Run func(dbo, *args) in the worker
+
+        :param func: The function to call
+        :type func: callable
+        :param args: The other arguments
+        :type args: tuple
+        :returns: (True, result) or (False, exception raised by func)
+        :rtype: tuple
+        :raises: EOFError or OSError if the worker has exited
+        """
+        _send_message(self._sock, (func, args))
+        ok, result, cached, hits, misses = _recv_message(self._sock)
+        DEPSOLVE_CACHE.merge(cached, hits, misses)
+        return (ok, result)
+
+    def close(self):
+        """Stop the worker"""
+        self._sock.close()
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+            os.waitpid(self.pid, 0)
+        except (ProcessLookupError, ChildProcessError):
+            pass
+
+def _run_query_worker(sock, dbo):
+    """Run the queries sent by the parent process until it closes the socket"""
+    # The parent handles the signals, and kills the worker when it is done with it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    DEPSOLVE_CACHE.journal = []
+    while True:
+        try:
+            func, args = _recv_message(sock)
+        except EOFError:
+            return
+
+        del DEPSOLVE_CACHE.journal[:]
+        hits, misses = DEPSOLVE_CACHE.hits, DEPSOLVE_CACHE.misses
+        try:
+            ok, result = True, func(dbo, *args)
+        except Exception as e:
+            ok, result = False, e
+        reply = (ok, result, DEPSOLVE_CACHE.journal, DEPSOLVE_CACHE.hits - hits, DEPSOLVE_CACHE.misses - misses)
+        try:
+            data = pickle.dumps(reply, pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            # Not all of the dnf exceptions can be pickled
+            error = RuntimeError(str(result) if not ok else "Cannot return the result: %s" % str(e))
+            data = pickle.dumps((False, error, [], 0, 0), pickle.HIGHEST_PROTOCOL)
+        _send_all(sock, _MESSAGE_HEADER.pack(len(data)) + data)
+
+# The length of each pickled message
+_MESSAGE_HEADER = struct.Struct("!Q")
+
+def _send_message(sock, obj):
+    """Pickle obj and send it"""
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    _send_all(sock, _MESSAGE_HEADER.pack(len(data)) + data)
+
+def _recv_message(sock):
+    """Receive a pickled object and return it"""
+    size, = _MESSAGE_HEADER.unpack(_recv_exactly(sock, _MESSAGE_HEADER.size))
+    return pickle.loads(_recv_exactly(sock, size))
+
+def _send_all(sock, data):
+    """Send all of the data, waiting without blocking gevent if the socket is non-blocking"""
+    data = memoryview(data)
+    while data:
+        try:
+            data = data[sock.send(data):]
+        except BlockingIOError:
+            wait_write(sock.fileno())
+
+def _recv_exactly(sock, size):
+    """Receive size bytes, waiting without blocking gevent if the socket is non-blocking"""
+    data = bytearray()
+    while len(data) < size:
+        try:
+            chunk = sock.recv(min(size - len(data), 1024**2))
+        except BlockingIOError:
+            wait_read(sock.fileno())
+            continue
+        if not chunk:
+            raise EOFError("The connection was closed")
+        data += chunk
+    return bytes(data)
+
+def metadata_changed(conf, revision):
+    """Check the repositories for new metadata
+
+    :param conf: configuration object
+    :type conf: ComposerParser
+    :param revision: The revision of the loaded repositories, from `repos_revision()`
+    :type revision: tuple
+    :returns: True if the metadata is different from revision
+    :rtype: bool
+    :raises: dnf.exceptions.Error if there was a problem downloading the metadata
+
+    This only downloads the repomd.xml (or metalink) of each repository, unless it
+    has changed. The sack is not loaded.
+    """
+    dbo = get_base_object(conf, fill_sack=False)
+    with metadata_lock(conf):
+        errors = load_repos(dbo.repos.iter_enabled())
+    if errors:
+        raise list(errors.values())[0]
+    return repos_revision(dbo) != revision
+
+@contextmanager
+def metadata_lock(conf, exclusive=True):
+    """Hold a lock on the metadata cache
+
+    :param conf: configuration object
+    :type conf: ComposerParser
+    :param exclusive: Take the lock needed to download metadata, instead of the one needed to read it
+    :type exclusive: bool
+
+    This keeps several lorax-composer processes from downloading the same metadata
+    into the cache directory at the same time.
+    """
+    cachedir = os.path.abspath(conf.get("composer", "cache_dir"))
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
+    with open(joinpaths(cachedir, "metadata.lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def get_base_object(conf, fill_sack=True, use_cache=False):
     """Get the DNF object with settings from the config file
 
     :param conf: configuration object
     :type conf: ComposerParser
+    :param fill_sack: Load the metadata
+    :type fill_sack: bool
+    :param use_cache: Use the metadata in the cache, without checking for new metadata
+    :type use_cache: bool
     :returns: A DNF Base object
     :rtype: dnf.Base
     """
@@ -126,8 +492,11 @@ def get_base_object(conf):
     log.info("Using %s for module_platform_id", platform_id)
     dbc.module_platform_id = platform_id
 
-    # Make sure metadata is always current
-    dbc.metadata_expire = 0
+    # Make sure metadata is always current, unless the caller already knows the cache is current
+    if use_cache:
+        dbc.metadata_expire = -1
+    else:
+        dbc.metadata_expire = 0
     dbc.metadata_expire_filter = "never"
 
     # write the dnf configuration file
@@ -173,14 +542,21 @@ def get_base_object(conf):
         if remove:
             del dbo.repos[source_name]
 
+    if not fill_sack:
+        return dbo
+
     # Update the metadata from the enabled repos to speed up later operations
     log.info("Updating repository metadata")
     try:
-        dbo.fill_sack(load_system_repo=False)
-        dbo.read_comps()
-        dbo.update_cache()
+        # Reading the cache only needs to keep other processes from updating it
+        with metadata_lock(conf, exclusive=not use_cache):
+            fill_loaded_sack(dbo, load_repos(dbo.repos.iter_enabled()))
+            dbo.read_comps()
     except dnf.exceptions.Error as e:
         log.error("Failed to update metadata: %s", str(e))
         raise RuntimeError("Fetching metadata failed: %s" % str(e))
 
+    # Record the revision of the metadata that was loaded
+    repos_revision(dbo)
+
     return dbo
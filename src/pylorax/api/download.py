@@ -0,0 +1,301 @@
+#
+# Copyright (C) 2020 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Serve large files, and archives of files
+
+`send_file_range()` returns a response for a file that handles HEAD, the ETag
+conditions, and a single byte range from the Range header. The body of the
+response is a `FileRange` which the `SendfileHandler` used by lorax-composer's
+WSGIServer sends with os.sendfile, so the data is not copied through Python.
+Other WSGI servers, like the test client, iterate over it instead.
+
+`send_tar()` returns a response with a tar archive of several files, made as
+it is sent. A compressed archive is made in gevent's thread pool, see
+`threadpool_stream()`.
+
+`wait_for_change()` waits for a DirWatch without blocking the other requests,
+for the responses that are sent as the files change.
+"""
+import logging
+log = logging.getLogger("lorax-composer")
+
+from email.utils import formatdate, parsedate_to_datetime
+from flask import Response
+from gevent.pywsgi import WSGIHandler
+import gevent
+from gevent import socket
+import mimetypes
+import os
+
+from pylorax.api.utils import TAR_COMPRESSION, compress_stream, tar_file_size, tar_file_stream
+
+class FileRange(object):
+    """Part of an open file, iterating over it returns the data
+
+    :param f: The file, opened in binary mode
+    :type f: file object
+    :param start: Offset of the first byte
+    :type start: int
+    :param length: Number of bytes
+    :type length: int
+    """
+    block_size = 1024**2
+
+    def __init__(self, f, start, length):
+        self.file = f
+        self.start = start
+        self.length = length
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def __iter__(self):
+        self.file.seek(self.start)
+        remaining = self.length
+        while remaining > 0:
+            data = self.file.read(min(self.block_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+    def close(self):
+        self.file.close()
+
+def parse_range(header, size):
+    """Parse the value of a Range header
+
+    :param header: The Range header
+    :type header: str
+    :param size: Size of the file
+    :type size: int
+    :returns: The first and last byte of the range, or None to return the whole file
+    :rtype: tuple of ints or None
+    :raises: ValueError if the range is not satisfiable
+
+    Only a single range is supported, a header with more than one, or that cannot
+    be parsed, returns None and the whole file is sent.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[6:].strip().partition("-")
+    try:
+        if not first:
+            # The last N bytes
+            length = int(last)
+            if length <= 0:
+                raise ValueError("Empty suffix range")
+            return (max(0, size - length), size - 1)
+        first = int(first)
+        last = int(last) if last else size - 1
+    except ValueError:
+        if not first:
+            raise
+        return None
+    if first >= size:
+        raise ValueError("Range starts after the end of the file")
+    if first > last:
+        return None
+    return (first, min(last, size - 1))
+
+def file_etag(path, checksum=None):
+    """Return the strong ETag for a file
+
+    :param path: Path to the file
+    :type path: str
+    :param checksum: The checksum of the file, if it is known
+    :type checksum: str
+    :returns: The quoted ETag
+    :rtype: str
+
+    Without a checksum it is made from the inode, size, and modification time. The
+    results of a compose are not changed after it has finished, so it is still
+    a strong validator.
+    """
+    if not checksum:
+        st = os.stat(path)
+        checksum = "%x-%x-%x" % (st.st_ino, st.st_size, st.st_mtime_ns)
+    return '"%s"' % checksum
+
+def _etag_matches(header, etag):
+    """Return True if the If-None-Match or If-Range header matches the ETag"""
+    return header.strip() == "*" or etag in [t.strip() for t in header.split(",")]
+
+def send_file_range(request, path, filename, etag=None):
+    """Return a response with the file, or the part of it requested by the Range header
+
+    :param request: The flask request
+    :type request: flask.Request
+    :param path: Path to the file
+    :type path: str
+    :param filename: The filename to use for the download
+    :type filename: str
+    :param etag: The ETag, eg. from file_etag()
+    :type etag: str
+    :returns: The response
+    :rtype: flask.Response
+
+    If-None-Match returns 304 Not Modified if the ETag matches. The Range header is
+    only used if there is no If-Range header, or if it matches the ETag or the
+    modification time, otherwise the whole file is returned.
+    """
+    if etag is None:
+        etag = file_etag(path)
+    # HEAD has no body, so there is nothing to close the file
+    if request.method == "HEAD":
+        f = None
+        st = os.stat(path)
+    else:
+        f = open(path, "rb")
+        st = os.fstat(f.fileno())
+    size = st.st_size
+    headers = [("Accept-Ranges", "bytes"),
+               ("ETag", etag),
+               ("Last-Modified", formatdate(st.st_mtime, usegmt=True)),
+               ("Content-Disposition", "attachment; filename=%s" % filename)]
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+    if _etag_matches(request.headers.get("If-None-Match", ""), etag):
+        if f:
+            f.close()
+        return Response(status=304, headers=headers)
+
+    byte_range = None
+    if_range = request.headers.get("If-Range")
+    if request.method in ("GET", "HEAD") and (not if_range or _if_range_matches(if_range, etag, st.st_mtime)):
+        try:
+            byte_range = parse_range(request.headers.get("Range"), size)
+        except ValueError:
+            if f:
+                f.close()
+            return Response(status=416, headers=headers + [("Content-Range", "bytes */%d" % size)])
+
+    if byte_range is None:
+        start, length, status = 0, size, 200
+    else:
+        start, length, status = byte_range[0], byte_range[1] - byte_range[0] + 1, 206
+        headers.append(("Content-Range", "bytes %d-%d/%d" % (byte_range[0], byte_range[1], size)))
+    headers.append(("Content-Length", str(length)))
+
+    if f is None:
+        return Response(status=status, headers=headers, mimetype=mimetype)
+    return Response(FileRange(f, start, length), status=status, headers=headers,
+                    mimetype=mimetype, direct_passthrough=True)
+
+def _if_range_matches(if_range, etag, mtime):
+    """Return True if the If-Range header is the ETag, or the modification time"""
+    if if_range.startswith('"'):
+        return if_range == etag
+    try:
+        return int(parsedate_to_datetime(if_range).timestamp()) == int(mtime)
+    except (TypeError, ValueError):
+        return False
+
+def send_tar(request, members, basename):
+    """Return a response with a tar of files on disk, compressed if ?compression= is set
+
+    :param request: The flask request
+    :type request: flask.Request
+    :param members: The members from `pylorax.api.utils.tar_file_members()`
+    :type members: list of (bytes, str, int) tuples
+    :param basename: The filename to use for the download, without the extension
+    :type basename: str
+    :returns: The response
+    :rtype: flask.Response
+    :raises: ValueError if the compression is not supported
+
+    The uncompressed archive's Content-Length is known before it is made, the
+    compressed archive is sent without one.
+    """
+    compression = request.args.get("compression")
+    if compression:
+        data = threadpool_stream(compress_stream(tar_file_stream(members), compression))
+        extension, mimetype = TAR_COMPRESSION[compression]
+        headers = []
+    else:
+        data = tar_file_stream(members)
+        extension, mimetype = ".tar", "application/x-tar"
+        headers = [("Content-Length", str(tar_file_size(members)))]
+    headers.append(("Content-Disposition", "attachment; filename=%s%s;" % (basename, extension)))
+    return Response(data, mimetype=mimetype, headers=headers, direct_passthrough=True)
+
+def threadpool_stream(chunks):
+    """Return the chunks of a stream, each one made in gevent's thread pool
+
+    :param chunks: The stream
+    :type chunks: iterable of bytes
+    :returns: The same chunks
+    :rtype: generator of bytes
+
+    Compressing a MiB takes tens of milliseconds, which would hold up all of the
+    other requests if it ran on the gevent loop. zlib and zstandard release the
+    GIL while they work, so the other requests are handled in the meantime.
+    """
+    chunks = iter(chunks)
+    threadpool = gevent.get_hub().threadpool
+    while True:
+        chunk = threadpool.apply(next, (chunks, None))
+        if chunk is None:
+            return
+        yield chunk
+
+def wait_for_change(watch, timeout):
+    """Wait for a change to the watched files, without blocking the other requests
+
+    :param watch: The watch
+    :type watch: DirWatch
+    :param timeout: Maximum number of seconds to wait
+    :type timeout: float
+    :returns: False if it timed out
+    :rtype: bool
+
+    Without inotify it sleeps for a second, the caller has to check for changes.
+    """
+    if watch.polling:
+        gevent.sleep(min(timeout, 1))
+        return True
+    try:
+        socket.wait_read(watch.fileno(), timeout)
+    except socket.timeout:
+        return False
+    watch.read()
+    return True
+
+class SendfileHandler(WSGIHandler):
+    """A WSGIHandler that sends FileRange responses with os.sendfile"""
+    def process_result(self):
+        if not isinstance(self.result, FileRange) or self.response_use_chunked:
+            return super(SendfileHandler, self).process_result()
+
+        # Send the headers
+        self.write(b"")
+
+        sock_fd = self.socket.fileno()
+        offset = self.result.start
+        remaining = self.result.length
+        while remaining > 0:
+            try:
+                sent = os.sendfile(sock_fd, self.result.fileno(), offset, remaining)
+            except BlockingIOError:
+                socket.wait_write(sock_fd)
+                continue
+            if sent == 0:
+                # The file is shorter than when the response was started
+                log.error("%s ended before the response was complete", self.result.file.name)
+                break
+            offset += sent
+            remaining -= sent
+            self.response_length += sent
@@ -0,0 +1,196 @@
+#
+# Copyright (C) 2020 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Log of the compose and upload state changes
+
+The builds change state in the queue monitor and compose processes, and the
+uploads change state in the upload monitor, so the events are stored in a sqlite
+database that all of them can write to. Each event has an increasing id, which the
+clients of the /events route use to ask for the events they have not seen yet.
+
+After an event is added the LAST file in the events directory is rewritten, the
+API server watches it with inotify to wake up the waiting clients.
+Only the most recent MAX_EVENTS events are kept.
+"""
+import logging
+log = logging.getLogger("lorax-composer")
+
+from contextlib import contextmanager
+import json
+import os
+import sqlite3
+import time
+
+from pylorax.api.dirwatch import DirWatch, IN_CLOSE_WRITE
+from pylorax.sysutils import joinpaths
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    time REAL NOT NULL,
+    type TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+"""
+
+# The number of events to keep, older events are removed when new ones are added
+MAX_EVENTS = 1000
+
+def event_log(lib_dir):
+    """Return the log of compose and upload events
+
+    :param lib_dir: The composer lib_dir
+    :type lib_dir: str
+    :returns: The event log
+    :rtype: EventLog
+    """
+    return EventLog(joinpaths(lib_dir, "events"))
+
+def publish_event(events_dir, event_type, data):
+    """Add an event to the log, logging any errors
+
+    :param events_dir: Directory with the event database, or None to do nothing
+    :type events_dir: str
+    :param event_type: The type of event, eg. compose or upload
+    :type event_type: str
+    :param data: The details of the event
+    :type data: dict
+    :returns: None
+
+    A failure to publish an event must not fail the compose or upload that
+    changed state, so it is only logged.
+    """
+    if not events_dir:
+        return
+    try:
+        EventLog(events_dir).publish(event_type, data)
+    except Exception as e:
+        log.error("Failed to publish %s event: %s", event_type, str(e))
+
+class EventLog(object):
+    """Store and retrieve events in a sqlite database
+
+    :param path: Path to the directory with the database
+    :type path: str
+
+    A new connection is used for each operation so that it can be used from
+    the API server, the queue monitor, and the upload monitor processes.
+    """
+    # Paths that have had the schema created by this process
+    _initialized = set()
+
+    def __init__(self, path):
+        self.path = path
+        self.db_path = joinpaths(path, "events.db")
+        self.last_path = joinpaths(path, "LAST")
+
+    @contextmanager
+    def _connect(self):
+        """Return a connection that commits on success, and is always closed"""
+        if self.path not in self._initialized:
+            os.makedirs(self.path, exist_ok=True)
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            if self.path not in self._initialized:
+                conn.executescript(SCHEMA)
+                self._initialized.add(self.path)
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def init(self, gid=None):
+        """Create the database and make sure the group can write to it
+
+        :param gid: Group ID that needs write access, or None
+        :type gid: int
+        """
+        with self._connect():
+            pass
+        if not os.path.exists(self.last_path):
+            open(self.last_path, "w").write("0\n")
+        if gid is not None:
+            for path in [self.db_path, self.last_path]:
+                os.chown(path, 0, gid)
+                os.chmod(path, 0o660)
+
+    def publish(self, event_type, data):
+        """Add an event and wake up the clients
+
+        :param event_type: The type of event, eg. compose or upload
+        :type event_type: str
+        :param data: The details of the event
+        :type data: dict
+        :returns: The id of the event
+        :rtype: int
+        """
+        with self._connect() as conn:
+            event_id = conn.execute("INSERT INTO events (time, type, data) VALUES (?, ?, ?)",
+                                    (time.time(), event_type, json.dumps(data))).lastrowid
+            conn.execute("DELETE FROM events WHERE id <= ?", (event_id - MAX_EVENTS,))
+        with open(self.last_path, "w") as f:
+            f.write("%d\n" % event_id)
+        return event_id
+
+    def last_id(self):
+        """Return the id of the most recent event
+
+        :returns: The id, or 0 if there have not been any events
+        :rtype: int
+        """
+        with self._connect() as conn:
+            return conn.execute("SELECT MAX(id) FROM events").fetchone()[0] or 0
+
+    def since(self, last_id, limit=100):
+        """Return the events after an event, oldest first
+
+        :param last_id: The id of the last event the client has seen
+        :type last_id: int
+        :param limit: Maximum number of events to return
+        :type limit: int
+        :returns: The id, time, type, and data of the events
+        :rtype: list of dicts
+        """
+        with self._connect() as conn:
+            rows = conn.execute("SELECT id, time, type, data FROM events WHERE id > ? ORDER BY id LIMIT ?",
+                                (last_id, limit)).fetchall()
+        return [{"id": row[0], "time": row[1], "type": row[2], "data": json.loads(row[3])} for row in rows]
+
+    def missed(self, last_id):
+        """Return True if events after last_id have already been removed
+
+        :param last_id: The id of the last event the client has seen
+        :type last_id: int
+        :returns: True if the client needs to read the current state again
+        :rtype: bool
+        """
+        with self._connect() as conn:
+            first_id = conn.execute("SELECT MIN(id) FROM events").fetchone()[0]
+        return first_id is not None and first_id > last_id + 1
+
+    def watch(self):
+        """Return a DirWatch that wakes up when an event is published
+
+        :returns: The watch on the LAST file
+        :rtype: DirWatch
+
+        Only the LAST file is watched, sqlite closes the database after every
+        query which would wake up a watch on the whole directory.
+        """
+        if not os.path.exists(self.last_path):
+            os.makedirs(self.path, exist_ok=True)
+            open(self.last_path, "a").close()
+        return DirWatch(self.last_path, mask=IN_CLOSE_WRITE)
@@ -0,0 +1,160 @@
+#
+# Copyright (C) 2020 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Maintenance of the blueprint git repository
+
+Every blueprint change is a new commit, and every tag is a new annotated tag, and
+libgit2 writes them all as loose objects and loose refs. Over time this makes
+walking the history and matching the tags slower. This uses git to pack the refs
+and objects, remove unreachable objects, and write a commit-graph, which libgit2
+uses to speed up walking the history.
+
+The history itself is not changed, the commit ids are used by the tags, the
+commit index, and the compose results.
+
+Only packing the refs needs the git lock. It rewrites packed-refs and deletes the
+loose refs that libgit2 writes, the other commands only add packs or remove
+unreachable objects that are older than any write in progress, which git allows
+while the repository is being used.
+"""
+import logging
+log = logging.getLogger("lorax-composer")
+
+import os
+import subprocess
+import threading
+import time
+
+# The git commands to run, in order, and whether they need the git lock
+MAINTENANCE_CMDS = [
+    (["pack-refs", "--all", "--prune"], True),
+    (["repack", "-a", "-d", "-q"], False),
+    (["prune", "--expire", "2.weeks.ago"], False),
+    (["commit-graph", "write", "--reachable"], False),
+]
+
+def git_dir_path(repo):
+    """Return the path to a repository's git directory
+
+    :param repo: Open repository
+    :type repo: Git.Repository
+    :returns: Path to the git directory
+    :rtype: str
+    """
+    return repo.get_location().get_path()
+
+def count_objects(git_dir):
+    """Return the object and ref counts of a repository
+
+    :param git_dir: Path to the git directory
+    :type git_dir: str
+    :returns: The number and size, in bytes, of the loose and packed objects, and the number of loose refs
+    :rtype: dict
+    """
+    cmd = ["git", "--git-dir", git_dir, "count-objects", "-v"]
+    counts = {}
+    for line in subprocess.check_output(cmd, universal_newlines=True).splitlines():
+        key, _, value = line.partition(":")
+        counts[key.strip()] = int(value.strip())
+
+    loose_refs = 0
+    for _, _, files in os.walk(os.path.join(git_dir, "refs")):
+        loose_refs += len(files)
+
+    return {"loose_objects": counts.get("count", 0),
+            "loose_size": counts.get("size", 0) * 1024,
+            "packed_objects": counts.get("in-pack", 0),
+            "packs": counts.get("packs", 0),
+            "packed_size": counts.get("size-pack", 0) * 1024,
+            "loose_refs": loose_refs}
+
+def run_git(git_dir, args):
+    """Run a git command on a repository
+
+    :param git_dir: Path to the git directory
+    :type git_dir: str
+    :param args: The git command and its arguments
+    :type args: list of str
+    :returns: None
+    :raises: RuntimeError if the command fails
+    """
+    cmd = ["git", "--git-dir", git_dir] + args
+    log.debug(cmd)
+    try:
+        subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError as e:
+        log.error("%s failed: %s", " ".join(cmd), e.output)
+        raise RuntimeError("Failed to run git %s" % args[0])
+
+def maintain_repo(git_dir, lock=None):
+    """Pack and clean up a repository
+
+    :param git_dir: Path to the git directory
+    :type git_dir: str
+    :param lock: The exclusive git lock, held while the refs are packed
+    :type lock: RWLock
+    :returns: The counts from before and after
+    :rtype: tuple of dicts
+    :raises: RuntimeError if one of the git commands fails
+
+    Only the refs are packed while holding the lock, the other commands run while
+    the repository is being used.
+    """
+    start = time.time()
+    before = count_objects(git_dir)
+    for args, locked in MAINTENANCE_CMDS:
+        if locked and lock is not None:
+            with lock:
+                run_git(git_dir, args)
+        else:
+            run_git(git_dir, args)
+    after = count_objects(git_dir)
+
+    log.info("Blueprint repository maintenance took %0.2fs", time.time() - start)
+    log.info("Objects: %d loose (%d bytes) and %d packed (%d bytes) were %d loose (%d bytes) and %d packed (%d bytes)",
+             after["loose_objects"], after["loose_size"], after["packed_objects"], after["packed_size"],
+             before["loose_objects"], before["loose_size"], before["packed_objects"], before["packed_size"])
+    log.info("Loose refs: %d were %d", after["loose_refs"], before["loose_refs"])
+    return (before, after)
+
+def start_repo_maintenance(gitlock, interval):
+    """Start a thread that maintains the blueprint repository
+
+    :param gitlock: The blueprint repository and its lock
+    :type gitlock: GitLock
+    :param interval: Hours between runs, 0 disables it
+    :type interval: float
+    :returns: The thread, or None if it is disabled
+    :rtype: threading.Thread or None
+
+    The first run is right away, so that a repository that has not been packed
+    in a long time is fixed when the server starts.
+    """
+    if interval <= 0:
+        return None
+
+    def maintenance_loop():
+        git_dir = git_dir_path(gitlock.repo)
+        while True:
+            try:
+                maintain_repo(git_dir, gitlock.lock)
+            except Exception as e:
+                log.error("Blueprint repository maintenance failed: %s", str(e))
+            time.sleep(interval * 3600)
+
+    thread = threading.Thread(target=maintenance_loop, name="repo-maintenance", daemon=True)
+    thread.start()
+    return thread
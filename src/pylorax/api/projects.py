@@ -17,13 +17,21 @@
 import logging
 log = logging.getLogger("lorax-composer")
 
+from bisect import bisect_left
+from collections import OrderedDict
 from configparser import ConfigParser
 import dnf
+import fcntl
+import fnmatch
 from glob import glob
+import hashlib
+import json
 import os
+import rpm
+from threading import Lock
 import time
+from weakref import WeakKeyDictionary
 
-from pylorax.api.bisect import insort_left
 from pylorax.sysutils import joinpaths
 
 TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
@@ -169,6 +177,130 @@ def dep_nevra(dep):
     return dep["name"]+"-"+dep_evra(dep)
 
 
+class ProjectIndex(object):
+    """An index of the available projects, sorted by name
+
+    It is built once from the sack and then used to answer the list, info, and
+    search requests without walking all of the packages again. The name is the
+    lowercase project name, builds that only differ by the case of their name are
+    grouped under the same project.
+    """
+    def __init__(self, pkgs):
+        self._projects = {}
+        self._names = {}
+        for p in pkgs:
+            key = p.name.lower()
+            self._names.setdefault(p.name, key)
+            if key not in self._projects:
+                self._projects[key] = pkg_to_project_info(p)
+            else:
+                build = pkg_to_build(p)
+                if build not in self._projects[key]["builds"]:
+                    self._projects[key]["builds"].append(build)
+        self._keys = sorted(self._projects)
+        self._searches = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _project(self, key):
+        """Return a copy of a project's info that the caller can modify"""
+        project = dict(self._projects[key])
+        project["builds"] = list(project["builds"])
+        return project
+
+    def search(self, search=None):
+        """Return the names of the projects that match search
+
+        :param search: Case insensitive string to search for, or None for all projects
+        :type search: str
+        :returns: The matching names, the ones starting with search first
+        :rtype: list of str
+
+        The results of the last few searches are kept so that paging through them
+        does not repeat the search.
+        """
+        if not search:
+            return self._keys
+        search = search.lower()
+        with self._lock:
+            if search in self._searches:
+                self._searches.move_to_end(search)
+                return self._searches[search]
+
+        # The names that start with search are next to each other in the sorted list
+        start = bisect_left(self._keys, search)
+        end = start
+        while end < len(self._keys) and self._keys[end].startswith(search):
+            end += 1
+        results = self._keys[start:end]
+        results += [k for k in self._keys[:start] + self._keys[end:] if search in k]
+
+        with self._lock:
+            self._searches[search] = results
+            while len(self._searches) > 16:
+                self._searches.popitem(last=False)
+        return results
+
+    def page(self, offset, limit, search=None):
+        """Return a page of the projects
+
+        :param offset: Number of projects to skip
+        :type offset: int
+        :param limit: Maximum number of projects to return
+        :type limit: int
+        :param search: Case insensitive string to search for, or None for all projects
+        :type search: str
+        :returns: The projects, and the total number of matching projects
+        :rtype: tuple of a list of dicts and an int
+        """
+        keys = self.search(search)
+        return ([self._project(k) for k in keys[offset:][:limit]], len(keys))
+
+    def info(self, project_names=None):
+        """Return the projects matching the names
+
+        :param project_names: Names or globs of projects, or None for all projects
+        :type project_names: list of str
+        :returns: The projects, sorted by name
+        :rtype: list of dicts
+        """
+        if not project_names:
+            return [self._project(k) for k in self._keys]
+
+        keys = set()
+        for name in project_names:
+            if any(c in name for c in "*?["):
+                keys.update(self._names[n] for n in fnmatch.filter(self._names, name))
+            elif name in self._names:
+                keys.add(self._names[name])
+        return [self._project(k) for k in sorted(keys)]
+
+# The project index of the most recently used repositories, by their revision
+_project_indexes = OrderedDict()
+_project_indexes_lock = Lock()
+
+def project_index(dbo):
+    """Return the ProjectIndex for the dnf.Base's metadata
+
+    :param dbo: dnf base object
+    :type dbo: dnf.Base
+    :returns: The index of the available projects
+    :rtype: ProjectIndex
+
+    The index is built the first time it is needed for each revision of the
+    repositories, and shared by all of the dnf.Base objects that have loaded it.
+    """
+    key = repos_revision(dbo)
+    with _project_indexes_lock:
+        if key not in _project_indexes:
+            _project_indexes[key] = ProjectIndex(dbo.sack.query().available())
+            while len(_project_indexes) > 2:
+                _project_indexes.popitem(last=False)
+        _project_indexes.move_to_end(key)
+        return _project_indexes[key]
+
 def projects_list(dbo):
     """Return a list of projects
 
@@ -180,6 +312,23 @@ def projects_list(dbo):
     return projects_info(dbo, None)
 
 
+def projects_page(dbo, offset, limit, search=None):
+    """Return a page of the list of projects
+
+    :param dbo: dnf base object
+    :type dbo: dnf.Base
+    :param offset: Number of projects to skip
+    :type offset: int
+    :param limit: Maximum number of projects to return
+    :type limit: int
+    :param search: Only return projects with this in their name, case insensitive
+    :type search: str
+    :returns: List of project info dicts, and the total number of matching projects
+    :rtype: tuple of a list of dicts and an int
+    """
+    return project_index(dbo).page(offset, limit, search)
+
+
 def projects_info(dbo, project_names):
     """Return details about specific projects
 
@@ -192,28 +341,166 @@ def projects_info(dbo, project_names):
 
     If project_names is None it will return the full list of available packages
     """
-    if project_names:
-        pkgs = dbo.sack.query().available().filter(name__glob=project_names)
-    else:
-        pkgs = dbo.sack.query().available()
-
-    # iterate over pkgs
-    # - if pkg.name isn't in the results yet, add pkg_to_project_info in sorted position
-    # - if pkg.name is already in results, get its builds. If the build for pkg is different
-    #   in any way (version, arch, etc.) add it to the entry's builds list. If it is the same,
-    #   skip it.
-    results = []
-    results_names = {}
-    for p in pkgs:
-        if p.name.lower() not in results_names:
-            idx = insort_left(results, pkg_to_project_info(p), key=lambda p: p["name"].lower())
-            results_names[p.name.lower()] = idx
-        else:
-            build = pkg_to_build(p)
-            if build not in results[results_names[p.name.lower()]]["builds"]:
-                results[results_names[p.name.lower()]]["builds"].append(build)
-
-    return results
+    return project_index(dbo).info(project_names)
+
+
+class DepsolveCache(object):
+    """A LRU cache of depsolve results
+
+    The results are stored under a key made from the depsolve request and the
+    revision of the enabled repositories, see `depsolve_cache_key()`. Repository
+    changes are detected by the key, but `clear()` should still be called when the
+    metadata is refreshed or a source is changed so that stale results do not take
+    up space.
+    """
+    def __init__(self, max_size=128):
+        self._lock = Lock()
+        self._results = OrderedDict()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # A list that new results are also added to, see `merge()`
+        self.journal = None
+
+    def get(self, key):
+        """Return the cached result for key, or None
+
+        :param key: The depsolve cache key
+        :type key: tuple
+        :returns: The cached result or None
+        """
+        with self._lock:
+            if key not in self._results:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._results.move_to_end(key)
+            return self._results[key]
+
+    def put(self, key, result):
+        """Store a result, removing the least recently used ones if it is full
+
+        :param key: The depsolve cache key
+        :type key: tuple
+        :param result: The result of the depsolve
+        :returns: None
+        """
+        with self._lock:
+            self._results[key] = result
+            self._results.move_to_end(key)
+            while len(self._results) > max(self.max_size, 0):
+                self._results.popitem(last=False)
+            if self.journal is not None:
+                self.journal.append((key, result))
+
+    def merge(self, results, hits, misses):
+        """Add the results and statistics of a copy of the cache in another process
+
+        :param results: The keys and results from the other cache's journal
+        :type results: list of tuples
+        :param hits: The number of hits in the other cache
+        :type hits: int
+        :param misses: The number of misses in the other cache
+        :type misses: int
+        :returns: None
+        """
+        for key, result in results:
+            self.put(key, result)
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def clear(self):
+        """Remove all of the cached results"""
+        with self._lock:
+            self._results.clear()
+
+    def stats(self):
+        """Return the cache statistics
+
+        :returns: The hits, misses, current size, and maximum size of the cache
+        :rtype: dict
+        """
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "size": len(self._results),
+                    "max_size": self.max_size}
+
+# Shared by all of the depsolve functions, DNFLock sets the size and clears it on refresh
+DEPSOLVE_CACHE = DepsolveCache()
+
+# The revision of each repository object, calculated when it is first used
+_repo_revisions = WeakKeyDictionary()
+
+def repo_revision(repo):
+    """Return a string that changes when the repository metadata changes
+
+    :param repo: The repository
+    :type repo: dnf.repo.Repo
+    :returns: The sha256 of the repository's repomd.xml, or its timestamp
+    :rtype: str
+
+    The repomd.xml is read from the metadata cache, or from the baseurl of a local
+    repository. If neither can be found the newest metadata timestamp is used.
+
+    The result is saved, so that it describes the metadata that was loaded into the
+    sack even if newer metadata has been downloaded since then. Call this right
+    after loading the metadata.
+    """
+    if repo in _repo_revisions:
+        return _repo_revisions[repo]
+    _repo_revisions[repo] = _read_repo_revision(repo)
+    return _repo_revisions[repo]
+
+def _read_repo_revision(repo):
+    """Read the revision of the repository's metadata, see `repo_revision()`"""
+    # NOTE: dnf does not have a public API for the location of the metadata
+    paths = [joinpaths(repo._repo.getCachedir(), "repodata/repomd.xml")]
+    paths += [joinpaths(url[7:], "repodata/repomd.xml") for url in repo.baseurl if url.startswith("file://")]
+    for path in paths:
+        try:
+            with open(path, "rb") as f:
+                return hashlib.sha256(f.read()).hexdigest()
+        except OSError:
+            continue
+    return str(repo._repo.getMaxTimestamp())
+
+def repos_revision(dbo):
+    """Return the revisions of all of the enabled repositories
+
+    :param dbo: dnf base object
+    :type dbo: dnf.Base
+    :returns: The id and revision of the enabled repositories, sorted by id
+    :rtype: tuple of tuples
+    """
+    return tuple(sorted((r.id, repo_revision(r)) for r in dbo.repos.iter_enabled()))
+
+def depsolve_cache_key(dbo, kind, projects, groups, with_core=False):
+    """Return the depsolve cache key for a request
+
+    :param dbo: dnf base object
+    :type dbo: dnf.Base
+    :param kind: The function the result is for
+    :type kind: str
+    :param projects: The projects and version globs to find the dependencies for
+    :type projects: List of tuples
+    :param groups: The groups to include in dependency solving
+    :type groups: List of str
+    :param with_core: Include the core group
+    :type with_core: bool
+    :returns: A key for DepsolveCache
+    :rtype: tuple
+
+    The order and duplicates of the projects and groups do not change the result,
+    so they are sorted and duplicates removed.
+    """
+    repos = repos_revision(dbo)
+    return (kind,
+            tuple(sorted(set((name, version or "") for name, version in projects))),
+            tuple(sorted(set(groups))),
+            bool(with_core),
+            repos)
 
 def _depsolve(dbo, projects, groups):
     """Add projects to a new transaction
@@ -271,7 +558,14 @@ def projects_depsolve(dbo, projects, groups):
     :returns: NEVRA's of the project and its dependencies
     :rtype: list of dicts
     :raises: ProjectsError if there was a problem installing something
+
+    The results are cached in DEPSOLVE_CACHE until the repositories change.
     """
+    key = depsolve_cache_key(dbo, "depsolve", projects, groups)
+    deps = DEPSOLVE_CACHE.get(key)
+    if deps is not None:
+        return [dict(d) for d in deps]
+
     _depsolve(dbo, projects, groups)
 
     try:
@@ -280,30 +574,187 @@ def projects_depsolve(dbo, projects, groups):
         raise ProjectsError("There was a problem depsolving %s: %s" % (projects, str(e)))
 
     if len(dbo.transaction) == 0:
-        return []
+        deps = []
+    else:
+        deps = sorted(map(pkg_to_dep, dbo.transaction.install_set), key=lambda p: p["name"].lower())
+    DEPSOLVE_CACHE.put(key, deps)
+    return [dict(d) for d in deps]
+
+
+class FileCountCache(object):
+    """The number of files in each package, saved to a file
+
+    Counting the files in a package means creating the list of all of its files,
+    which takes most of the time needed to estimate the size of an image. The count
+    never changes for a build, so it is saved under the package's NEVRA and only
+    counted the first time the package is used.
+
+    The counts of the packages that are no longer available are removed when it is
+    saved, and it keeps at most max_size of them.
+    """
+    def __init__(self, path, max_size=100000):
+        self.path = path
+        self.max_size = max_size
+        self._lock = Lock()
+        self._counts = None
+        # The counts added since it was last saved
+        self._new = {}
+
+    def _read(self):
+        """Return the saved counts, or an empty dict"""
+        try:
+            with open(self.path, "r") as f:
+                counts = json.load(f)
+            if not isinstance(counts, dict):
+                raise ValueError("not a dict")
+            return counts
+        except (OSError, ValueError) as e:
+            if os.path.exists(self.path):
+                log.warning("Ignoring the file count cache %s: %s", self.path, str(e))
+            return {}
+
+    def counts(self, pkgs):
+        """Return the number of files in each package
+
+        :param pkgs: The packages
+        :type pkgs: list of hawkey.Package
+        :returns: The number of files in each one
+        :rtype: list of int
+
+        The packages that have not been counted before are all counted at once,
+        without holding the lock.
+        """
+        keys = [str(pkg) for pkg in pkgs]
+        with self._lock:
+            if self._counts is None:
+                self._counts = self._read()
+            counts = [self._counts.get(key) for key in keys]
+        new = {}
+        for i, pkg in enumerate(pkgs):
+            if counts[i] is None:
+                counts[i] = new.setdefault(keys[i], file_count(pkg))
+        if new:
+            with self._lock:
+                self._counts.update(new)
+                self._new.update(new)
+        return counts
+
+    def count(self, pkg):
+        """Return the number of files in the package
+
+        :param pkg: The package
+        :type pkg: hawkey.Package
+        :returns: The number of files
+        :rtype: int
+        """
+        return self.counts([pkg])[0]
+
+    def save(self, dbo=None):
+        """Write the counts to the file if any have been added
+
+        :param dbo: Only keep the counts of the packages available in its sack
+        :type dbo: dnf.Base
+        :returns: None
+
+        The new counts are added to the ones in the file, another lorax-composer
+        process may have saved it since it was read. If there are more than
+        max_size the oldest ones are removed.
+        """
+        with self._lock:
+            if not self._new:
+                return
+            try:
+                with open(self.path + ".lock", "a") as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    counts = self._read()
+                    counts.update(self._new)
+                    if dbo is not None:
+                        available = set(str(pkg) for pkg in dbo.sack.query().available())
+                        counts = dict((k, v) for k, v in counts.items() if k in available)
+                    for key in list(counts)[:max(len(counts) - self.max_size, 0)]:
+                        del counts[key]
+
+                    tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+                    with open(tmp_path, "w") as f:
+                        json.dump(counts, f)
+                    os.replace(tmp_path, self.path)
+            except OSError as e:
+                log.error("Failed to save the file count cache %s: %s", self.path, str(e))
+                return
+            self._counts = counts
+            self._new = {}
+
+def file_count(pkg):
+    """Return the number of files in a package
+
+    :param pkg: The package
+    :type pkg: hawkey.Package
+    :returns: The number of files, directories, and links
+    :rtype: int
 
-    return sorted(map(pkg_to_dep, dbo.transaction.install_set), key=lambda p: p["name"].lower())
+    If the rpm is available locally, eg. from a local repository, the count is
+    read from its header. Otherwise the metadata's file list is used.
+    """
+    try:
+        path = pkg.localPkg()
+    except (AttributeError, ValueError):
+        path = None
+    if path and os.path.exists(path):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                ts = rpm.TransactionSet()
+                ts.setVSFlags(rpm._RPMVSF_NOSIGNATURES | rpm._RPMVSF_NODIGESTS)
+                hdr = ts.hdrFromFdno(fd)
+            finally:
+                os.close(fd)
+            return len(hdr[rpm.RPMTAG_BASENAMES])
+        except (OSError, rpm.error) as e:
+            log.debug("Counting the files of %s from its metadata: %s", pkg, str(e))
+    return len(pkg.files)
+
+# The FileCountCache for each cache directory
+_file_counts = {}
+_file_counts_lock = Lock()
+
+def file_count_cache(dbo):
+    """Return the FileCountCache for the dnf.Base's cache directory
 
+    :param dbo: dnf base object
+    :type dbo: dnf.Base
+    :returns: The file count cache
+    :rtype: FileCountCache
+    """
+    path = joinpaths(dbo.conf.cachedir, "file-counts.json")
+    with _file_counts_lock:
+        if path not in _file_counts:
+            _file_counts[path] = FileCountCache(path)
+        return _file_counts[path]
 
-def estimate_size(packages, block_size=6144):
+def estimate_size(packages, block_size=6144, file_counts=None):
     """Estimate the installed size of a package list
 
     :param packages: The packages to be installed
     :type packages: list of hawkey.Package objects
     :param block_size: The block size to use for rounding up file sizes.
     :type block_size: int
+    :param file_counts: The saved file counts to use, or None to count the files
+    :type file_counts: FileCountCache
     :returns: The estimated size of installed packages
     :rtype: int
 
     Estimating actual requirements is difficult without the actual file sizes, which
     dnf doesn't provide access to. So use the file count and block size to estimate
     a minimum size for each package.
+
+    New file counts are added to file_counts, the caller should save it.
     """
-    installed_size = 0
-    for p in packages:
-        installed_size += len(p.files) * block_size
-        installed_size += p.installsize
-    return installed_size
+    packages = list(packages)
+    if file_counts is None:
+        counts = [len(p.files) for p in packages]
+    else:
+        counts = file_counts.counts(packages)
+    return sum(count * block_size + p.installsize for count, p in zip(counts, packages))
 
 
 def projects_depsolve_with_size(dbo, projects, groups, with_core=True):
@@ -318,7 +769,14 @@ def projects_depsolve_with_size(dbo, projects, groups, with_core=True):
     :returns: installed size and a list of NEVRA's of the project and its dependencies
     :rtype: tuple of (int, list of dicts)
     :raises: ProjectsError if there was a problem installing something
+
+    The results are cached in DEPSOLVE_CACHE until the repositories change.
     """
+    key = depsolve_cache_key(dbo, "depsolve_with_size", projects, groups, with_core)
+    result = DEPSOLVE_CACHE.get(key)
+    if result is not None:
+        return (result[0], [dict(d) for d in result[1]])
+
     _depsolve(dbo, projects, groups)
 
     if with_core:
@@ -330,11 +788,14 @@ def projects_depsolve_with_size(dbo, projects, groups, with_core=True):
         raise ProjectsError("There was a problem depsolving %s: %s" % (projects, str(e)))
 
     if len(dbo.transaction) == 0:
-        return (0, [])
-
-    installed_size = estimate_size(dbo.transaction.install_set)
-    deps = sorted(map(pkg_to_dep, dbo.transaction.install_set), key=lambda p: p["name"].lower())
-    return (installed_size, deps)
+        installed_size, deps = (0, [])
+    else:
+        file_counts = file_count_cache(dbo)
+        installed_size = estimate_size(dbo.transaction.install_set, file_counts=file_counts)
+        file_counts.save(dbo)
+        deps = sorted(map(pkg_to_dep, dbo.transaction.install_set), key=lambda p: p["name"].lower())
+    DEPSOLVE_CACHE.put(key, (installed_size, deps))
+    return (installed_size, [dict(d) for d in deps])
 
 
 def modules_list(dbo, module_names):
@@ -669,6 +1130,7 @@ def new_repo_source(dbo, repoid, source, repo_dir):
         log.info("Updating repository metadata after adding %s", repoid)
         dbo.fill_sack(load_system_repo=False)
         dbo.read_comps()
+        DEPSOLVE_CACHE.clear()
 
         # Remove any previous sources with this id, ignore it if it isn't found
         try:
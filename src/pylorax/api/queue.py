@@ -26,17 +26,20 @@ import multiprocessing as mp
 import pwd
 import shutil
 import subprocess
-from subprocess import Popen, PIPE
+import tempfile
 import time
 
 from pylorax import find_templates
 from pylorax.api.compose import move_compose_results
-from pylorax.api.recipes import recipe_from_file
-from pylorax.api.timestamp import TS_CREATED, TS_STARTED, TS_FINISHED, write_timestamp, timestamp_dict
+from pylorax.api.composedb import compose_index, index_compose, rebuild_compose_index, sync_compose_index
+from pylorax.api.composedb import get_image_name, publish_compose_event, read_image_checksum, write_image_checksum
+from pylorax.api.dirwatch import DirWatch
+from pylorax.api.timestamp import TS_STARTED, TS_FINISHED, write_timestamp
+from pylorax.api.utils import tar_file_members
 import pylorax.api.toml as toml
 from pylorax.base import DataHolder
 from pylorax.creator import run_creator
-from pylorax.sysutils import joinpaths, read_tail
+from pylorax.sysutils import joinpaths, read_lines
 
 from lifted.queue import create_upload, get_uploads, ready_upload, delete_upload
 
@@ -66,6 +69,7 @@ def check_queues(cfg):
     # Check results STATUS messages
     # - If STATUS is missing, set it to FAILED
     # - RUNNING should be changed to FAILED
+    # - PENDING should be changed to FAILED, it was being prepared when composer stopped
     # - WAITING should have a symlink in the new queue
     for link in glob(joinpaths(cfg.composer_dir, "results/*")):
         if not os.path.exists(joinpaths(link, "STATUS")):
@@ -73,7 +77,7 @@ def check_queues(cfg):
             continue
 
         status = open(joinpaths(link, "STATUS")).read().strip()
-        if status == "RUNNING":
+        if status in ("RUNNING", "PENDING"):
             log.info("Setting build %s to FAILED", os.path.basename(link))
             open(joinpaths(link, "STATUS"), "w").write("FAILED\n")
         elif status == "WAITING":
@@ -81,6 +85,8 @@ def check_queues(cfg):
                 log.info("Creating missing symlink to new build %s", os.path.basename(link))
                 os.symlink(link, joinpaths(cfg.composer_dir, "queue/new/", os.path.basename(link)))
 
+    rebuild_compose_index(cfg.composer_dir)
+
 def start_queue_monitor(cfg, uid, gid):
     """Start the queue monitor as a mp process
 
@@ -91,15 +97,38 @@ def start_queue_monitor(cfg, uid, gid):
     :param gid: Group ID that owns the queue
     :type gid: int
     :returns: None
+
+    The queues are checked before the monitor is started, and before any
+    requests are served, so that builds submitted after startup are not
+    mistaken for ones that were interrupted.
     """
     lib_dir = cfg.get("composer", "lib_dir")
     share_dir = cfg.get("composer", "share_dir")
     tmp = cfg.get("composer", "tmp")
-    monitor_cfg = DataHolder(cfg=cfg, composer_dir=lib_dir, share_dir=share_dir, uid=uid, gid=gid, tmp=tmp)
+    max_composes = max(1, cfg.getint("composer", "max_concurrent_composes"))
+    monitor_cfg = DataHolder(cfg=cfg, composer_dir=lib_dir, share_dir=share_dir, uid=uid, gid=gid, tmp=tmp,
+                             max_composes=max_composes)
+    check_queues(monitor_cfg)
     p = mp.Process(target=monitor, args=(monitor_cfg,))
     p.daemon = True
     p.start()
 
+def compose_tmp_dir(tmp, uuid):
+    """Return the temporary directory used by a running compose
+
+    :param tmp: Top level temporary directory
+    :type tmp: str
+    :param uuid: The UUID of the build
+    :type uuid: str
+    :returns: Path to the compose's private temporary directory
+    :rtype: str
+
+    Each compose gets its own directory so that several can run at the same time.
+    The anaconda install root is in ./sysimage/, anaconda's /tmp is ./tmp/, and
+    any lmc-* temporary files are created at the top level.
+    """
+    return joinpaths(tmp, "lorax-composer", uuid)
+
 def monitor(cfg):
     """Monitor the queue for new compose requests
 
@@ -110,10 +139,13 @@ def monitor(cfg):
     The queue has 2 subdirectories, new and run. When a compose is ready to be run
     a symlink to the uniquely named results directory should be placed in ./queue/new/
 
-    When the it is ready to be run (it is checked every 30 seconds or after a previous
+    When the it is ready to be run (as soon as the symlink is created or after a previous
     compose is finished) the symlink will be moved into ./queue/run/ and a STATUS file
     will be created in the results directory.
 
+    Up to cfg.max_composes builds are run at the same time, each one in its own
+    child process.
+
     STATUS can contain one of: WAITING, RUNNING, FINISHED, FAILED
 
     If the system is restarted while a compose is running it will move any old symlinks
@@ -121,70 +153,134 @@ def monitor(cfg):
     """
     def queue_sort(uuid):
         """Sort the queue entries by their mtime, not their names"""
-        return os.stat(joinpaths(cfg.composer_dir, "queue/new", uuid)).st_mtime
+        try:
+            return os.stat(joinpaths(cfg.composer_dir, "queue/new", uuid)).st_mtime
+        except OSError:
+            # The symlink may vanish if uuid_cancel() has been called
+            return 0
 
-    check_queues(cfg)
+    def reap_composes(block=False):
+        """Remove finished composes from the running list"""
+        while running:
+            try:
+                pid, _ = os.waitpid(-1, 0 if block else os.WNOHANG)
+            except ChildProcessError:
+                running.clear()
+                return
+            if pid == 0:
+                return
+            uuid = running.pop(pid, None)
+            if uuid:
+                log.debug("Compose process %d for %s has exited", pid, uuid)
+            block = False
+
+    max_composes = cfg.get("max_composes", 1)
+    running = {}
+    # Watch for new symlinks before looking at the queue so that none are missed
+    new_watch = DirWatch(joinpaths(cfg.composer_dir, "queue/new"))
     while True:
+        reap_composes()
+        if len(running) >= max_composes:
+            # Wait for one of the running composes to finish
+            reap_composes(block=True)
+            continue
+
         uuids = sorted(os.listdir(joinpaths(cfg.composer_dir, "queue/new")), key=queue_sort)
 
         # Pick the oldest and move it into ./run/
         if not uuids:
-            # No composes left to process, sleep for a bit
-            time.sleep(5)
+            # No composes left to process, wait for start_build() to add one
+            # This falls back to checking every 5 seconds if inotify isn't available.
+            new_watch.wait(5)
         else:
             src = joinpaths(cfg.composer_dir, "queue/new", uuids[0])
             dst = joinpaths(cfg.composer_dir, "queue/run", uuids[0])
             try:
+                # Claiming the build by moving its symlink is atomic
                 os.rename(src, dst)
             except OSError:
                 # The symlink may vanish if uuid_cancel() has been called
                 continue
 
-            # The anaconda logs are also copied into ./anaconda/ in this directory
-            os.makedirs(joinpaths(dst, "logs"), exist_ok=True)
+            # Daemonic multiprocessing processes cannot have children, so fork the
+            # compose process directly. Its loggers and tempfile settings are private.
+            pid = os.fork()
+            if pid == 0:
+                rc = 1
+                try:
+                    run_compose(cfg, uuids[0])
+                    rc = 0
+                except BaseException:
+                    # os._exit() skips the interpreter's printing of the traceback
+                    log.exception("Compose process for %s failed", uuids[0])
+                finally:
+                    logging.shutdown()
+                    os._exit(rc)
+            running[pid] = uuids[0]
+            log.debug("Started compose process %d for %s (%d running)", pid, uuids[0], len(running))
+
+def run_compose(cfg, uuid):
+    """Run a compose that has been moved into ./queue/run/
+
+    :param cfg: Configuration settings
+    :type cfg: DataHolder
+    :param uuid: The UUID of the build
+    :type uuid: str
+    :returns: None
+
+    This is run in its own process by monitor(), the results are written to the STATUS
+    file, and the symlink is removed from ./queue/run/ when it is done.
+    """
+    dst = joinpaths(cfg.composer_dir, "queue/run", uuid)
 
-            def open_handler(loggers, file_name):
-                handler = logging.FileHandler(joinpaths(dst, "logs", file_name))
-                handler.setLevel(logging.DEBUG)
-                handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s: %(message)s"))
-                for logger in loggers:
-                    logger.addHandler(handler)
-                return (handler, loggers)
+    # The anaconda logs are also copied into ./anaconda/ in this directory
+    os.makedirs(joinpaths(dst, "logs"), exist_ok=True)
 
-            loggers = (((log, program_log, dnf_log), "combined.log"),
-                       ((log,), "composer.log"),
-                       ((program_log,), "program.log"),
-                       ((dnf_log,), "dnf.log"))
-            handlers = [open_handler(loggers, file_name) for loggers, file_name in loggers]
+    def open_handler(loggers, file_name):
+        handler = logging.FileHandler(joinpaths(dst, "logs", file_name))
+        handler.setLevel(logging.DEBUG)
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s: %(message)s"))
+        for logger in loggers:
+            logger.addHandler(handler)
+        return (handler, loggers)
 
-            log.info("Starting new compose: %s", dst)
-            open(joinpaths(dst, "STATUS"), "w").write("RUNNING\n")
+    loggers = (((log, program_log, dnf_log), "combined.log"),
+               ((log,), "composer.log"),
+               ((program_log,), "program.log"),
+               ((dnf_log,), "dnf.log"))
+    handlers = [open_handler(loggers, file_name) for loggers, file_name in loggers]
 
-            try:
-                make_compose(cfg, os.path.realpath(dst))
-                log.info("Finished building %s, results are in %s", dst, os.path.realpath(dst))
-                open(joinpaths(dst, "STATUS"), "w").write("FINISHED\n")
-                write_timestamp(dst, TS_FINISHED)
-
-                upload_cfg = cfg.cfg["upload"]
-                for upload in get_uploads(upload_cfg, uuid_get_uploads(cfg.cfg, uuids[0])):
-                    log.info("Readying upload %s", upload.uuid)
-                    uuid_ready_upload(cfg.cfg, uuids[0], upload.uuid)
-            except Exception:
-                import traceback
-                log.error("traceback: %s", traceback.format_exc())
+    log.info("Starting new compose: %s", dst)
+    open(joinpaths(dst, "STATUS"), "w").write("RUNNING\n")
+    index_compose(cfg.composer_dir, os.path.realpath(dst))
+
+    try:
+        make_compose(cfg, os.path.realpath(dst))
+        log.info("Finished building %s, results are in %s", dst, os.path.realpath(dst))
+        open(joinpaths(dst, "STATUS"), "w").write("FINISHED\n")
+        write_timestamp(dst, TS_FINISHED)
+        index_compose(cfg.composer_dir, os.path.realpath(dst))
+
+        upload_cfg = cfg.cfg["upload"]
+        for upload in get_uploads(upload_cfg, uuid_get_uploads(cfg.cfg, uuid)):
+            log.info("Readying upload %s", upload.uuid)
+            uuid_ready_upload(cfg.cfg, uuid, upload.uuid)
+    except Exception:
+        import traceback
+        log.error("traceback: %s", traceback.format_exc())
 
 # TODO - Write the error message to an ERROR-LOG file to include with the status
 #                log.error("Error running compose: %s", e)
-                open(joinpaths(dst, "STATUS"), "w").write("FAILED\n")
-                write_timestamp(dst, TS_FINISHED)
-            finally:
-                for handler, loggers in handlers:
-                    for logger in loggers:
-                        logger.removeHandler(handler)
-                    handler.close()
+        open(joinpaths(dst, "STATUS"), "w").write("FAILED\n")
+        write_timestamp(dst, TS_FINISHED)
+        index_compose(cfg.composer_dir, os.path.realpath(dst))
+    finally:
+        for handler, loggers in handlers:
+            for logger in loggers:
+                logger.removeHandler(handler)
+            handler.close()
 
-            os.unlink(dst)
+    os.unlink(dst)
 
 def make_compose(cfg, results_dir):
     """Run anaconda with the final-kickstart.ks from results_dir
@@ -235,7 +331,15 @@ def make_compose(cfg, results_dir):
     cfg_dict["squashfs_args"] = None
 
     cfg_dict["lorax_templates"] = find_templates(cfg.share_dir)
-    cfg_dict["tmp"] = cfg.tmp
+
+    # Each compose uses its own temporary directory, anaconda root, and anaconda /tmp
+    build_tmp = compose_tmp_dir(cfg.tmp, os.path.basename(results_dir))
+    os.makedirs(build_tmp, exist_ok=True)
+    tempfile.tempdir = build_tmp
+    cfg_dict["tmp"] = build_tmp
+    cfg_dict["dirinstall_path"] = joinpaths(build_tmp, "sysimage")
+    cfg_dict["anaconda_tmp"] = joinpaths(build_tmp, "tmp")
+    os.makedirs(cfg_dict["anaconda_tmp"], exist_ok=True)
     # Use default args for dracut
     cfg_dict["dracut_conf"] = None
     cfg_dict["dracut_args"] = None
@@ -250,8 +354,8 @@ def make_compose(cfg, results_dir):
     install_cfg = DataHolder(**cfg_dict)
 
     # Some kludges for the 99-copy-logs %post, failure in it will crash the build
-    for f in ["/tmp/NOSAVE_INPUT_KS", "/tmp/NOSAVE_LOGS"]:
-        open(f, "w")
+    for f in ["NOSAVE_INPUT_KS", "NOSAVE_LOGS"]:
+        open(joinpaths(cfg_dict["anaconda_tmp"], f), "w")
 
     # Placing a CANCEL file in the results directory will make execWithRedirect send anaconda a SIGTERM
     def cancel_build():
@@ -261,6 +365,7 @@ def make_compose(cfg, results_dir):
     try:
         test_path = joinpaths(results_dir, "TEST")
         write_timestamp(results_dir, TS_STARTED)
+        index_compose(cfg.composer_dir, results_dir)
         if os.path.exists(test_path):
             # Pretend to run the compose
             time.sleep(5)
@@ -277,40 +382,53 @@ def make_compose(cfg, results_dir):
 
             # Extract the results of the compose into results_dir and cleanup the compose directory
             move_compose_results(install_cfg, results_dir)
+
+        # Store the checksum so that the API and the uploads do not need to read the image again
+        write_image_checksum(results_dir, joinpaths(results_dir, install_cfg.image_name))
     finally:
         # Make sure any remaining temporary directories are removed (eg. if there was an exception)
-        for d in glob(joinpaths(cfg.tmp, "lmc-*")):
+        for d in glob(joinpaths(build_tmp, "lmc-*")):
             if os.path.isdir(d):
                 shutil.rmtree(d)
             elif os.path.isfile(d):
                 os.unlink(d)
 
+        # Only remove the rest of the compose's temporary directory if nothing is still mounted on it
+        mounts = [m.split()[1] for m in open("/proc/mounts").readlines()]
+        if any(m.startswith(build_tmp) for m in mounts):
+            log.error("%s still has filesystems mounted, not removing it", build_tmp)
+        else:
+            shutil.rmtree(build_tmp, ignore_errors=True)
+
+        # The build's links to the rpm cache are not needed after the compose
+        shutil.rmtree(joinpaths(results_dir, "cache-repo"), ignore_errors=True)
+
         # Make sure that everything under the results directory is owned by the user
         user = pwd.getpwuid(cfg.uid).pw_name
         group = grp.getgrgid(cfg.gid).gr_name
         log.debug("Install finished, chowning results to %s:%s", user, group)
         subprocess.call(["chown", "-R", "%s:%s" % (user, group), results_dir])
 
-def get_compose_type(results_dir):
-    """Return the type of composition.
+def _add_upload_summaries(cfg, index, detail):
+    """Add the summaries of the build's uploads to the details
 
-    :param results_dir: The directory containing the metadata and results for the build
-    :type results_dir: str
-    :returns: The type of compose (eg. 'tar')
-    :rtype: str
-    :raises: RuntimeError if no kickstart template can be found.
+    :param cfg: Configuration settings
+    :type cfg: ComposerConfig
+    :param index: The compose index
+    :type index: ComposeIndex
+    :param detail: Details about the build
+    :type detail: dict
+    :returns: The details with the uploads field set
+    :rtype: dict
     """
-    # Should only be 2 kickstarts, the final-kickstart.ks and the template
-    t = [os.path.basename(ks)[:-3] for ks in glob(joinpaths(results_dir, "*.ks"))
-                                   if "final-kickstart" not in ks]
-    if len(t) != 1:
-        raise RuntimeError("Cannot find ks template for build %s" % os.path.basename(results_dir))
-    return t[0]
+    upload_uuids = index.get_uploads(detail["id"])
+    detail["uploads"] = [upload.summary() for upload in get_uploads(cfg["upload"], upload_uuids)]
+    return detail
 
 def compose_detail(cfg, results_dir, api=1):
     """Return details about the build.
 
-    :param cfg: Configuration settings (required for api=1)
+    :param cfg: Configuration settings
     :type cfg: ComposerConfig
     :param results_dir: The directory containing the metadata and results for the build
     :type results_dir: str
@@ -328,6 +446,7 @@ def compose_detail(cfg, results_dir, api=1):
     * blueprint - Blueprint name
     * version - Blueprint version
     * image_size - Size of the image, if finished. 0 otherwise.
+    * image_sha256 - SHA-256 of the image, if finished. None otherwise.
     * uploads - For API v1 details about uploading the image are included
 
     Various timestamps are also included in the dict.  These are all Unix UTC timestamps.
@@ -337,37 +456,24 @@ def compose_detail(cfg, results_dir, api=1):
     * job_created - When the user submitted the compose
     * job_started - Anaconda started running
     * job_finished - Job entered FINISHED or FAILED state
+
+    The details are read from the compose index, if the build is not in the index
+    they are read from the results directory and added to it.
     """
+    lib_dir = cfg.get("composer", "lib_dir")
     build_id = os.path.basename(os.path.abspath(results_dir))
-    status = open(joinpaths(results_dir, "STATUS")).read().strip()
-    blueprint = recipe_from_file(joinpaths(results_dir, "blueprint.toml"))
-
-    compose_type = get_compose_type(results_dir)
-
-    image_path = get_image_name(results_dir)[1]
-    if status == "FINISHED" and os.path.exists(image_path):
-        image_size = os.stat(image_path).st_size
-    else:
-        image_size = 0
-
-    times = timestamp_dict(results_dir)
+    if not os.path.isdir(results_dir):
+        raise IOError("%s is not a valid build_id" % build_id)
 
-    detail = {"id":           build_id,
-              "queue_status": status,
-              "job_created":  times.get(TS_CREATED),
-              "job_started":  times.get(TS_STARTED),
-              "job_finished": times.get(TS_FINISHED),
-              "compose_type": compose_type,
-              "blueprint":    blueprint["name"],
-              "version":      blueprint["version"],
-              "image_size":   image_size,
-             }
+    index = compose_index(lib_dir)
+    detail = index.get(build_id)
+    if detail is None:
+        detail = index_compose(lib_dir, results_dir, replace=False)
+    # Builds indexed before the checksum was stored do not have it
+    detail.setdefault("image_sha256", None)
 
     if api == 1:
-        # Get uploads for this build_id
-        upload_uuids = uuid_get_uploads(cfg, build_id)
-        summaries = [upload.summary() for upload in get_uploads(cfg["upload"], upload_uuids)]
-        detail["uploads"] = summaries
+        _add_upload_summaries(cfg, index, detail)
     return detail
 
 def queue_status(cfg, api=1):
@@ -380,28 +486,16 @@ def queue_status(cfg, api=1):
     :returns: A list of the new composes, and a list of the running composes
     :rtype: dict
 
-    This returns a dict with 2 lists. "new" is the list of uuids that are waiting to be built,
-    and "run" has the uuids that are being built (currently limited to 1 at a time).
+    This returns a dict with 2 lists. "new" is the list of uuids that are being prepared (PENDING)
+    or are waiting to be built (WAITING), and "run" has the uuids that are being built (up to the composer.max_concurrent_composes
+    setting at a time).
     """
-    queue_dir = joinpaths(cfg.get("composer", "lib_dir"), "queue")
-    new_queue = [os.path.realpath(p) for p in glob(joinpaths(queue_dir, "new/*"))]
-    run_queue = [os.path.realpath(p) for p in glob(joinpaths(queue_dir, "run/*"))]
-
-    new_details = []
-    for n in new_queue:
-        try:
-            d = compose_detail(cfg, n, api)
-        except IOError:
-            continue
-        new_details.append(d)
-
-    run_details = []
-    for r in run_queue:
-        try:
-            d = compose_detail(cfg, r, api)
-        except IOError:
-            continue
-        run_details.append(d)
+    index = sync_compose_index(cfg.get("composer", "lib_dir"))
+    new_details = index.list(["PENDING", "WAITING"])
+    run_details = index.list(["RUNNING"])
+    if api == 1:
+        for d in new_details + run_details:
+            _add_upload_summaries(cfg, index, d)
 
     return {
         "new": new_details,
@@ -449,17 +543,11 @@ def build_status(cfg, status_filter=None, api=1):
     else:
         status_filter = ["FINISHED", "FAILED"]
 
-    results = []
-    result_dir = joinpaths(cfg.get("composer", "lib_dir"), "results")
-    for build in glob(result_dir + "/*"):
-        log.debug("Checking status of build %s", build)
-
-        try:
-            status = open(joinpaths(build, "STATUS"), "r").read().strip()
-            if status in status_filter:
-                results.append(compose_detail(cfg, build, api))
-        except IOError:
-            pass
+    index = sync_compose_index(cfg.get("composer", "lib_dir"))
+    results = index.list(status_filter)
+    if api == 1:
+        for d in results:
+            _add_upload_summaries(cfg, index, d)
     return results
 
 def _upload_list_path(cfg, uuid):
@@ -534,6 +622,7 @@ def uuid_add_upload(cfg, uuid, upload_uuid):
     if upload_uuid not in uuid_get_uploads(cfg, uuid):
         with open(_upload_list_path(cfg, uuid), "a") as uploads_file:
             print(upload_uuid, file=uploads_file)
+        compose_index(cfg.get("composer", "lib_dir")).set_uploads(uuid, uuid_get_uploads(cfg, uuid))
         status = uuid_status(cfg, uuid)
         if status and status["queue_status"] == "FINISHED":
             uuid_ready_upload(cfg, uuid, upload_uuid)
@@ -549,7 +638,13 @@ def uuid_remove_upload(cfg, upload_uuid):
     :rtype: None
     :raises: RuntimeError if the upload_uuid is not found
     """
-    for build_uuid in (os.path.basename(b) for b in glob(joinpaths(cfg.get("composer", "lib_dir"), "results/*"))):
+    index = compose_index(cfg.get("composer", "lib_dir"))
+    build_uuid = index.upload_build(upload_uuid)
+    if build_uuid:
+        build_uuids = [build_uuid]
+    else:
+        build_uuids = [os.path.basename(b) for b in glob(joinpaths(cfg.get("composer", "lib_dir"), "results/*"))]
+    for build_uuid in build_uuids:
         uploads = uuid_get_uploads(cfg, build_uuid)
         if upload_uuid not in uploads:
             continue
@@ -558,6 +653,7 @@ def uuid_remove_upload(cfg, upload_uuid):
         with open(_upload_list_path(cfg, build_uuid), "w") as uploads_file:
             for upload in uploads:
                 print(upload, file=uploads_file)
+        index.set_uploads(build_uuid, uploads)
         return
 
     raise RuntimeError(f"{upload_uuid} is not a valid upload id!")
@@ -581,7 +677,7 @@ def uuid_ready_upload(cfg, uuid, upload_uuid):
     if status["queue_status"] != "FINISHED":
         raise RuntimeError(f"Build {uuid} is not finished!")
     _, image_path = uuid_image(cfg, uuid)
-    ready_upload(cfg["upload"], upload_uuid, image_path)
+    ready_upload(cfg["upload"], upload_uuid, image_path, read_image_checksum(os.path.dirname(image_path)))
 
 def uuid_cancel(cfg, uuid):
     """Cancel a build and delete its results
@@ -593,7 +689,7 @@ def uuid_cancel(cfg, uuid):
     :returns: True if it was canceled and deleted
     :rtype: bool
 
-    Only call this if the build status is WAITING or RUNNING
+    Only call this if the build status is PENDING, WAITING or RUNNING
     """
     cancel_path = joinpaths(cfg.get("composer", "lib_dir"), "results", uuid, "CANCEL")
     if os.path.exists(cancel_path):
@@ -601,7 +697,8 @@ def uuid_cancel(cfg, uuid):
         return False
 
     # This status can change (and probably will) while it is in the middle of doing this:
-    # It can move from WAITING -> RUNNING or it can move from RUNNING -> FINISHED|FAILED
+    # It can move from PENDING -> WAITING|FAILED, from WAITING -> RUNNING, or it can move
+    # from RUNNING -> FINISHED|FAILED
 
     # If it is in WAITING remove the symlink and then check to make sure it didn't show up
     # in the run queue
@@ -624,11 +721,21 @@ def uuid_cancel(cfg, uuid):
     # At this point the build has probably started. Write to the CANCEL file.
     open(cancel_path, "w").write("\n")
 
+    # A PENDING build is deleted by prepare_build() when it sees the CANCEL file,
+    # it checks for it after writing the build's new status.
+    status_path = joinpaths(cfg.get("composer", "lib_dir"), "results", uuid, "STATUS")
+    if open(status_path).read().strip() == "PENDING":
+        log.info("Canceling %s while it is being prepared", uuid)
+        return True
+
     # Wait for status to move to FAILED or FINISHED
     started = time.time()
     while True:
         status = uuid_status(cfg, uuid)
-        if status is None or status["queue_status"] == "FAILED":
+        if status is None:
+            # prepare_build() saw the CANCEL file and deleted it
+            return True
+        elif status["queue_status"] == "FAILED":
             break
         elif status is not None and status["queue_status"] == "FINISHED":
             # The build finished successfully, no point in deleting it now
@@ -641,8 +748,11 @@ def uuid_cancel(cfg, uuid):
 
         time.sleep(5)
 
-    # Remove the partial results
-    uuid_delete(cfg, uuid)
+    # Remove the partial results, unless prepare_build() has already done it
+    try:
+        return uuid_delete(cfg, uuid)
+    except FileNotFoundError:
+        return True
 
 def uuid_delete(cfg, uuid):
     """Delete all of the results from a compose
@@ -662,7 +772,12 @@ def uuid_delete(cfg, uuid):
     for upload in get_uploads(cfg["upload"], uuid_get_uploads(cfg, uuid)):
         delete_upload(cfg["upload"], upload.uuid)
 
+    lib_dir = cfg.get("composer", "lib_dir")
+    index = compose_index(lib_dir)
+    detail = index.get(uuid)
     shutil.rmtree(uuid_dir)
+    index.delete(uuid)
+    publish_compose_event(lib_dir, {"id": uuid, "queue_status": "DELETED"}, detail and detail["queue_status"])
     return True
 
 def uuid_info(cfg, uuid, api=1):
@@ -685,34 +800,46 @@ def uuid_info(cfg, uuid, api=1):
     * deps - The NEVRA of all of the dependencies used in the composition
     * compose_type - The type of output generated (tar, iso, etc.)
     * queue_status - The final status of the composition (FINISHED or FAILED)
+    * image_size - Size of the image, if finished. 0 otherwise.
+    * image_sha256 - SHA-256 of the image, if finished. None otherwise.
+    * cache_hits - The number of later builds that reused this build's image
+    * cached_from - The uuid of the build whose image was reused by this build, or None
     """
     uuid_dir = joinpaths(cfg.get("composer", "lib_dir"), "results", uuid)
     if not os.path.exists(uuid_dir):
         return None
 
-    # Load the compose configuration
-    cfg_path = joinpaths(uuid_dir, "config.toml")
-    if not os.path.exists(cfg_path):
-        raise RuntimeError("Missing config.toml for %s" % uuid)
-    cfg_dict = toml.loads(open(cfg_path, "r").read())
-
-    frozen_path = joinpaths(uuid_dir, "frozen.toml")
-    if not os.path.exists(frozen_path):
-        raise RuntimeError("Missing frozen.toml for %s" % uuid)
-    frozen_dict = toml.loads(open(frozen_path, "r").read())
+    details = compose_detail(cfg, uuid_dir, api)
 
-    deps_path = joinpaths(uuid_dir, "deps.toml")
-    if not os.path.exists(deps_path):
-        raise RuntimeError("Missing deps.toml for %s" % uuid)
-    deps_dict = toml.loads(open(deps_path, "r").read())
+    # PENDING builds have not been depsolved yet, and builds that failed while
+    # being prepared may not have been depsolved either.
+    def read_toml(filename):
+        path = joinpaths(uuid_dir, filename)
+        if not os.path.exists(path):
+            if details["queue_status"] in ("PENDING", "FAILED"):
+                return {}
+            raise RuntimeError("Missing %s for %s" % (filename, uuid))
+        return toml.loads(open(path, "r").read())
 
-    details = compose_detail(cfg, uuid_dir, api)
+    # Load the compose configuration
+    cfg_dict = read_toml("config.toml")
+    frozen_dict = read_toml("frozen.toml")
+    deps_dict = read_toml("deps.toml")
 
     commit_path = joinpaths(uuid_dir, "COMMIT")
     if not os.path.exists(commit_path):
         raise RuntimeError("Missing commit hash for %s" % uuid)
     commit_id = open(commit_path, "r").read().strip()
 
+    try:
+        cache_hits = int(open(joinpaths(uuid_dir, "CACHE_HITS"), "r").read())
+    except (IOError, ValueError):
+        cache_hits = 0
+    try:
+        cached_from = open(joinpaths(uuid_dir, "CACHED_FROM"), "r").read().strip()
+    except IOError:
+        cached_from = None
+
     info = {"id":           uuid,
             "config":       cfg_dict,
             "blueprint":    frozen_dict,
@@ -721,6 +848,9 @@ def uuid_info(cfg, uuid, api=1):
             "compose_type": details["compose_type"],
             "queue_status": details["queue_status"],
             "image_size":   details["image_size"],
+            "image_sha256": details["image_sha256"],
+            "cache_hits":   cache_hits,
+            "cached_from":  cached_from,
     }
     if api == 1:
         upload_uuids = uuid_get_uploads(cfg, uuid)
@@ -728,8 +858,8 @@ def uuid_info(cfg, uuid, api=1):
         info["uploads"] = summaries
     return info
 
-def uuid_tar(cfg, uuid, metadata=False, image=False, logs=False):
-    """Return a tar of the build data
+def uuid_tar_members(cfg, uuid, metadata=False, image=False, logs=False):
+    """Return the files to include in a tar of the build data
 
     :param cfg: Configuration settings
     :type cfg: ComposerConfig
@@ -741,12 +871,12 @@ def uuid_tar(cfg, uuid, metadata=False, image=False, logs=False):
     :type image: bool
     :param logs: Set to true to include the logs from the build
     :type logs: bool
-    :returns: A stream of bytes from tar
-    :rtype: A generator
+    :returns: The tar headers, paths, and sizes of the files
+    :rtype: list of (bytes, str, int) tuples
     :raises: RuntimeError if there was a problem (eg. missing config file)
 
-    This yields an uncompressed tar's data to the caller. It includes
-    the selected data to the caller by returning the Popen stdout from the tar process.
+    See `pylorax.api.utils.tar_file_members()`. Use `tar_file_stream()` to make the
+    archive, and `tar_file_size()` to get its size.
     """
     uuid_dir = joinpaths(cfg.get("composer", "lib_dir"), "results", uuid)
     if not os.path.exists(uuid_dir):
@@ -765,10 +895,9 @@ def uuid_tar(cfg, uuid, metadata=False, image=False, logs=False):
         if f.endswith(image_name):
             return image
         return metadata
-    filenames = [os.path.basename(f) for f in glob(joinpaths(uuid_dir, "*")) if include_file(f)]
+    filenames = sorted(os.path.basename(f) for f in glob(joinpaths(uuid_dir, "*")) if include_file(f))
 
-    tar = Popen(["tar", "-C", uuid_dir, "-cf-"] + filenames, stdout=PIPE)
-    return tar.stdout
+    return tar_file_members(uuid_dir, filenames)
 
 def uuid_image(cfg, uuid):
     """Return the filename and full path of the build's image file
@@ -784,80 +913,99 @@ def uuid_image(cfg, uuid):
     uuid_dir = joinpaths(cfg.get("composer", "lib_dir"), "results", uuid)
     return get_image_name(uuid_dir)
 
-def get_image_name(uuid_dir):
-    """Return the filename and full path of the build's image file
+def uuid_image_checksum(cfg, uuid):
+    """Return the stored SHA-256 of the build's image
 
+    :param cfg: Configuration settings
+    :type cfg: ComposerConfig
     :param uuid: The UUID of the build
     :type uuid: str
-    :returns: The image filename and full path
-    :rtype: tuple of strings
-    :raises: RuntimeError if there was a problem (eg. invalid uuid, missing config file)
+    :returns: The hex digest of the image, or None if it has not been stored
+    :rtype: str or None
     """
-    uuid = os.path.basename(os.path.abspath(uuid_dir))
-    if not os.path.exists(uuid_dir):
-        raise RuntimeError("%s is not a valid build_id" % uuid)
-
-    # Load the compose configuration
-    cfg_path = joinpaths(uuid_dir, "config.toml")
-    if not os.path.exists(cfg_path):
-        raise RuntimeError("Missing config.toml for %s" % uuid)
-    cfg_dict = toml.loads(open(cfg_path, "r").read())
-    image_name = cfg_dict["image_name"]
-
-    return (image_name, joinpaths(uuid_dir, image_name))
+    return read_image_checksum(joinpaths(cfg.get("composer", "lib_dir"), "results", uuid))
 
-def uuid_log(cfg, uuid, size=1024):
-    """Return `size` KiB from the end of the most currently relevant log for a
-    given compose
+def uuid_log_path(cfg, uuid):
+    """Return the path to the most currently relevant log for a given compose
 
     :param cfg: Configuration settings
     :type cfg: ComposerConfig
     :param uuid: The UUID of the build
     :type uuid: str
-    :param size: Number of KiB to read. Default is 1024
-    :type size: int
-    :returns: Up to `size` KiB from the end of the log
-    :rtype: str
-    :raises: RuntimeError if there was a problem (eg. no log file available)
+    :returns: The path to the log, and True if the build is running
+    :rtype: tuple of (str, bool)
+    :raises: RuntimeError if the build_id or its status is missing
 
-    This function will return the end of either the anaconda log, the packaging
-    log, or the combined composer logs, depending on the progress of the
-    compose. It tries to return lines from the end of the log, it will attempt
-    to start on a line boundary, and it may return less than `size` kbytes.
+    This returns either the anaconda log, the packaging log, or the combined
+    composer logs, depending on the progress of the compose. The log may not
+    exist yet.
     """
     uuid_dir = joinpaths(cfg.get("composer", "lib_dir"), "results", uuid)
     if not os.path.exists(uuid_dir):
         raise RuntimeError("%s is not a valid build_id" % uuid)
 
-    # While a build is running the logs will be in /tmp/anaconda.log and when it
-    # has finished they will be in the results directory
+    # While a build is running the logs will be in the compose's private anaconda /tmp
+    # directory and when it has finished they will be in the results directory
     status = uuid_status(cfg, uuid)
     if status is None:
         raise RuntimeError("Status is missing for %s" % uuid)
+    running = status["queue_status"] == "RUNNING"
+
+    # Try to return the most relevant log at any given time during the
+    # compose. If the compose is not running, return the composer log.
+    anaconda_tmp = joinpaths(compose_tmp_dir(cfg.get("composer", "tmp"), uuid), "tmp")
+    anaconda_log = joinpaths(anaconda_tmp, "anaconda.log")
+    packaging_log = joinpaths(anaconda_tmp, "packaging.log")
+    combined_log = joinpaths(uuid_dir, "logs", "combined.log")
+    if not running or not os.path.isfile(anaconda_log):
+        return (combined_log, running)
+    if not os.path.isfile(packaging_log):
+        return (anaconda_log, running)
+    try:
+        anaconda_mtime = os.stat(anaconda_log).st_mtime
+        packaging_mtime = os.stat(packaging_log).st_mtime
+        # If the packaging log exists and its last message is at least 15
+        # seconds newer than the anaconda log, return the packaging log.
+        if packaging_mtime > anaconda_mtime + 15:
+            return (packaging_log, running)
+        return (anaconda_log, running)
+    except OSError:
+        # Return the combined log if anaconda_log or packaging_log disappear
+        return (combined_log, running)
+
+def uuid_log_read(cfg, uuid, log_name=None, offset=None, size=1024):
+    """Return the most currently relevant log for a given compose, after an offset
 
-    def get_log_path():
-        # Try to return the most relevant log at any given time during the
-        # compose. If the compose is not running, return the composer log.
-        anaconda_log = "/tmp/anaconda.log"
-        packaging_log = "/tmp/packaging.log"
-        combined_log = joinpaths(uuid_dir, "logs", "combined.log")
-        if status["queue_status"] != "RUNNING" or not os.path.isfile(anaconda_log):
-            return combined_log
-        if not os.path.isfile(packaging_log):
-            return anaconda_log
-        try:
-            anaconda_mtime = os.stat(anaconda_log).st_mtime
-            packaging_mtime = os.stat(packaging_log).st_mtime
-            # If the packaging log exists and its last message is at least 15
-            # seconds newer than the anaconda log, return the packaging log.
-            if packaging_mtime > anaconda_mtime + 15:
-                return packaging_log
-            return anaconda_log
-        except OSError:
-            # Return the combined log if anaconda_log or packaging_log disappear
-            return combined_log
+    :param cfg: Configuration settings
+    :type cfg: ComposerConfig
+    :param uuid: The UUID of the build
+    :type uuid: str
+    :param log_name: The name of the log the offset is for, eg. anaconda.log
+    :type log_name: str
+    :param offset: The offset returned by the previous call, or None
+    :type offset: int
+    :param size: Maximum number of KiB to read. Default is 1024
+    :type size: int
+    :returns: The text, the name of the log, and the offset to pass to the next call
+    :rtype: tuple of (str, str, int)
+    :raises: RuntimeError if there was a problem (eg. no log file available)
+
+    Clients that pass the log name and offset from the previous call only read the
+    new part of the log. If there is no offset, it is past the end of the log,
+    or the most relevant log has changed, it returns up to `size` KiB from the end
+    of the log, starting on a line boundary. While the build is running it only
+    returns complete lines.
+    """
+    log_path, running = uuid_log_path(cfg, uuid)
+    name = os.path.basename(log_path)
     try:
-        tail = read_tail(get_log_path(), size)
+        start = offset
+        if name != log_name or offset is None or offset > os.path.getsize(log_path):
+            start = max(0, os.path.getsize(log_path) - 1024 * size)
+        text, next_offset = read_lines(log_path, start, size, complete=running)
     except OSError as e:
         raise RuntimeError("No log available.") from e
-    return tail
+    if start != offset and start > 0:
+        # Skip the partial line at the start of the tail
+        text = text[text.find("\n") + 1:]
+    return (text, name, next_offset)
@@ -21,9 +21,13 @@ from gi.repository import Ggit as Git
 from gi.repository import Gio
 from gi.repository import GLib
 
+from collections import OrderedDict
+from copy import deepcopy
 import os
 import semantic_version as semver
+from threading import Lock
 
+from pylorax.api.commitdb import CommitIndex
 from pylorax.api.projects import dep_evra
 from pylorax.base import DataHolder
 from pylorax.sysutils import joinpaths
@@ -161,9 +165,9 @@ class Recipe(dict):
         :returns: A new Recipe object
         :rtype: Recipe
         """
-        module_names = self.module_names
-        package_names = self.package_names
-        group_names = self.group_names
+        module_names = set(self.module_names)
+        package_names = set(self.package_names)
+        group_names = set(self.group_names)
 
         new_modules = []
         new_packages = []
@@ -554,6 +558,23 @@ def write_commit(repo, branch, filename, message, content):
     :rtype: Git.OId
     :raises: Can raise errors from Ggit
     """
+    return write_files_commit(repo, branch, {filename: content}, message)
+
+def write_files_commit(repo, branch, files, message):
+    """Make a new commit of several files to a repository's branch
+
+    :param repo: Open repository
+    :type repo: Git.Repository
+    :param branch: Branch name
+    :type branch: str
+    :param files: The data to write to each filename
+    :type files: dict
+    :param message: The commit message
+    :type message: str
+    :returns: OId of the new commit
+    :rtype: Git.OId
+    :raises: Can raise errors from Ggit
+    """
     try:
         parent_commit = head_commit(repo, branch)
     except GLib.GError:
@@ -563,14 +584,17 @@ def write_commit(repo, branch, filename, message, content):
         parent_commit = head_commit(repo, branch)
 
     parent_commit = head_commit(repo, branch)
-    blob_id = repo.create_blob_from_buffer(content.encode("UTF-8"))
 
-    # Use treebuilder to make a new entry for this filename and blob
+    # Use treebuilder to make a new entry for each filename and blob
     parent_tree = parent_commit.get_tree()
     builder = repo.create_tree_builder_from_tree(parent_tree)
-    builder.insert(filename, blob_id, Git.FileMode.BLOB)
+    for filename in sorted(files):
+        blob_id = repo.create_blob_from_buffer(files[filename].encode("UTF-8"))
+        builder.insert(filename, blob_id, Git.FileMode.BLOB)
     (tree, sig, ref) = prepare_commit(repo, branch, builder)
-    return repo.create_commit(ref, sig, sig, "UTF-8", message, tree, [parent_commit])
+    commit_id = repo.create_commit(ref, sig, sig, "UTF-8", message, tree, [parent_commit])
+    update_commit_index(repo, branch)
+    return commit_id
 
 def read_commit_spec(repo, spec):
     """Return the raw content of the blob specified by the spec
@@ -607,13 +631,117 @@ def read_commit(repo, branch, filename, commit=None):
     If no commit is passed the master:filename is returned, otherwise it will be
     commit:filename
     """
+    commit = file_commit(repo, branch, filename, commit)
+    return (commit, read_commit_spec(repo, "%s:%s" % (commit, filename)))
+
+def file_commit(repo, branch, filename, commit=None):
+    """Return the commit to read a file from
+
+    :param repo: Open repository
+    :type repo: Git.Repository
+    :param branch: Branch name
+    :type branch: str
+    :param filename: filename to read
+    :type filename: str
+    :param commit: Optional commit hash
+    :type commit: str
+    :returns: The commit, or the most recent commit of the file if commit is None
+    :rtype: str
+    :raises: RecipeError if the file has no commits on the branch
+    """
     if not commit:
         # Find the most recent commit for filename on the selected branch
         commits = list_commits(repo, branch, filename, 1)
         if not commits:
             raise RecipeError("No commits for %s on the %s branch." % (filename, branch))
         commit = commits[0].commit
-    return (commit, read_commit_spec(repo, "%s:%s" % (commit, filename)))
+    return commit
+
+class RecipeCache(object):
+    """A LRU cache of parsed Recipe objects
+
+    Parsing and checking a blueprint takes much longer than copying it, so the
+    recipes are kept under a key that changes when the file does, eg. its git blob
+    id. Copies are stored and returned so that the callers can modify them.
+    """
+    def __init__(self, max_size=256):
+        self._lock = Lock()
+        self._recipes = OrderedDict()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return a copy of the cached recipe for key, or None
+
+        :param key: The key the recipe was stored under
+        :returns: A Recipe object or None
+        :rtype: Recipe or None
+        """
+        with self._lock:
+            if key not in self._recipes:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._recipes.move_to_end(key)
+            recipe = self._recipes[key]
+        return deepcopy(recipe)
+
+    def put(self, key, recipe):
+        """Store a copy of a recipe, removing the least recently used ones if it is full
+
+        :param key: The key to store the recipe under
+        :param recipe: The recipe
+        :type recipe: Recipe
+        :returns: None
+        """
+        recipe = deepcopy(recipe)
+        with self._lock:
+            self._recipes[key] = recipe
+            self._recipes.move_to_end(key)
+            while len(self._recipes) > max(self.max_size, 0):
+                self._recipes.popitem(last=False)
+
+    def clear(self):
+        """Remove all of the cached recipes"""
+        with self._lock:
+            self._recipes.clear()
+
+    def stats(self):
+        """Return the cache statistics
+
+        :returns: The hits, misses, current size, and maximum size of the cache
+        :rtype: dict
+        """
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "size": len(self._recipes),
+                    "max_size": self.max_size}
+
+# The recipes read from git, by blob id
+RECIPE_CACHE = RecipeCache()
+
+def read_recipe_spec(repo, spec):
+    """Return the Recipe from the blob specified by the spec
+
+    :param repo: Open repository
+    :type repo: Git.Repository
+    :param spec: Git revparse spec
+    :type spec: str
+    :returns: A Recipe object
+    :rtype: Recipe
+    :raises: Can raise errors from Ggit, TomlError, or RecipeError
+
+    The blob is only read and parsed if it is not in RECIPE_CACHE.
+    """
+    blob_id = repo.revparse(spec).get_id()
+    recipe = RECIPE_CACHE.get(blob_id.to_string())
+    if recipe is None:
+        blob = repo.lookup(blob_id, Git.Blob)
+        recipe = recipe_from_toml(blob.get_raw_content())
+        RECIPE_CACHE.put(blob_id.to_string(), recipe)
+    return recipe
 
 def read_recipe_commit(repo, branch, recipe_name, commit=None):
     """Read a recipe commit from git and return a Recipe object
@@ -636,8 +764,8 @@ def read_recipe_commit(repo, branch, recipe_name, commit=None):
     if not repo_file_exists(repo, branch, recipe_filename(recipe_name)):
         raise RecipeFileError("Unknown blueprint")
 
-    (_, recipe_toml) = read_commit(repo, branch, recipe_filename(recipe_name), commit)
-    return recipe_from_toml(recipe_toml)
+    (_, recipe) = read_recipe_and_id(repo, branch, recipe_name, commit)
+    return recipe
 
 def read_recipe_and_id(repo, branch, recipe_name, commit=None):
     """Read a recipe commit and its id from git
@@ -657,8 +785,9 @@ def read_recipe_and_id(repo, branch, recipe_name, commit=None):
     If no commit is passed the master:filename is returned, otherwise it will be
     commit:filename
     """
-    (commit_id, recipe_toml) = read_commit(repo, branch, recipe_filename(recipe_name), commit)
-    return (commit_id, recipe_from_toml(recipe_toml))
+    filename = recipe_filename(recipe_name)
+    commit_id = file_commit(repo, branch, filename, commit)
+    return (commit_id, read_recipe_spec(repo, "%s:%s" % (commit_id, filename)))
 
 def list_branch_files(repo, branch):
     """Return a sorted list of the files on the branch HEAD
@@ -724,7 +853,9 @@ def delete_file(repo, branch, filename):
     builder.remove(filename)
     (tree, sig, ref) = prepare_commit(repo, branch, builder)
     message = "Recipe %s deleted" % filename
-    return repo.create_commit(ref, sig, sig, "UTF-8", message, tree, [parent_commit])
+    commit_id = repo.create_commit(ref, sig, sig, "UTF-8", message, tree, [parent_commit])
+    update_commit_index(repo, branch)
+    return commit_id
 
 def revert_recipe(repo, branch, recipe_name, commit):
     """Revert the contents of a recipe to that of a previous commit
@@ -772,7 +903,9 @@ def revert_file(repo, branch, filename, commit):
     (tree, sig, ref) = prepare_commit(repo, branch, builder)
     commit_hash = commit_id.to_string()
     message = "%s reverted to commit %s" % (filename, commit_hash)
-    return repo.create_commit(ref, sig, sig, "UTF-8", message, tree, [parent_commit])
+    commit_id = repo.create_commit(ref, sig, sig, "UTF-8", message, tree, [parent_commit])
+    update_commit_index(repo, branch)
+    return commit_id
 
 def commit_recipe(repo, branch, recipe):
     """Commit a recipe to a branch
@@ -798,6 +931,62 @@ def commit_recipe(repo, branch, recipe):
     message = "Recipe %s, version %s saved." % (recipe["name"], recipe["version"])
     return write_commit(repo, branch, recipe.filename, message, recipe_toml)
 
+def commit_recipes(repo, branch, recipes):
+    """Commit several recipes to a branch in one commit
+
+    :param repo: Open repository
+    :type repo: Git.Repository
+    :param branch: Branch name
+    :type branch: str
+    :param recipes: Recipes to commit
+    :type recipes: list of Recipe
+    :returns: OId of the new commit, or None if none of the recipes changed
+    :rtype: Git.OId or None
+    :raises: Can raise errors from Ggit
+
+    The version of each recipe is bumped the same way as commit_recipe() does it.
+    Recipes that are the same as the one on the branch, and do not set a new
+    version, are skipped so that importing the same recipes again does not make
+    a new commit.
+    """
+    files = {}
+    saved = []
+    for recipe in recipes:
+        try:
+            old_recipe = read_recipe_commit(repo, branch, recipe["name"])
+        except Exception:
+            old_recipe = None
+
+        if old_recipe is not None and recipe.get("version") in (None, "", old_recipe["version"]) \
+           and dict(recipe, version=None) == dict(old_recipe, version=None):
+            continue
+
+        recipe.bump_version(old_recipe["version"] if old_recipe else None)
+        files[recipe.filename] = recipe.toml()
+        saved.append("%s, version %s" % (recipe["name"], recipe["version"]))
+
+    if not files:
+        return None
+    message = "%d recipes saved.\n\n%s\n" % (len(saved), "\n".join(sorted(saved)))
+    return write_files_commit(repo, branch, files, message)
+
+def read_branch_recipes(repo, branch):
+    """Read all of the recipes on a branch
+
+    :param repo: Open repository
+    :type repo: Git.Repository
+    :param branch: Branch name
+    :type branch: str
+    :returns: The recipes, sorted by filename
+    :rtype: list of Recipe
+    :raises: Can raise errors from Ggit, TomlError, or RecipeError
+
+    All of the recipes are read from the same commit, the branch's head.
+    """
+    commit = head_commit(repo, branch).get_id().to_string()
+    return [read_recipe_spec(repo, "%s:%s" % (commit, f))
+            for f in list_commit_files(repo, commit) if f.endswith(".toml")]
+
 def commit_recipe_file(repo, branch, filename):
     """Commit a recipe file to a branch
 
@@ -882,23 +1071,23 @@ def tag_file_commit(repo, branch, filename):
     Revisions start at 1 and increment for each new commit that is tagged.
     If the commit has already been tagged it will return false.
     """
-    file_commits = list_commits(repo, branch, filename)
+    file_commits = list_commits(repo, branch, filename, limit=1)
     if not file_commits:
         return None
 
-    # Find the most recently tagged version (may not be one) and add 1 to it.
-    for details in file_commits:
-        if details.revision is not None:
-            new_revision = details.revision + 1
-            break
-    else:
-        new_revision = 1
+    # Find the highest tagged revision of the file (may not be one) and add 1 to it.
+    revisions = [get_revision_from_tag(t) for t in repo.list_tags_match("%s/%s/r*" % (branch, filename))]
+    new_revision = max([r for r in revisions if r is not None], default=0) + 1
 
     name = "%s/%s/r%d" % (branch, filename, new_revision)
     sig = Git.Signature.new_now("bdcs-api-server", "user-email")
     commit_id = Git.OId.new_from_string(file_commits[0].commit)
     commit = repo.lookup(commit_id, Git.Commit)
-    return repo.create_tag(name, commit, sig, name, Git.CreateFlags.NONE)
+    tag_id = repo.create_tag(name, commit, sig, name, Git.CreateFlags.NONE)
+
+    # This is the commit's highest revision, see tag_revisions()
+    commit_index(repo).set_revision(branch, filename, file_commits[0].commit, new_revision)
+    return tag_id
 
 def find_commit_tag(repo, branch, filename, commit_id):
     """Find the tag that matches the commit_id
@@ -969,7 +1158,7 @@ class CommitDetails(DataHolder):
                             message = message,
                             revision = revision)
 
-def list_commits(repo, branch, filename, limit=0):
+def list_commits(repo, branch, filename, limit=0, offset=0):
     """List the commit history of a file on a branch.
 
     :param repo: Open repository
@@ -980,13 +1169,183 @@ def list_commits(repo, branch, filename, limit=0):
     :type filename: str
     :param limit: Number of commits to return (0=all)
     :type limit: int
-    :returns: A list of commit details
+    :param offset: Number of commits to skip
+    :type offset: int
+    :returns: A list of commit details, newest first
     :rtype: list(CommitDetails)
     :raises: Can raise errors from Ggit
+
+    The commits are read from the commit index, see current_commit_index()
+    """
+    index = current_commit_index(repo, branch)
+
+    commits = []
+    for (commit_id, commit_time, utc_offset, message, revision) in index.list(branch, filename, offset, limit):
+        try:
+            commits.append(CommitDetails(commit_id, format_commit_time(commit_time, utc_offset), message, revision))
+        except CommitTimeValError:
+            # Skip any commits that have trouble converting the time
+            # TODO - log details about this failure
+            pass
+    return commits
+
+def count_commits(repo, branch, filename):
+    """Return the number of commits that changed a file on a branch
+
+    :param repo: Open repository
+    :type repo: Git.Repository
+    :param branch: Branch name
+    :type branch: str
+    :param filename: filename
+    :type filename: str
+    :returns: The number of commits
+    :rtype: int
+    :raises: Can raise errors from Ggit
+    """
+    return current_commit_index(repo, branch).count(branch, filename)
+
+def commit_index(repo):
+    """Return the commit history index for the repository
+
+    :param repo: Open repository
+    :type repo: Git.Repository
+    :returns: The commit index, stored in the git directory
+    :rtype: CommitIndex
+    """
+    return CommitIndex(joinpaths(repo.get_location().get_path(), "commits.db"))
+
+def branch_head_id(repo, branch):
+    """Return the id of the branch's head commit, without reading the commit
+
+    :param repo: Open repository
+    :type repo: Git.Repository
+    :param branch: Branch name
+    :type branch: str
+    :returns: The commit id
+    :rtype: str
+    :raises: Can raise errors from Ggit
+    """
+    return repo.lookup_branch(branch, Git.BranchType.LOCAL).get_target().to_string()
+
+def current_commit_index(repo, branch):
+    """Return the commit history index, for reading the branch's commits
+
+    :param repo: Open repository
+    :type repo: Git.Repository
+    :param branch: Branch name
+    :type branch: str
+    :returns: The commit index
+    :rtype: CommitIndex
+    :raises: Can raise errors from Ggit
+
+    The commits made by the API update the index, so this only compares the indexed
+    head with the branch's head. It is only updated here when the branch has been
+    changed some other way, eg. reset with git, or when it has not been indexed yet.
+    """
+    index = commit_index(repo)
+    if index.is_current(branch, branch_head_id(repo, branch)):
+        return index
+    return update_commit_index(repo, branch)
+
+def update_commit_index(repo, branch):
+    """Add the branch's new commits to the commit history index
+
+    :param repo: Open repository
+    :type repo: Git.Repository
+    :param branch: Branch name
+    :type branch: str
+    :returns: The commit index
+    :rtype: CommitIndex
+    :raises: Can raise errors from Ggit
+
+    Only the commits since the last update are read. If the indexed head is not an
+    ancestor of the branch's head, eg. it has been reset or it has diverged, it is
+    indexed again from the start. The revisions of the tags are only read then, after
+    that tag_file_commit() updates them.
+
+    This is called after each commit is made, while holding the git lock. The update
+    is made while holding the index's exclusive lock, the readers only hold the git
+    lock's shared lock and may be updating it too, see current_commit_index().
+    """
+    index = commit_index(repo)
+    head_id = branch_head_id(repo, branch)
+    if index.is_current(branch, head_id):
+        return index
+
+    with index.updating():
+        (indexed_id, seq) = index.get_head(branch)
+        if indexed_id == head_id:
+            return index
+
+        if indexed_id and is_ancestor(repo, indexed_id, head_id):
+            new_commits = walk_commits(repo, branch, indexed_id)
+        else:
+            new_commits = None
+        replace = new_commits is None
+        if replace:
+            seq = 0
+            new_commits = walk_commits(repo, branch)
+            revisions = tag_revisions(repo, branch)
+        else:
+            revisions = {}
+
+        # walk_commits returns the newest commit first
+        rows = []
+        for commit_seq, (commit, filenames) in zip(range(seq + len(new_commits), seq, -1), new_commits):
+            commit_id = commit.get_id().to_string()
+            commit_time = commit.get_committer().get_time()
+            for filename in filenames:
+                rows.append((filename, commit_seq, commit_id, commit_time.to_unix(),
+                             commit_time.get_utc_offset() // 1000000, commit.get_message(),
+                             revisions.get((filename, commit_id))))
+        index.add(branch, head_id, seq + len(new_commits), rows, replace)
+    return index
+
+def is_ancestor(repo, ancestor_id, commit_id):
+    """Check to see if a commit is an ancestor of another one
+
+    :param repo: Open repository
+    :type repo: Git.Repository
+    :param ancestor_id: The possible ancestor's commit id
+    :type ancestor_id: str
+    :param commit_id: The commit id
+    :type commit_id: str
+    :returns: True if ancestor_id is commit_id, or one of its ancestors
+    :rtype: bool
+    """
+    try:
+        base = repo.merge_base(Git.OId.new_from_string(ancestor_id), Git.OId.new_from_string(commit_id))
+    except GLib.GError:
+        # The commit is not in the repository anymore, or they have no common ancestor
+        return False
+    return base is not None and base.to_string() == ancestor_id
+
+def walk_commits(repo, branch, since=None):
+    """Return the files changed by each commit on the branch
+
+    :param repo: Open repository
+    :type repo: Git.Repository
+    :param branch: Branch name
+    :type branch: str
+    :param since: Only return the commits after this commit id
+    :type since: str
+    :returns: The commits, newest first, and the files each one changed, or None
+    :rtype: list of (Git.Commit, list of str) tuples
+    :raises: Can raise errors from Ggit
+
+    A file is changed by a commit if it is in the commit's tree, and is different
+    in all of its parents. If since is not in the repository None is returned, use
+    `is_ancestor()` to check that it is an ancestor of the branch first. The first
+    commit, without any parents, is not included.
     """
     revwalk = Git.RevisionWalker.new(repo)
-    branch_ref = "refs/heads/%s" % branch
-    revwalk.push_ref(branch_ref)
+    revwalk.push_ref("refs/heads/%s" % branch)
+    if since:
+        try:
+            revwalk.hide(Git.OId.new_from_string(since))
+        except GLib.GError:
+            # The commit is not in the repository anymore
+            return None
 
     commits = []
     while True:
@@ -996,34 +1355,77 @@ def list_commits(repo, branch, filename, limit=0):
         commit = repo.lookup(commit_id, Git.Commit)
 
         parents = commit.get_parents()
-        # No parents? Must be the first commit.
+        # No parents? Must be the first commit, which should have been hidden
         if parents.get_size() == 0:
+            if since:
+                return None
             continue
 
         tree = commit.get_tree()
-        # Is the filename in this tree? If not, move on.
-        if not tree.get_by_name(filename):
-            continue
+        parent_trees = [parents.get(i).get_tree() for i in range(0, parents.get_size())]
+        filenames = []
+        for i in range(0, tree.size()):
+            entry = tree.get(i)
+            if all(is_entry_diff(entry, pt) for pt in parent_trees):
+                filenames.append(entry.get_name())
+        commits.append((commit, filenames))
 
-        # Is filename different in all of the parent commits?
-        parent_commits = list(map(parents.get, range(0, parents.get_size())))
-        is_diff = all([is_parent_diff(repo, filename, tree, pc) for pc in parent_commits])
-        # No changes from parents, skip it.
-        if not is_diff:
-            continue
+    return commits
 
-        tag = find_commit_tag(repo, branch, filename, commit.get_id())
-        try:
-            commits.append(get_commit_details(commit, get_revision_from_tag(tag)))
-            if limit and len(commits) > limit:
-                break
-        except CommitTimeValError:
-            # Skip any commits that have trouble converting the time
-            # TODO - log details about this failure
-            pass
+def is_entry_diff(entry, tree):
+    """Check to see if a tree entry is different in another tree
 
-    # These will be in reverse time sort order thanks to revwalk
-    return commits
+    :param entry: The entry to check
+    :type entry: Git.TreeEntry
+    :param tree: The tree to compare it with
+    :type tree: Git.Tree
+    :returns: True if the tree does not have the entry, or its contents are different
+    :rtype: bool
+    """
+    other = tree.get_by_name(entry.get_name())
+    return other is None or entry.get_id().compare(other.get_id()) != 0
+
+def tag_revisions(repo, branch):
+    """Return the revision of each tagged file commit on the branch
+
+    :param repo: Open repository
+    :type repo: Git.Repository
+    :param branch: Branch name
+    :type branch: str
+    :returns: The revision for each (filename, commit id)
+    :rtype: dict
+
+    Each tag is only read once. A commit with more than one tag has the highest of
+    their revisions, the same as tag_file_commit() sets when it tags it again.
+    """
+    tags = {}
+    prefix = "%s/" % branch
+    for tag in repo.list_tags_match("%s*/r*" % prefix):
+        filename = tag[len(prefix):tag.rindex("/r")]
+        ref = repo.lookup_reference("refs/tags/" + tag)
+        target_id = repo.lookup(ref.get_target(), Git.Tag).get_target_id().to_string()
+        revision = get_revision_from_tag(tag)
+        if revision is not None:
+            tags[(filename, target_id)] = max(revision, tags.get((filename, target_id), 0))
+    return tags
+
+def format_commit_time(commit_time, utc_offset):
+    """Return the ISO 8601 string for a commit time
+
+    :param commit_time: Seconds since the epoch
+    :type commit_time: int
+    :param utc_offset: The committer's offset from UTC, in seconds
+    :type utc_offset: int
+    :returns: The time in ISO 8601 format
+    :rtype: str
+    :raises: CommitTimeValError
+    """
+    datetime = GLib.DateTime.new_from_unix_utc(commit_time)
+    datetime = datetime.to_timezone(GLib.TimeZone.new_offset(utc_offset))
+    time_str = datetime.format_iso8601()
+    if not time_str:
+        raise CommitTimeValError
+    return time_str
 
 def get_commit_details(commit, revision=None):
     """Return the details about a specific commit.
@@ -1092,6 +1494,25 @@ def find_field_value(field, value, lst):
             return d
     return None
 
+def index_field_value(field, lst):
+    """Return a dict of the dicts in the list, keyed by the value of a field
+
+    :param field: field to use as the key
+    :type field: str
+    :param lst: List of dict's with field
+    :type lst: list of dict
+    :returns: The first dict with each value of field
+    :rtype: dict
+
+    Looking up each value in the returned dict gives the same result as
+    find_field_value, without searching the list each time.
+    """
+    index = {}
+    for d in lst:
+        if d.get(field):
+            index.setdefault(d[field], d)
+    return index
+
 def find_name(name, lst):
     """Find the dict matching the name in a list and return it.
 
@@ -1151,6 +1572,8 @@ def diff_lists(title, field, old_items, new_items):
     diffs = []
     old_fields= set(m[field] for m in old_items)
     new_fields= set(m[field] for m in new_items)
+    old_index = index_field_value(field, old_items)
+    new_index = index_field_value(field, new_items)
 
     added_items = new_fields.difference(old_fields)
     added_items = sorted(added_items, key=lambda n: n.lower())
@@ -1163,15 +1586,15 @@ def diff_lists(title, field, old_items, new_items):
 
     for v in added_items:
         diffs.append({"old":None,
-                      "new":{title:find_field_value(field, v, new_items)}})
+                      "new":{title:new_index.get(v)}})
 
     for v in removed_items:
-        diffs.append({"old":{title:find_field_value(field, v, old_items)},
+        diffs.append({"old":{title:old_index.get(v)},
                       "new":None})
 
     for v in same_items:
-        old_item = find_field_value(field, v, old_items)
-        new_item = find_field_value(field, v, new_items)
+        old_item = old_index.get(v)
+        new_item = new_index.get(v)
         if old_item != new_item:
             diffs.append({"old":{title:old_item},
                           "new":{title:new_item}})
@@ -1209,9 +1632,10 @@ def customizations_diff(old_recipe, new_recipe):
         if type(new_recipe["customizations"][v]) == type([]):
             # Lists of dicts need to use diff_lists
             # sshkey uses 'user', user and group use 'name'
-            if "user" in new_recipe["customizations"][v][0]:
+            first = (new_recipe["customizations"][v] or old_recipe["customizations"][v] or [{}])[0]
+            if "user" in first:
                 field_name = "user"
-            elif "name" in new_recipe["customizations"][v][0]:
+            elif "name" in first:
                 field_name = "name"
             else:
                 raise RuntimeError("%s list has unrecognized key, not 'name' or 'user'" % "customizations."+v)
@@ -0,0 +1,326 @@
+#
+# Copyright (C) 2020 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Shared cache of the rpms used by the composes
+
+The rpms needed by a compose are downloaded into the cache under lib_dir/rpmcache/
+before it is started, stored under the checksum of the package so that the same
+package from different repositories is only stored once. Each compose gets its own
+repository of hardlinks to the cached rpms, and Anaconda prefers it to the remote
+repositories.
+
+When the cache is larger than the rpm_cache_size setting, in MiB, the least recently
+used rpms are removed. Composes that have already linked them are not affected.
+"""
+import logging
+log = logging.getLogger("lorax-composer")
+
+from contextlib import contextmanager
+import dnf
+import fcntl
+import os
+import shutil
+import subprocess
+from threading import Lock
+import time
+
+from pylorax.api.dnfbase import get_base_object
+from pylorax.api.projects import pkg_to_dep
+from pylorax.sysutils import joinpaths
+
+
+class RPMCache(object):
+    """The cached rpms, stored as <checksum type>-<checksum>.rpm"""
+    def __init__(self, cache_dir, max_size):
+        """Setup the cache
+
+        :param cache_dir: Directory to store the rpms in
+        :type cache_dir: str
+        :param max_size: Maximum size of the cache in bytes
+        :type max_size: int
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self._lock = Lock()
+
+    @contextmanager
+    def _locked(self):
+        """Hold the lock, and a lock on the cache directory for the other lorax-composer processes"""
+        with self._lock:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(self.cache_dir.rstrip("/") + ".lock", "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    @staticmethod
+    def pkg_filename(pkg):
+        """Return the name of the package's file in the cache
+
+        :param pkg: The package
+        :type pkg: dnf.package.Package
+        :returns: The filename, or None if the package has no checksum
+        :rtype: str or None
+        """
+        chksum = pkg.returnIdSum()
+        if not chksum or not chksum[1]:
+            return None
+        return "%s-%s.rpm" % chksum
+
+    def pkg_path(self, pkg):
+        """Return the path to the package's rpm in the cache
+
+        :param pkg: The package
+        :type pkg: dnf.package.Package
+        :returns: The path, the rpm may not be in the cache
+        :rtype: str
+        :raises: RuntimeError if the package has no checksum
+        """
+        filename = self.pkg_filename(pkg)
+        if filename is None:
+            raise RuntimeError("%s has no checksum" % pkg)
+        return joinpaths(self.cache_dir, filename)
+
+    def touch(self, paths):
+        """Mark the cached rpms as used, if they are all in the cache
+
+        :param paths: The paths from `pkg_path()`
+        :type paths: list of str
+        :returns: False if some of them are not in the cache
+        :rtype: bool
+        """
+        with self._locked():
+            if not all(os.path.exists(path) for path in paths):
+                return False
+            # The modification time is the last time the rpm was used
+            now = time.time()
+            for path in paths:
+                os.utime(path, (now, now))
+        return True
+
+    def fetch(self, dbo, pkgs):
+        """Make sure that the packages are in the cache
+
+        :param dbo: dnf base object to download the packages with
+        :type dbo: dnf.Base
+        :param pkgs: The packages
+        :type pkgs: list of dnf.package.Package
+        :returns: The path to each package's rpm in the cache
+        :rtype: list of str
+        :raises: RuntimeError if a package cannot be cached
+        """
+        with self._locked():
+            paths = []
+            missing = []
+            for pkg in pkgs:
+                path = self.pkg_path(pkg)
+                paths.append(path)
+                if not os.path.exists(path):
+                    missing.append((pkg, path))
+
+            log.info("%d of %d packages are in the rpm cache", len(pkgs) - len(missing), len(pkgs))
+            if missing:
+                try:
+                    dbo.download_packages([pkg for pkg, _ in missing])
+                except dnf.exceptions.Error as e:
+                    raise RuntimeError("Failed to download the packages: %s" % str(e))
+
+                for pkg, path in missing:
+                    self._add(dbo, pkg.localPkg(), path)
+
+            # The modification time is the last time the rpm was used
+            now = time.time()
+            for path in paths:
+                os.utime(path, (now, now))
+        return paths
+
+    @staticmethod
+    def _add(dbo, src, path):
+        """Add an rpm to the cache
+
+        Downloaded rpms are moved out of the dnf cache, rpms from local repositories
+        are copied.
+        """
+        tmp_path = path + ".tmp"
+        if os.path.abspath(src).startswith(os.path.abspath(dbo.conf.cachedir) + "/"):
+            shutil.move(src, tmp_path)
+        else:
+            shutil.copy2(src, tmp_path)
+        os.replace(tmp_path, path)
+
+    def size(self):
+        """Return the total size of the cached rpms
+
+        :returns: The size in bytes
+        :rtype: int
+        """
+        return sum(size for _, size, _ in self._entries())
+
+    def _entries(self):
+        """Return the path, size, and last use of each rpm, oldest first"""
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for f in os.scandir(self.cache_dir):
+            if not f.name.endswith(".rpm"):
+                continue
+            st = f.stat()
+            entries.append((f.path, st.st_size, st.st_mtime))
+        return sorted(entries, key=lambda e: e[2])
+
+    def evict(self):
+        """Remove the least recently used rpms until the cache is smaller than max_size
+
+        :returns: The number of rpms that were removed
+        :rtype: int
+        """
+        with self._locked():
+            entries = self._entries()
+            total = sum(size for _, size, _ in entries)
+            removed = 0
+            for path, size, _ in entries:
+                if total <= self.max_size:
+                    break
+                os.unlink(path)
+                total -= size
+                removed += 1
+            if removed:
+                log.info("Removed %d rpms from the rpm cache, it is now %d bytes", removed, total)
+            return removed
+
+def find_packages(dbo, deps):
+    """Find the packages for the depsolved NEVRAs
+
+    :param dbo: dnf base object
+    :type dbo: dnf.Base
+    :param deps: The dependencies from deps.toml
+    :type deps: list of dicts
+    :returns: The packages, in the same order as deps
+    :rtype: list of dnf.package.Package
+    :raises: RuntimeError if one of them is not available
+    """
+    available = {}
+    for pkg in dbo.sack.query().available().filter(name=sorted(set(d["name"] for d in deps))):
+        dep = pkg_to_dep(pkg)
+        available.setdefault(tuple(dep[k] for k in ("name", "epoch", "version", "release", "arch")), pkg)
+
+    pkgs = []
+    for d in deps:
+        key = (d["name"], int(d["epoch"]), d["version"], d["release"], d["arch"])
+        if key not in available:
+            raise RuntimeError("%s-%s:%s-%s.%s is not available" % key)
+        pkgs.append(available[key])
+    return pkgs
+
+def link_rpms(paths, repo_dir):
+    """Create a repository with links to the rpms
+
+    :param paths: Paths to the rpms
+    :type paths: list of str
+    :param repo_dir: Path of the new repository
+    :type repo_dir: str
+    :returns: None
+    :raises: RuntimeError if createrepo_c fails
+    """
+    os.makedirs(repo_dir, exist_ok=True)
+    for path in paths:
+        dst = joinpaths(repo_dir, os.path.basename(path))
+        if os.path.exists(dst):
+            continue
+        try:
+            os.link(path, dst)
+        except OSError:
+            shutil.copy2(path, dst)
+
+    cmd = ["createrepo_c", repo_dir]
+    log.debug(cmd)
+    try:
+        subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError as e:
+        log.error("Failed to create repo at %s: %s", repo_dir, e.output)
+        raise RuntimeError("Failed to create repo at %s" % repo_dir)
+
+# The RPMCache for each cache directory, created by rpm_cache()
+_rpm_caches = {}
+_rpm_caches_lock = Lock()
+
+def rpm_cache(cfg):
+    """Return the RPMCache for the configuration
+
+    :param cfg: Configuration
+    :type cfg: ComposerConfig
+    :returns: The rpm cache, or None if it is disabled
+    :rtype: RPMCache or None
+
+    The same RPMCache is returned for each call with the same cache directory, so
+    that the builds being prepared share its lock.
+    """
+    max_size = cfg.getint("composer", "rpm_cache_size") * 1024**2
+    if max_size <= 0:
+        return None
+    cache_dir = joinpaths(cfg.get("composer", "lib_dir"), "rpmcache")
+    with _rpm_caches_lock:
+        cache = _rpm_caches.get(cache_dir)
+        if cache is None:
+            cache = RPMCache(cache_dir, max_size)
+            _rpm_caches[cache_dir] = cache
+        cache.max_size = max_size
+    return cache
+
+def create_cache_repo(cfg, dnflock, deps, results_dir):
+    """Create a repository for the build with the cached rpms
+
+    :param cfg: Configuration
+    :type cfg: ComposerConfig
+    :param dnflock: Lock and YumBase for depsolving
+    :type dnflock: YumLock
+    :param deps: The dependencies from deps.toml
+    :type deps: list of dicts
+    :param results_dir: The build's results directory
+    :type results_dir: str
+    :returns: Path to the repository, or "" if the rpm cache is disabled
+    :rtype: str
+    :raises: RuntimeError if the repository cannot be created
+
+    The packages missing from the cache are downloaded first, and after the
+    repository has been created the least recently used rpms are removed if the
+    cache is too large.
+
+    The lock is only held while finding the packages. Downloading them can take a
+    long time, so it is done with a separate dnf.Base object loaded from the
+    metadata cache. If that metadata has been refreshed since the build was
+    depsolved the packages may not be available, and RuntimeError is raised.
+    """
+    cache = rpm_cache(cfg)
+    if cache is None:
+        return ""
+
+    with dnflock.lock:
+        paths = [cache.pkg_path(pkg) for pkg in find_packages(dnflock.dbo, deps)]
+
+    if not cache.touch(paths):
+        try:
+            dbo = get_base_object(cfg, use_cache=True)
+        except dnf.exceptions.Error as e:
+            raise RuntimeError("Failed to load the metadata: %s" % str(e))
+        paths = cache.fetch(dbo, find_packages(dbo, deps))
+
+    repo_dir = joinpaths(results_dir, "cache-repo/")
+    link_rpms(paths, repo_dir)
+    cache.evict()
+    return repo_dir
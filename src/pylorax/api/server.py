@@ -18,12 +18,16 @@ import logging
 log = logging.getLogger("lorax-composer")
 
 from collections import namedtuple
+from contextlib import contextmanager
+import fcntl
 from flask import Flask, jsonify, redirect, send_from_directory
 from glob import glob
 import os
+from threading import Condition, Lock
 import werkzeug
 
 from pylorax import vernum
+from pylorax.api.blocking import call_blocking
 from pylorax.api.errors import HTTP_ERROR
 from pylorax.api.v0 import v0_api
 from pylorax.api.v1 import v1_api
@@ -31,9 +35,153 @@ from pylorax.sysutils import joinpaths
 
 GitLock = namedtuple("GitLock", ["repo", "lock", "dir"])
 
+class RWLock(object):
+    """A lock that can be held by many readers in different processes, or by one writer
+
+    Using it as a context manager takes the exclusive lock, use read() for the
+    shared lock.
+
+    In a process the readers, threads or greenlets, share the lock and a writer
+    waits for all of them to release it. A waiting writer keeps new readers from
+    taking it, so that a stream of readers cannot starve it. If a path is passed
+    the lock is also held on that file with flock, shared while there are readers
+    and exclusive for a writer, so that the processes using the same file, each
+    with its own repository object, can read at the same time.
+
+    The API is served by gevent in the main thread, without monkey patching. Waiting
+    for the lock there would block all of the requests, so the main thread waits in
+    a thread and lets the other greenlets run, see `call_blocking()`.
+    """
+    def __init__(self, path=None):
+        self._cond = Condition(Lock())
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+        # Set while the first reader takes the shared flock
+        self._flocking = False
+        self._path = path
+        self._fd = None
+        self._pid = None
+
+    def _flock(self, operation, blocking=True):
+        """Lock or unlock the file, if there is one
+
+        :returns: False if it is locked by another process and blocking is False
+        :rtype: bool
+        """
+        if self._path is None:
+            return True
+        # flock locks are shared by everything using the same open file, so each
+        # process, eg. after a fork, needs to open it again
+        if self._pid != os.getpid():
+            self._fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o660)
+            self._pid = os.getpid()
+        try:
+            fcntl.flock(self._fd, operation if blocking else operation | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+
+    def _acquire_read(self, blocking):
+        """Take the shared lock, the first reader also takes the shared flock
+
+        :returns: False if it is held by a writer and blocking is False
+        :rtype: bool
+        """
+        with self._cond:
+            while self._writer or self._writers_waiting or self._flocking:
+                if not blocking:
+                    return False
+                self._cond.wait()
+            self._readers += 1
+            if self._readers > 1:
+                return True
+            self._flocking = True
+
+        # Another process may be writing, wait for it without holding up the
+        # release of the lock by the other threads
+        locked = False
+        try:
+            locked = self._flock(fcntl.LOCK_SH, blocking)
+        finally:
+            with self._cond:
+                self._flocking = False
+                if not locked:
+                    self._readers -= 1
+                self._cond.notify_all()
+        return locked
+
+    def _acquire_write(self, blocking):
+        """Take the exclusive lock and flock
+
+        :returns: False if it is held and blocking is False
+        :rtype: bool
+        """
+        with self._cond:
+            if not blocking and (self._writer or self._readers or self._flocking):
+                return False
+            self._writers_waiting += 1
+            try:
+                while self._writer or self._readers or self._flocking:
+                    self._cond.wait()
+            finally:
+                self._writers_waiting -= 1
+            self._writer = True
+
+        locked = False
+        try:
+            locked = self._flock(fcntl.LOCK_EX, blocking)
+        finally:
+            if not locked:
+                with self._cond:
+                    self._writer = False
+                    self._cond.notify_all()
+        return locked
+
+    def acquire_read(self):
+        """Take the shared lock"""
+        if not self._acquire_read(False):
+            call_blocking(self._acquire_read, True, undo=lambda _: self.release_read())
+
+    def release_read(self):
+        """Release the shared lock"""
+        with self._cond:
+            self._readers -= 1
+            if self._readers == 0:
+                self._flock(fcntl.LOCK_UN)
+                self._cond.notify_all()
+
+    def acquire(self):
+        """Take the exclusive lock"""
+        if not self._acquire_write(False):
+            call_blocking(self._acquire_write, True, undo=lambda _: self.release())
+
+    def release(self):
+        """Release the exclusive lock"""
+        with self._cond:
+            self._flock(fcntl.LOCK_UN)
+            self._writer = False
+            self._cond.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    @contextmanager
+    def read(self):
+        """Hold the shared lock for the duration of a with block"""
+        self.acquire_read()
+        try:
+            yield self
+        finally:
+            self.release_read()
+
 server = Flask(__name__)
 
-__all__ = ["server", "GitLock"]
+__all__ = ["server", "GitLock", "RWLock"]
 
 @server.route('/')
 def server_root():
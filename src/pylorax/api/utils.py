@@ -15,6 +15,19 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """ API utility functions
 """
+import logging
+log = logging.getLogger("lorax-composer")
+
+import io
+import os
+import tarfile
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 from pylorax.api.recipes import RecipeError, RecipeFileError, read_recipe_commit
 
 def take_limits(iterable, offset, limit):
@@ -41,9 +54,182 @@ def blueprint_exists(api, branch, blueprint_name):
     :type recipe_name: str
     """
     try:
-        with api.config["GITLOCK"].lock:
+        with api.config["GITLOCK"].lock.read():
             read_recipe_commit(api.config["GITLOCK"].repo, branch, blueprint_name)
 
         return True
     except (RecipeError, RecipeFileError):
         return False
+
+def tar_stream(members):
+    """Return an uncompressed tar archive of files that are in memory
+
+    :param members: The name, contents, and modification time of each file
+    :type members: iterable of (str, bytes, int) tuples
+    :returns: The archive, a file at a time
+    :rtype: generator of bytes
+
+    Nothing is buffered, so the archive can be returned to the client while the
+    files are still being read.
+    """
+    size = 0
+    for name, data, mtime in members:
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(mtime)
+        info.mode = 0o644
+        header = info.tobuf(format=tarfile.PAX_FORMAT)
+        padding = tarfile.NUL * (-len(data) % tarfile.BLOCKSIZE)
+        yield header + data + padding
+        size += len(header) + len(data) + len(padding)
+
+    yield tarfile.NUL * tar_end_size(size)
+
+def tar_end_size(size):
+    """Return the size of the end of a tar archive
+
+    :param size: Size of the archive's members, with their headers and padding
+    :type size: int
+    :returns: Number of NUL bytes to add to the end of the archive
+    :rtype: int
+
+    The end of the archive is two empty blocks, padded to a full record.
+    """
+    size += 2 * tarfile.BLOCKSIZE
+    return 2 * tarfile.BLOCKSIZE + (-size % tarfile.RECORDSIZE)
+
+def tar_file_members(root, names):
+    """Return the tar headers of files and directories on disk
+
+    :param root: The directory the names are relative to
+    :type root: str
+    :param names: The files and directories to include, directories are included recursively
+    :type names: list of str
+    :returns: The header, path, and size of the data of each member
+    :rtype: list of (bytes, str, int) tuples
+
+    The headers are made before anything is sent so that the size of the archive
+    is known, see `tar_file_size()`. Sockets and other special files are skipped.
+    """
+    # The TarFile is only used to make the TarInfo, it is never written to
+    tar = tarfile.TarFile(fileobj=io.BytesIO(), mode="w", format=tarfile.PAX_FORMAT)
+    members = []
+
+    def add(path, arcname):
+        info = tar.gettarinfo(path, arcname)
+        if info is None:
+            return
+        size = info.size if info.isreg() else 0
+        members.append((info.tobuf(tarfile.PAX_FORMAT, tar.encoding, tar.errors), path, size))
+
+    for name in names:
+        path = os.path.join(root, name)
+        add(path, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for f in sorted(dirnames + filenames):
+                    member_path = os.path.join(dirpath, f)
+                    add(member_path, os.path.relpath(member_path, root))
+    return members
+
+def tar_file_size(members):
+    """Return the size of the archive made by `tar_file_stream()`
+
+    :param members: The members from `tar_file_members()`
+    :type members: list of (bytes, str, int) tuples
+    :returns: Size of the archive in bytes
+    :rtype: int
+    """
+    size = sum(len(header) + data_size + (-data_size % tarfile.BLOCKSIZE) for header, _, data_size in members)
+    return size + tar_end_size(size)
+
+def tar_file_stream(members, chunk_size=1024**2):
+    """Return an uncompressed tar archive of files on disk
+
+    :param members: The members from `tar_file_members()`
+    :type members: list of (bytes, str, int) tuples
+    :param chunk_size: Size of the chunks to return
+    :type chunk_size: int
+    :returns: The archive, in chunks of about chunk_size bytes
+    :rtype: generator of bytes
+
+    The small headers and files are gathered into chunks, and at most one chunk
+    is held in memory. If a file has become shorter since its header was made it
+    is padded with zeros, so that the archive is still the size it was expected to be.
+    """
+    pending = []
+    pending_size = 0
+    archive_size = 0
+
+    def add(data):
+        nonlocal pending, pending_size, archive_size
+        pending.append(data)
+        pending_size += len(data)
+        archive_size += len(data)
+        if pending_size >= chunk_size:
+            chunk = b"".join(pending)
+            pending = []
+            pending_size = 0
+            return chunk
+        return None
+
+    for header, path, size in members:
+        chunk = add(header)
+        if chunk:
+            yield chunk
+        if size:
+            with open(path, "rb") as f:
+                remaining = size
+                while remaining > 0:
+                    data = f.read(min(chunk_size, remaining))
+                    if not data:
+                        log.error("%s is shorter than expected, padding it with zeros", path)
+                        data = tarfile.NUL * min(chunk_size, remaining)
+                    remaining -= len(data)
+                    chunk = add(data)
+                    if chunk:
+                        yield chunk
+        chunk = add(tarfile.NUL * (-size % tarfile.BLOCKSIZE))
+        if chunk:
+            yield chunk
+
+    pending.append(tarfile.NUL * tar_end_size(archive_size))
+    yield b"".join(pending)
+
+# The supported compression of the tar archives, and their file extension and mime type
+TAR_COMPRESSION = {
+    "gzip": (".tar.gz", "application/gzip"),
+    "zstd": (".tar.zst", "application/zstd"),
+}
+
+def compress_stream(chunks, compression):
+    """Compress a stream of data
+
+    :param chunks: The data to compress
+    :type chunks: iterable of bytes
+    :param compression: The compression to use, one of TAR_COMPRESSION
+    :type compression: str
+    :returns: The compressed data
+    :rtype: generator of bytes
+    :raises: ValueError if the compression is not supported
+
+    zstd needs the python3-zstandard package.
+    """
+    if compression == "gzip":
+        # wbits of 16 + 15 writes the gzip header and trailer
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif compression == "zstd" and zstandard is not None:
+        compressor = zstandard.ZstdCompressor().compressobj()
+    elif compression == "zstd":
+        raise ValueError("zstd compression is not available, python3-zstandard is not installed")
+    else:
+        raise ValueError("Unknown compression: %s, it must be one of %s" % (compression, ", ".join(sorted(TAR_COMPRESSION))))
+
+    def compress():
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    return compress()
@@ -52,20 +52,24 @@ import logging
 log = logging.getLogger("lorax-composer")
 
 import os
-from flask import jsonify, request, Response, send_file
+from flask import jsonify, request, Response
 from flask import current_app as api
+import gevent
 
 from pylorax.sysutils import joinpaths
 from pylorax.api.checkparams import checkparams
 from pylorax.api.compose import start_build, compose_types
+from pylorax.api.dirwatch import DirWatch, IN_MODIFY
+from pylorax.api.download import file_etag, send_file_range, send_tar, wait_for_change
 from pylorax.api.errors import *                               # pylint: disable=wildcard-import,unused-wildcard-import
 from pylorax.api.flask_blueprint import BlueprintSkip
-from pylorax.api.projects import projects_list, projects_info, projects_depsolve
+from pylorax.api.projects import projects_page, projects_info, projects_depsolve
 from pylorax.api.projects import modules_list, modules_info, ProjectsError, repo_to_source
 from pylorax.api.projects import get_repo_sources, delete_repo_source, new_repo_source
 from pylorax.api.queue import queue_status, build_status, uuid_delete, uuid_status, uuid_info
-from pylorax.api.queue import uuid_tar, uuid_image, uuid_cancel, uuid_log
-from pylorax.api.recipes import list_branch_files, read_recipe_commit, recipe_filename, list_commits
+from pylorax.api.queue import uuid_tar_members, uuid_image, uuid_image_checksum, uuid_cancel, uuid_log_path
+from pylorax.api.queue import uuid_log_read
+from pylorax.api.recipes import list_branch_files, read_recipe_commit, recipe_filename, list_commits, count_commits
 from pylorax.api.recipes import recipe_from_dict, recipe_from_toml, commit_recipe, delete_recipe, revert_recipe
 from pylorax.api.recipes import tag_recipe_commit, recipe_diff, RecipeFileError
 from pylorax.api.regexes import VALID_API_STRING, VALID_BLUEPRINT_NAME
@@ -79,6 +83,9 @@ from pylorax.api.workspace import workspace_read, workspace_write, workspace_del
 # Create the v0 routes Blueprint with skip_routes support
 v0_api = BlueprintSkip("v0_routes", __name__)
 
+# Seconds between checks for a change of the most relevant log when following it
+LOG_FOLLOW_CHECK = 5
+
 @v0_api.route("/blueprints/list")
 def v0_blueprints_list():
     """List the available blueprints on a branch.
@@ -108,7 +115,7 @@ def v0_blueprints_list():
     except ValueError as e:
         return jsonify(status=False, errors=[{"id": BAD_LIMIT_OR_OFFSET, "msg": str(e)}]), 400
 
-    with api.config["GITLOCK"].lock:
+    with api.config["GITLOCK"].lock.read():
         blueprints = [f[:-5] for f in list_branch_files(api.config["GITLOCK"].repo, branch)]
         limited_blueprints = take_limits(blueprints, offset, limit)
     return jsonify(blueprints=limited_blueprints, limit=limit, offset=offset, total=len(blueprints))
@@ -199,7 +206,7 @@ def v0_blueprints_info(blueprint_names):
         exceptions = []
         # Get the workspace version (if it exists)
         try:
-            with api.config["GITLOCK"].lock:
+            with api.config["GITLOCK"].lock.read():
                 ws_blueprint = workspace_read(api.config["GITLOCK"].repo, branch, blueprint_name)
         except Exception as e:
             ws_blueprint = None
@@ -208,7 +215,7 @@ def v0_blueprints_info(blueprint_names):
 
         # Get the git version (if it exists)
         try:
-            with api.config["GITLOCK"].lock:
+            with api.config["GITLOCK"].lock.read():
                 git_blueprint = read_recipe_commit(api.config["GITLOCK"].repo, branch, blueprint_name)
         except RecipeFileError as e:
             # Adding an exception would be redundant, skip it
@@ -332,15 +339,15 @@ def v0_blueprints_changes(blueprint_names):
     for blueprint_name in [n.strip() for n in blueprint_names.split(",")]:
         filename = recipe_filename(blueprint_name)
         try:
-            with api.config["GITLOCK"].lock:
-                commits = list_commits(api.config["GITLOCK"].repo, branch, filename)
+            with api.config["GITLOCK"].lock.read():
+                total = count_commits(api.config["GITLOCK"].repo, branch, filename)
+                commits = list_commits(api.config["GITLOCK"].repo, branch, filename, limit, offset) if limit > 0 else []
         except Exception as e:
             errors.append({"id": BLUEPRINTS_ERROR, "msg": "%s: %s" % (blueprint_name, str(e))})
             log.error("(v0_blueprints_changes) %s", str(e))
         else:
-            if commits:
-                limited_commits = take_limits(commits, offset, limit)
-                blueprints.append({"name":blueprint_name, "changes":limited_commits, "total":len(commits)})
+            if total:
+                blueprints.append({"name":blueprint_name, "changes":commits, "total":total})
             else:
                 # no commits means there is no blueprint in the branch
                 errors.append({"id": UNKNOWN_BLUEPRINT, "msg": "%s" % blueprint_name})
@@ -632,34 +639,30 @@ def v0_blueprints_diff(blueprint_name, from_commit, to_commit):
     if not blueprint_exists(api, branch, blueprint_name):
         return jsonify(status=False, errors=[{"id": UNKNOWN_BLUEPRINT, "msg": "Unknown blueprint name: %s" % blueprint_name}])
 
-    try:
-        if from_commit == "NEWEST":
-            with api.config["GITLOCK"].lock:
+    # Read both blueprints under one lock so that they come from the same state of the repository
+    with api.config["GITLOCK"].lock.read():
+        try:
+            if from_commit == "NEWEST":
                 old_blueprint = read_recipe_commit(api.config["GITLOCK"].repo, branch, blueprint_name)
-        else:
-            with api.config["GITLOCK"].lock:
+            else:
                 old_blueprint = read_recipe_commit(api.config["GITLOCK"].repo, branch, blueprint_name, from_commit)
-    except Exception as e:
-        log.error("(v0_blueprints_diff) %s", str(e))
-        return jsonify(status=False, errors=[{"id": UNKNOWN_COMMIT, "msg": str(e)}]), 400
+        except Exception as e:
+            log.error("(v0_blueprints_diff) %s", str(e))
+            return jsonify(status=False, errors=[{"id": UNKNOWN_COMMIT, "msg": str(e)}]), 400
 
-    try:
-        if to_commit == "WORKSPACE":
-            with api.config["GITLOCK"].lock:
+        try:
+            if to_commit == "WORKSPACE":
                 new_blueprint = workspace_read(api.config["GITLOCK"].repo, branch, blueprint_name)
-            # If there is no workspace, use the newest commit instead
-            if not new_blueprint:
-                with api.config["GITLOCK"].lock:
+                # If there is no workspace, use the newest commit instead
+                if not new_blueprint:
                     new_blueprint = read_recipe_commit(api.config["GITLOCK"].repo, branch, blueprint_name)
-        elif to_commit == "NEWEST":
-            with api.config["GITLOCK"].lock:
+            elif to_commit == "NEWEST":
                 new_blueprint = read_recipe_commit(api.config["GITLOCK"].repo, branch, blueprint_name)
-        else:
-            with api.config["GITLOCK"].lock:
+            else:
                 new_blueprint = read_recipe_commit(api.config["GITLOCK"].repo, branch, blueprint_name, to_commit)
-    except Exception as e:
-        log.error("(v0_blueprints_diff) %s", str(e))
-        return jsonify(status=False, errors=[{"id": UNKNOWN_COMMIT, "msg": str(e)}]), 400
+        except Exception as e:
+            log.error("(v0_blueprints_diff) %s", str(e))
+            return jsonify(status=False, errors=[{"id": UNKNOWN_COMMIT, "msg": str(e)}]), 400
 
     diff = recipe_diff(old_blueprint, new_blueprint)
     return jsonify(diff=diff)
@@ -728,7 +731,7 @@ def v0_blueprints_freeze(blueprint_names):
         # Get the workspace version (if it exists)
         blueprint = None
         try:
-            with api.config["GITLOCK"].lock:
+            with api.config["GITLOCK"].lock.read():
                 blueprint = workspace_read(api.config["GITLOCK"].repo, branch, blueprint_name)
         except Exception:
             pass
@@ -736,7 +739,7 @@ def v0_blueprints_freeze(blueprint_names):
         if not blueprint:
             # No workspace version, get the git version (if it exists)
             try:
-                with api.config["GITLOCK"].lock:
+                with api.config["GITLOCK"].lock.read():
                     blueprint = read_recipe_commit(api.config["GITLOCK"].repo, branch, blueprint_name)
             except RecipeFileError as e:
                 # adding an error here would be redundant, skip it
@@ -757,8 +760,7 @@ def v0_blueprints_freeze(blueprint_names):
         projects = sorted(set(module_nver+package_nver), key=lambda p: p[0].lower())
         deps = []
         try:
-            with api.config["DNFLOCK"].lock:
-                deps = projects_depsolve(api.config["DNFLOCK"].dbo, projects, blueprint.group_names)
+            deps = api.config["DNFLOCK"].query(projects_depsolve, projects, blueprint.group_names)
         except ProjectsError as e:
             errors.append({"id": BLUEPRINTS_ERROR, "msg": "%s: %s" % (blueprint_name, str(e))})
             log.error("(v0_blueprints_freeze) %s", str(e))
@@ -865,7 +867,7 @@ def v0_blueprints_depsolve(blueprint_names):
         # Get the workspace version (if it exists)
         blueprint = None
         try:
-            with api.config["GITLOCK"].lock:
+            with api.config["GITLOCK"].lock.read():
                 blueprint = workspace_read(api.config["GITLOCK"].repo, branch, blueprint_name)
         except Exception:
             pass
@@ -873,7 +875,7 @@ def v0_blueprints_depsolve(blueprint_names):
         if not blueprint:
             # No workspace version, get the git version (if it exists)
             try:
-                with api.config["GITLOCK"].lock:
+                with api.config["GITLOCK"].lock.read():
                     blueprint = read_recipe_commit(api.config["GITLOCK"].repo, branch, blueprint_name)
             except RecipeFileError as e:
                 # adding an error here would be redundant, skip it
@@ -894,8 +896,7 @@ def v0_blueprints_depsolve(blueprint_names):
         projects = sorted(set(module_nver+package_nver), key=lambda p: p[0].lower())
         deps = []
         try:
-            with api.config["DNFLOCK"].lock:
-                deps = projects_depsolve(api.config["DNFLOCK"].dbo, projects, blueprint.group_names)
+            deps = api.config["DNFLOCK"].query(projects_depsolve, projects, blueprint.group_names)
         except ProjectsError as e:
             errors.append({"id": BLUEPRINTS_ERROR, "msg": "%s: %s" % (blueprint_name, str(e))})
             log.error("(v0_blueprints_depsolve) %s", str(e))
@@ -915,11 +916,15 @@ def v0_blueprints_depsolve(blueprint_names):
 def v0_projects_list():
     """List all of the available projects/packages
 
-    **/api/v0/projects/list[?offset=0&limit=20]**
+    **/api/v0/projects/list[?offset=0&limit=20&search=<string>]**
 
       List all of the available projects. By default this returns the first 20 items,
       but this can be changed by setting the `offset` and `limit` arguments.
 
+      Setting `search` only returns the projects with that string in their name, ignoring
+      case. The projects whose names start with it are listed first. `total` is the number
+      of matching projects.
+
       Example::
 
           {
@@ -944,15 +949,15 @@ def v0_projects_list():
     except ValueError as e:
         return jsonify(status=False, errors=[{"id": BAD_LIMIT_OR_OFFSET, "msg": str(e)}]), 400
 
+    search = request.args.get("search") or None
+
     try:
-        with api.config["DNFLOCK"].lock:
-            available = projects_list(api.config["DNFLOCK"].dbo)
+        projects, total = api.config["DNFLOCK"].query(projects_page, offset, limit, search)
     except ProjectsError as e:
         log.error("(v0_projects_list) %s", str(e))
         return jsonify(status=False, errors=[{"id": PROJECTS_ERROR, "msg": str(e)}]), 400
 
-    projects = take_limits(available, offset, limit)
-    return jsonify(projects=projects, offset=offset, limit=limit, total=len(available))
+    return jsonify(projects=projects, offset=offset, limit=limit, total=total)
 
 @v0_api.route("/projects/info", defaults={'project_names': ""})
 @v0_api.route("/projects/info/<project_names>")
@@ -1001,8 +1006,7 @@ def v0_projects_info(project_names):
         return jsonify(status=False, errors=[{"id": INVALID_CHARS, "msg": "Invalid characters in API path"}]), 400
 
     try:
-        with api.config["DNFLOCK"].lock:
-            projects = projects_info(api.config["DNFLOCK"].dbo, project_names.split(","))
+        projects = api.config["DNFLOCK"].query(projects_info, project_names.split(","))
     except ProjectsError as e:
         log.error("(v0_projects_info) %s", str(e))
         return jsonify(status=False, errors=[{"id": PROJECTS_ERROR, "msg": str(e)}]), 400
@@ -1058,8 +1062,7 @@ def v0_projects_depsolve(project_names):
         return jsonify(status=False, errors=[{"id": INVALID_CHARS, "msg": "Invalid characters in API path"}]), 400
 
     try:
-        with api.config["DNFLOCK"].lock:
-            deps = projects_depsolve(api.config["DNFLOCK"].dbo, [(n, "*") for n in project_names.split(",")], [])
+        deps = api.config["DNFLOCK"].query(projects_depsolve, [(n, "*") for n in project_names.split(",")], [])
     except ProjectsError as e:
         log.error("(v0_projects_depsolve) %s", str(e))
         return jsonify(status=False, errors=[{"id": PROJECTS_ERROR, "msg": str(e)}]), 400
@@ -1214,6 +1217,7 @@ def v0_projects_source_new():
         with api.config["DNFLOCK"].lock:
             repo_dir = api.config["COMPOSER_CFG"].get("composer", "repo_dir")
             new_repo_source(api.config["DNFLOCK"].dbo, source["name"], source, repo_dir)
+            api.config["DNFLOCK"].invalidate()
     except Exception as e:
         return jsonify(status=False, errors=[{"id": PROJECTS_ERROR, "msg": str(e)}]), 400
 
@@ -1251,6 +1255,7 @@ def v0_projects_source_delete(source_name):
                 log.info("Updating repository metadata after removing %s", source_name)
                 api.config["DNFLOCK"].dbo.fill_sack(load_system_repo=False)
                 api.config["DNFLOCK"].dbo.read_comps()
+                api.config["DNFLOCK"].invalidate()
 
     except ProjectsError as e:
         log.error("(v0_projects_source_delete) %s", str(e))
@@ -1327,8 +1332,7 @@ def v0_modules_list(module_names=None):
         module_names = module_names.split(",")
 
     try:
-        with api.config["DNFLOCK"].lock:
-            available = modules_list(api.config["DNFLOCK"].dbo, module_names)
+        available = api.config["DNFLOCK"].query(modules_list, module_names)
     except ProjectsError as e:
         log.error("(v0_modules_list) %s", str(e))
         return jsonify(status=False, errors=[{"id": MODULES_ERROR, "msg": str(e)}]), 400
@@ -1385,8 +1389,7 @@ def v0_modules_info(module_names):
     if VALID_API_STRING.match(module_names) is None:
         return jsonify(status=False, errors=[{"id": INVALID_CHARS, "msg": "Invalid characters in API path"}]), 400
     try:
-        with api.config["DNFLOCK"].lock:
-            modules = modules_info(api.config["DNFLOCK"].dbo, module_names.split(","))
+        modules = api.config["DNFLOCK"].query(modules_info, module_names.split(","))
     except ProjectsError as e:
         log.error("(v0_modules_info) %s", str(e))
         return jsonify(status=False, errors=[{"id": MODULES_ERROR, "msg": str(e)}]), 400
@@ -1424,6 +1427,14 @@ def v0_compose_start():
       blueprint branch to use. 'branch' is optional and will default to master. It will create a new
       build and add it to the queue. It returns the build uuid and a status if it succeeds
 
+      The build starts out in the PENDING state while its blueprint is depsolved and its
+      kickstart is created, and then moves to WAITING. If this fails it moves to FAILED, and
+      the error can be viewed with the compose log route.
+
+      If a FINISHED build used the same packages, kickstart, and settings its image will be
+      reused and the new build will be FINISHED as soon as it has been depsolved. Pass `?cache=0` to always run
+      the compose.
+
       Example::
 
           {
@@ -1438,6 +1449,10 @@ def v0_compose_start():
     except ValueError:
         test_mode = 0
 
+    # Passing ?cache=0 will run the compose even if an identical one has already finished.
+    # Test composes only reuse other test composes when passed ?cache=1
+    use_cache = request.args.get("cache", "0" if test_mode else "1") not in ("0", "false")
+
     compose = request.get_json(cache=False)
 
     errors = []
@@ -1470,7 +1485,7 @@ def v0_compose_start():
 
     try:
         build_id = start_build(api.config["COMPOSER_CFG"], api.config["DNFLOCK"], api.config["GITLOCK"],
-                               branch, blueprint_name, compose_type, test_mode)
+                               branch, blueprint_name, compose_type, test_mode, use_cache)
     except Exception as e:
         if "Invalid compose type" in str(e):
             return jsonify(status=False, errors=[{"id": BAD_COMPOSE_TYPE, "msg": str(e)}]), 400
@@ -1710,8 +1725,8 @@ def v0_compose_cancel(uuid):
     if status is None:
         return jsonify(status=False, errors=[{"id": UNKNOWN_UUID, "msg": "%s is not a valid build uuid" % uuid}]), 400
 
-    if status["queue_status"] not in ["WAITING", "RUNNING"]:
-        return jsonify(status=False, errors=[{"id": BUILD_IN_WRONG_STATE, "msg": "Build %s is not in WAITING or RUNNING." % uuid}])
+    if status["queue_status"] not in ["PENDING", "WAITING", "RUNNING"]:
+        return jsonify(status=False, errors=[{"id": BUILD_IN_WRONG_STATE, "msg": "Build %s is not in PENDING, WAITING or RUNNING." % uuid}])
 
     try:
         uuid_cancel(api.config["COMPOSER_CFG"], uuid)
@@ -1780,6 +1795,8 @@ def v0_compose_info(uuid):
         * deps - The NEVRA of all of the dependencies used in the composition
         * compose_type - The type of output generated (tar, iso, etc.)
         * queue_status - The final status of the composition (FINISHED or FAILED)
+        * cache_hits - The number of later builds that reused this build's image
+        * cached_from - The uuid of the build whose image was reused, or null
 
       Example::
 
@@ -1832,7 +1849,7 @@ def v0_compose_info(uuid):
 def v0_compose_metadata(uuid):
     """Return a tar of the metadata for the build
 
-    **/api/v0/compose/metadata/<uuid>**
+    **/api/v0/compose/metadata/<uuid>[?compression=gzip|zstd]**
 
       Returns a .tar of the metadata used for the build. This includes all the
       information needed to reproduce the build, including the final kickstart
@@ -1841,7 +1858,8 @@ def v0_compose_metadata(uuid):
       The mime type is set to 'application/x-tar' and the filename is set to
       UUID-metadata.tar
 
-      The .tar is uncompressed, but is not large.
+      The .tar is uncompressed, but is not large. With compression=gzip it is
+      UUID-metadata.tar.gz, and with compression=zstd it is UUID-metadata.tar.zst
     """
     if VALID_API_STRING.match(uuid) is None:
         return jsonify(status=False, errors=[{"id": INVALID_CHARS, "msg": "Invalid characters in API path"}]), 400
@@ -1852,10 +1870,11 @@ def v0_compose_metadata(uuid):
     if status["queue_status"] not in ["FINISHED", "FAILED"]:
         return jsonify(status=False, errors=[{"id": BUILD_IN_WRONG_STATE, "msg": "Build %s not in FINISHED or FAILED state." % uuid}]), 400
     else:
-        return Response(uuid_tar(api.config["COMPOSER_CFG"], uuid, metadata=True, image=False, logs=False),
-                        mimetype="application/x-tar",
-                        headers=[("Content-Disposition", "attachment; filename=%s-metadata.tar;" % uuid)],
-                        direct_passthrough=True)
+        try:
+            return send_tar(request, uuid_tar_members(api.config["COMPOSER_CFG"], uuid, metadata=True, image=False, logs=False),
+                            "%s-metadata" % uuid)
+        except ValueError as e:
+            return jsonify(status=False, errors=[{"id": COMPOSE_ERROR, "msg": str(e)}]), 400
 
 @v0_api.route("/compose/results", defaults={'uuid': ""})
 @v0_api.route("/compose/results/<uuid>")
@@ -1863,15 +1882,18 @@ def v0_compose_metadata(uuid):
 def v0_compose_results(uuid):
     """Return a tar of the metadata and the results for the build
 
-    **/api/v0/compose/results/<uuid>**
+    **/api/v0/compose/results/<uuid>[?compression=gzip|zstd]**
 
       Returns a .tar of the metadata, logs, and output image of the build. This
       includes all the information needed to reproduce the build, including the
       final kickstart populated with repository and package NEVRA. The output image
-      is already in compressed form so the returned tar is not compressed.
+      is already in compressed form so the returned tar is not compressed by default.
 
       The mime type is set to 'application/x-tar' and the filename is set to
-      UUID.tar
+      UUID.tar, the Content-Length is set to the size of the .tar.
+
+      With compression=gzip the filename is UUID.tar.gz, and with compression=zstd
+      it is UUID.tar.zst. The size of a compressed tar is not known in advance.
     """
     if VALID_API_STRING.match(uuid) is None:
         return jsonify(status=False, errors=[{"id": INVALID_CHARS, "msg": "Invalid characters in API path"}]), 400
@@ -1882,10 +1904,11 @@ def v0_compose_results(uuid):
     elif status["queue_status"] not in ["FINISHED", "FAILED"]:
         return jsonify(status=False, errors=[{"id": BUILD_IN_WRONG_STATE, "msg": "Build %s not in FINISHED or FAILED state." % uuid}]), 400
     else:
-        return Response(uuid_tar(api.config["COMPOSER_CFG"], uuid, metadata=True, image=True, logs=True),
-                        mimetype="application/x-tar",
-                        headers=[("Content-Disposition", "attachment; filename=%s.tar;" % uuid)],
-                        direct_passthrough=True)
+        try:
+            return send_tar(request, uuid_tar_members(api.config["COMPOSER_CFG"], uuid, metadata=True, image=True, logs=True),
+                            "%s" % uuid)
+        except ValueError as e:
+            return jsonify(status=False, errors=[{"id": COMPOSE_ERROR, "msg": str(e)}]), 400
 
 @v0_api.route("/compose/logs", defaults={'uuid': ""})
 @v0_api.route("/compose/logs/<uuid>")
@@ -1893,13 +1916,14 @@ def v0_compose_results(uuid):
 def v0_compose_logs(uuid):
     """Return a tar of the metadata for the build
 
-    **/api/v0/compose/logs/<uuid>**
+    **/api/v0/compose/logs/<uuid>[?compression=gzip|zstd]**
 
       Returns a .tar of the anaconda build logs. The tar is not compressed, but is
       not large.
 
       The mime type is set to 'application/x-tar' and the filename is set to
-      UUID-logs.tar
+      UUID-logs.tar. With compression=gzip it is UUID-logs.tar.gz, and with
+      compression=zstd it is UUID-logs.tar.zst
     """
     if VALID_API_STRING.match(uuid) is None:
         return jsonify(status=False, errors=[{"id": INVALID_CHARS, "msg": "Invalid characters in API path"}]), 400
@@ -1910,10 +1934,11 @@ def v0_compose_logs(uuid):
     elif status["queue_status"] not in ["FINISHED", "FAILED"]:
         return jsonify(status=False, errors=[{"id": BUILD_IN_WRONG_STATE, "msg": "Build %s not in FINISHED or FAILED state." % uuid}]), 400
     else:
-        return Response(uuid_tar(api.config["COMPOSER_CFG"], uuid, metadata=False, image=False, logs=True),
-                        mimetype="application/x-tar",
-                        headers=[("Content-Disposition", "attachment; filename=%s-logs.tar;" % uuid)],
-                        direct_passthrough=True)
+        try:
+            return send_tar(request, uuid_tar_members(api.config["COMPOSER_CFG"], uuid, metadata=False, image=False, logs=True),
+                            "%s-logs" % uuid)
+        except ValueError as e:
+            return jsonify(status=False, errors=[{"id": COMPOSE_ERROR, "msg": str(e)}]), 400
 
 @v0_api.route("/compose/image", defaults={'uuid': ""})
 @v0_api.route("/compose/image/<uuid>")
@@ -1925,6 +1950,10 @@ def v0_compose_image(uuid):
 
       Returns the output image from the build. The filename is set to the filename
       from the build with the UUID as a prefix. eg. UUID-root.tar.xz or UUID-boot.iso.
+
+      HEAD returns just the headers. The ETag is the SHA-256 of the image. A single
+      byte range is supported with the Range and If-Range headers, so that an interrupted
+      download can be resumed. If-None-Match with the current ETag returns 304.
     """
     if VALID_API_STRING.match(uuid) is None:
         return jsonify(status=False, errors=[{"id": INVALID_CHARS, "msg": "Invalid characters in API path"}]), 400
@@ -1943,8 +1972,8 @@ def v0_compose_image(uuid):
 
         # Make the image name unique
         image_name = uuid + "-" + image_name
-        # XXX - Will mime type guessing work for all our output?
-        return send_file(image_path, as_attachment=True, attachment_filename=image_name, add_etags=False)
+        etag = file_etag(image_path, uuid_image_checksum(api.config["COMPOSER_CFG"], uuid))
+        return send_file_range(request, image_path, image_name, etag)
 
 @v0_api.route("/compose/log", defaults={'uuid': ""})
 @v0_api.route("/compose/log/<uuid>")
@@ -1952,7 +1981,7 @@ def v0_compose_image(uuid):
 def v0_compose_log_tail(uuid):
     """Return the tail of the most currently relevant log
 
-    **/api/v0/compose/log/<uuid>[?size=KiB]**
+    **/api/v0/compose/log/<uuid>[?size=KiB][&log=<name>&offset=<offset>][&follow=1]**
 
       Returns the end of either the anaconda log, the packaging log, or the
       composer logs, depending on the progress of the compose. The size
@@ -1960,6 +1989,16 @@ def v0_compose_log_tail(uuid):
       returned data is raw text from the end of the log file, starting on a
       line boundary.
 
+      The X-Log-Name and X-Log-Offset headers are the name of the log and the offset
+      after the returned text. Passing them back as log and offset returns just the
+      new part of the log, up to size KiB. If the most relevant log has changed the
+      end of the new log is returned. While the build is running only complete lines
+      are returned.
+
+      With follow=1 the end of the log, or the part after the offset, is sent and then
+      new lines are sent as they are written to the log. It ends when the build has
+      finished.
+
       Example::
 
           12:59:24,222 INFO anaconda: Running Thread: AnaConfigurationThread (140629395244800)
@@ -1983,15 +2022,97 @@ def v0_compose_log_tail(uuid):
 
     try:
         size = int(request.args.get("size", "1024"))
+        offset = int(request.args["offset"]) if "offset" in request.args else None
     except ValueError as e:
         return jsonify(status=False, errors=[{"id": COMPOSE_ERROR, "msg": str(e)}]), 400
+    log_name = request.args.get("log")
+    follow = request.args.get("follow", "0") not in ["0", "false", "False"]
 
     status = uuid_status(api.config["COMPOSER_CFG"], uuid, api=0)
     if status is None:
         return jsonify(status=False, errors=[{"id": UNKNOWN_UUID, "msg": "%s is not a valid build uuid" % uuid}]), 400
-    elif status["queue_status"] == "WAITING":
+    elif status["queue_status"] in ["PENDING", "WAITING"]:
         return jsonify(status=False, errors=[{"id": BUILD_IN_WRONG_STATE, "msg": "Build %s has not started yet. No logs to view" % uuid}])
     try:
-        return Response(uuid_log(api.config["COMPOSER_CFG"], uuid, size), direct_passthrough=True)
+        text, log_name, offset = uuid_log_read(api.config["COMPOSER_CFG"], uuid, log_name, offset, size)
     except RuntimeError as e:
         return jsonify(status=False, errors=[{"id": COMPOSE_ERROR, "msg": str(e)}]), 400
+    headers = [("X-Log-Name", log_name), ("X-Log-Offset", str(offset))]
+    if not follow:
+        return Response(text, headers=headers, direct_passthrough=True)
+
+    return Response(follow_log(api.config["COMPOSER_CFG"], uuid, text, log_name, offset, size),
+                    mimetype="text/plain", headers=headers, direct_passthrough=True)
+
+def follow_log(cfg, uuid, text, log_name, offset, size):
+    """Return the text, and then the new lines of the compose's log as they are written
+
+    :param cfg: Configuration settings
+    :type cfg: ComposerConfig
+    :param uuid: The UUID of the build
+    :type uuid: str
+    :param text: The first text to return
+    :type text: str
+    :param log_name: The name of the log the text is from
+    :type log_name: str
+    :param offset: The offset after the text
+    :type offset: int
+    :param size: Maximum number of KiB to read at a time
+    :type size: int
+    :returns: The lines of the log
+    :rtype: generator of str
+
+    The log is watched with inotify, and the most relevant log is checked again every
+    LOG_FOLLOW_CHECK seconds. If it changes the end of the new log is returned, or
+    the rest of it if it was followed earlier. combined.log is an exception, if it was
+    not followed earlier only the lines added to it after the change are returned. It
+    stops when the build is no longer running and the rest of the log has been
+    returned, or when the build is deleted.
+    """
+    offsets = {log_name: offset}
+    watch = None
+    try:
+        while True:
+            if text:
+                yield text
+            try:
+                log_path, running = uuid_log_path(cfg, uuid)
+            except RuntimeError:
+                # The build was deleted, the response has already started so just end it
+                log.info("Build %s was deleted while its log was being followed", uuid)
+                break
+            if os.path.basename(log_path) != log_name:
+                # Resume the log if it was followed before
+                log_name = os.path.basename(log_path)
+                offset = offsets.get(log_name)
+                if offset is None and log_name == "combined.log":
+                    # Start at its current end instead of sending up to `size` KiB
+                    # from the end of it again
+                    try:
+                        offset = os.path.getsize(log_path)
+                    except OSError:
+                        pass
+            try:
+                text, log_name, offset = uuid_log_read(cfg, uuid, log_name, offset, size)
+            except RuntimeError:
+                text = ""
+            offsets[log_name] = offset
+            if text:
+                continue
+            if not running:
+                break
+
+            if watch is None or watch.path != log_path:
+                if watch is not None:
+                    watch.close()
+                    watch = None
+                if not os.path.exists(log_path):
+                    gevent.sleep(1)
+                    continue
+                # Watch for changes before reading it again, so that none are missed
+                watch = DirWatch(log_path, mask=IN_MODIFY)
+                continue
+            wait_for_change(watch, LOG_FOLLOW_CHECK)
+    finally:
+        if watch is not None:
+            watch.close()
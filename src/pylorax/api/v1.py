@@ -20,30 +20,44 @@
 import logging
 log = logging.getLogger("lorax-composer")
 
-from flask import jsonify, request
+from flask import jsonify, request, Response
 from flask import current_app as api
+from io import BytesIO
+import json
+import math
+import tarfile
+import time
 
 from lifted.queue import get_upload, reset_upload, cancel_upload, delete_upload
 from lifted.providers import list_providers, resolve_provider, load_profiles, validate_settings, save_settings
 from lifted.providers import load_settings, delete_profile
+from pylorax.api.blocking import call_blocking
 from pylorax.api.checkparams import checkparams
 from pylorax.api.compose import start_build
-from pylorax.api.errors import BAD_COMPOSE_TYPE, BUILD_FAILED, INVALID_CHARS, MISSING_POST, PROJECTS_ERROR
+from pylorax.api.errors import BAD_COMPOSE_TYPE, BLUEPRINTS_ERROR, BUILD_FAILED, INVALID_CHARS, MISSING_POST, PROJECTS_ERROR
 from pylorax.api.errors import SYSTEM_SOURCE, UNKNOWN_BLUEPRINT, UNKNOWN_SOURCE, UNKNOWN_UUID, UPLOAD_ERROR
-from pylorax.api.errors import COMPOSE_ERROR
+from pylorax.api.errors import BAD_LIMIT_OR_OFFSET, COMPOSE_ERROR
+from pylorax.api.download import wait_for_change
+from pylorax.api.events import event_log
 from pylorax.api.flask_blueprint import BlueprintSkip
 from pylorax.api.queue import queue_status, build_status, uuid_status, uuid_schedule_upload, uuid_remove_upload
 from pylorax.api.queue import uuid_info
 from pylorax.api.projects import get_repo_sources, repo_to_source
-from pylorax.api.projects import new_repo_source
+from pylorax.api.projects import new_repo_source, DEPSOLVE_CACHE
+from pylorax.api.recipes import commit_recipes, read_branch_recipes, read_recipe_commit, recipe_from_dict
+from pylorax.api.recipes import recipe_from_toml
 from pylorax.api.regexes import VALID_API_STRING, VALID_BLUEPRINT_NAME
 import pylorax.api.toml as toml
-from pylorax.api.utils import blueprint_exists
+from pylorax.api.utils import blueprint_exists, tar_stream
+from pylorax.api.workspace import workspace_write
 
 
 # Create the v1 routes Blueprint with skip_routes support
 v1_api = BlueprintSkip("v1_routes", __name__)
 
+# Seconds between the keepalive comments sent to idle /events clients
+EVENTS_KEEPALIVE = 15
+
 @v1_api.route("/projects/source/info", defaults={'source_ids': ""})
 @v1_api.route("/projects/source/info/<source_ids>")
 @checkparams([("source_ids", "", "no source names given")])
@@ -173,11 +187,182 @@ def v1_projects_source_new():
         with api.config["DNFLOCK"].lock:
             repo_dir = api.config["COMPOSER_CFG"].get("composer", "repo_dir")
             new_repo_source(api.config["DNFLOCK"].dbo, source["id"], source, repo_dir)
+            api.config["DNFLOCK"].invalidate()
     except Exception as e:
         return jsonify(status=False, errors=[{"id": PROJECTS_ERROR, "msg": str(e)}]), 400
 
     return jsonify(status=True)
 
+@v1_api.route("/projects/cache")
+def v1_projects_cache():
+    """Return the statistics of the depsolve cache
+
+    **/api/v1/projects/cache**
+
+      Return the number of cache hits and misses, and the current and maximum number of
+      results in the cache used by the depsolve routes and by compose. The maximum size
+      can be changed with ``depsolve_cache_size`` in the ``[composer]`` section of
+      ``/etc/lorax/composer.conf``.
+
+      Example::
+
+          {
+              "depsolve": {
+                  "hits": 12,
+                  "misses": 4,
+                  "size": 4,
+                  "max_size": 128
+              }
+          }
+    """
+    return jsonify(depsolve=DEPSOLVE_CACHE.stats())
+
+@v1_api.route("/blueprints/bulk", methods=["POST"])
+def v1_blueprints_bulk():
+    """Commit several blueprints at once
+
+    **POST /api/v1/blueprints/bulk**
+
+      Create or update several blueprints in a single commit. The body of the request is
+      either a JSON list of blueprints with the `Content-Type` header set to `application/json`,
+      or a tar of blueprint TOML files with it set to `application/x-tar`, like the one
+      returned by `/blueprints/export?format=tar`.
+
+      All of the blueprints are checked before any of them are committed, if there are
+      errors nothing is committed and they are all returned. The version of each blueprint
+      is bumped the same way `/blueprints/new` does it, and the workspace copies are replaced.
+      Blueprints that are the same as the ones already on the branch are not committed again,
+      if none of them have changed `commit` is null.
+
+      Example::
+
+          {
+              "status": true,
+              "commit": "bb2d6e3a4a9cd6bf5c9ae7b1fb3e7a24e5bc73e2",
+              "blueprints": ["example-atlas", "example-http-server"]
+          }
+    """
+    branch = request.args.get("branch", "master")
+    if VALID_API_STRING.match(branch) is None:
+        return jsonify(status=False, errors=[{"id": INVALID_CHARS, "msg": "Invalid characters in branch argument"}]), 400
+
+    # The source of each blueprint, for the error messages, and a function to parse it
+    entries = []
+    try:
+        if request.headers.get('Content-Type') == "application/x-tar":
+            with tarfile.open(fileobj=BytesIO(request.data)) as tar:
+                for member in tar:
+                    if member.isfile() and member.name.endswith(".toml"):
+                        data = tar.extractfile(member).read()
+                        entries.append((member.name, lambda data=data: recipe_from_toml(data)))
+        else:
+            blueprints = request.get_json(cache=False)
+            if not isinstance(blueprints, list):
+                raise RuntimeError("The request body must be a list of blueprints")
+            for i, blueprint_dict in enumerate(blueprints):
+                entries.append(("blueprint %d" % i, lambda d=blueprint_dict: recipe_from_dict(d)))
+    except Exception as e:
+        log.error("(v1_blueprints_bulk) %s", str(e))
+        return jsonify(status=False, errors=[{"id": BLUEPRINTS_ERROR, "msg": str(e)}]), 400
+
+    if not entries:
+        return jsonify(status=False, errors=[{"id": MISSING_POST, "msg": "Missing blueprints"}]), 400
+
+    blueprints = []
+    errors = []
+    for (source, parse) in entries:
+        try:
+            blueprint = parse()
+            if VALID_BLUEPRINT_NAME.match(blueprint["name"]) is None:
+                raise RuntimeError("Invalid characters in the blueprint name")
+            if blueprint["name"] in [b["name"] for b in blueprints]:
+                raise RuntimeError("%s is included more than once" % blueprint["name"])
+            blueprints.append(blueprint)
+        except Exception as e:
+            errors.append({"id": BLUEPRINTS_ERROR, "msg": "%s: %s" % (source, str(e))})
+    if errors:
+        return jsonify(status=False, errors=errors), 400
+
+    try:
+        with api.config["GITLOCK"].lock:
+            commit_id = commit_recipes(api.config["GITLOCK"].repo, branch, blueprints)
+
+            # Read the blueprints with the new versions and write them to the workspace
+            for blueprint in blueprints:
+                blueprint = read_recipe_commit(api.config["GITLOCK"].repo, branch, blueprint["name"])
+                workspace_write(api.config["GITLOCK"].repo, branch, blueprint)
+    except Exception as e:
+        log.error("(v1_blueprints_bulk) %s", str(e))
+        return jsonify(status=False, errors=[{"id": BLUEPRINTS_ERROR, "msg": str(e)}]), 400
+
+    return jsonify(status=True,
+                   commit=commit_id.to_string() if commit_id else None,
+                   blueprints=sorted(b["name"] for b in blueprints))
+
+@v1_api.route("/blueprints/export")
+def v1_blueprints_export():
+    """Return all of the blueprints on a branch
+
+    **/api/v1/blueprints/export[?format=<json|tar>]**
+
+      Return all of the committed blueprints on the branch in one response. By default
+      it is a JSON object with a list of the blueprints, like `/blueprints/info`, but without
+      the changes or errors. With `?format=tar` it is a tar of the blueprints as TOML files,
+      with the mime type set to 'application/x-tar', that can be passed to `/blueprints/bulk`.
+
+      All of the blueprints are read from the branch's most recent commit. The workspace
+      copies are not included.
+
+      Example::
+
+          {
+              "blueprints": [
+                  {
+                      "name": "example-atlas",
+                      "description": "Automatically Tuned Linear Algebra Software",
+                      "version": "0.0.1",
+                      "modules": [
+                          {
+                              "name": "atlas",
+                              "version": "*"
+                          }
+                      ],
+                      "packages": [],
+                      "groups": []
+                  }
+              ]
+          }
+    """
+    branch = request.args.get("branch", "master")
+    if VALID_API_STRING.match(branch) is None:
+        return jsonify(status=False, errors=[{"id": INVALID_CHARS, "msg": "Invalid characters in branch argument"}]), 400
+
+    out_fmt = request.args.get("format", "json")
+    if out_fmt not in ["json", "tar"]:
+        return jsonify(status=False, errors=[{"id": BLUEPRINTS_ERROR, "msg": "Unsupported format: %s" % out_fmt}]), 400
+
+    try:
+        with api.config["GITLOCK"].lock.read():
+            blueprints = read_branch_recipes(api.config["GITLOCK"].repo, branch)
+    except Exception as e:
+        log.error("(v1_blueprints_export) %s", str(e))
+        return jsonify(status=False, errors=[{"id": BLUEPRINTS_ERROR, "msg": str(e)}]), 400
+
+    if out_fmt == "tar":
+        mtime = time.time()
+        members = ((b.filename, b.toml().encode("UTF-8"), mtime) for b in blueprints)
+        return Response(tar_stream(members),
+                        mimetype="application/x-tar",
+                        headers=[("Content-Disposition", "attachment; filename=%s-blueprints.tar;" % branch)],
+                        direct_passthrough=True)
+
+    def json_stream():
+        yield '{"blueprints": ['
+        for i, blueprint in enumerate(blueprints):
+            yield (", " if i else "") + json.dumps(blueprint)
+        yield ']}\n'
+    return Response(json_stream(), mimetype="application/json")
+
 @v1_api.route("/compose", methods=["POST"])
 def v1_compose_start():
     """Start a compose
@@ -237,6 +422,14 @@ def v1_compose_start():
       If an "upload" is given, it will schedule an upload to run when the build
       finishes.
 
+      The build starts out in the PENDING state while its blueprint is depsolved and its
+      kickstart is created, and then moves to WAITING. If this fails it moves to FAILED, and
+      the error can be viewed with the compose log route.
+
+      If a FINISHED build used the same packages, kickstart, and settings its image will be
+      reused and the new build will be FINISHED as soon as it has been depsolved. Pass `?cache=0` to always run
+      the compose.
+
       Example response::
 
           {
@@ -252,6 +445,10 @@ def v1_compose_start():
     except ValueError:
         test_mode = 0
 
+    # Passing ?cache=0 will run the compose even if an identical one has already finished.
+    # Test composes only reuse other test composes when passed ?cache=1
+    use_cache = request.args.get("cache", "0" if test_mode else "1") not in ("0", "false")
+
     compose = request.get_json(cache=False)
 
     errors = []
@@ -306,7 +503,7 @@ def v1_compose_start():
 
     try:
         build_id = start_build(api.config["COMPOSER_CFG"], api.config["DNFLOCK"], api.config["GITLOCK"],
-                               branch, blueprint_name, compose_type, test_mode)
+                               branch, blueprint_name, compose_type, test_mode, use_cache)
     except Exception as e:
         if "Invalid compose type" in str(e):
             return jsonify(status=False, errors=[{"id": BAD_COMPOSE_TYPE, "msg": str(e)}]), 400
@@ -601,6 +798,8 @@ def v1_compose_info(uuid):
         * deps - The NEVRA of all of the dependencies used in the composition
         * compose_type - The type of output generated (tar, iso, etc.)
         * queue_status - The final status of the composition (FINISHED or FAILED)
+        * cache_hits - The number of later builds that reused this build's image
+        * cached_from - The uuid of the build whose image was reused, or null
 
       Example::
 
@@ -1040,3 +1239,138 @@ def v1_providers_delete(provider_name, profile):
         error = {"id": UPLOAD_ERROR, "msg": str(e)}
         return jsonify(status=False, errors=[error])
     return jsonify(status=True)
+
+@v1_api.route("/events")
+def v1_events():
+    """Stream the compose and upload state changes as Server-Sent Events
+
+    **/api/v1/events[?since=<id>]**
+
+      Returns a text/event-stream that sends an event every time a build or an upload
+      changes state, so that clients do not need to poll the status routes. Each event
+      has an id, a type of compose or upload, and the JSON details as its data::
+
+          id: 42
+          event: compose
+          data: {"id": "45502a6d-06e8-48a5-a215-2b4174b3614b", "queue_status": "RUNNING", "previous_status": "WAITING", ...}
+
+          id: 43
+          event: upload
+          data: {"uuid": "b637c411-9d9d-4279-b067-6c8d38e3b211", "status": "READY", "provider_name": "aws", ...}
+
+      The compose event's data is the same as an entry from `/compose/status` and the
+      previous_status, a deleted build has a queue_status of DELETED. The upload event's
+      data is the uuid, status, provider_name, image_name, and creation_time, a deleted
+      upload has a status of DELETED.
+
+      By default it starts with the next event. Reconnecting clients can pass the id of
+      the last event they received with the Last-Event-ID header, or ?since=, to get the
+      events they missed. If those have already been discarded a reset event is sent
+      first, the client should read the current state from the status routes.
+      A comment is sent every 15 seconds to keep the connection open.
+    """
+    try:
+        since = int(request.headers.get("Last-Event-ID", request.args.get("since", "-1")))
+    except ValueError as e:
+        return jsonify(status=False, errors=[{"id": BAD_LIMIT_OR_OFFSET, "msg": str(e)}]), 400
+
+    events = event_log(api.config["COMPOSER_CFG"].get("composer", "lib_dir"))
+    # The database may be locked by a writer, wait for it in a thread
+    if since < 0:
+        since = call_blocking(events.last_id)
+
+    def event_stream():
+        last_id = since
+        # Watch for new events before reading them, so that none are missed
+        watch = events.watch()
+        try:
+            if call_blocking(events.missed, last_id):
+                yield "event: reset\ndata: {}\n\n"
+            last_sent = time.time()
+            while True:
+                new_events = call_blocking(events.since, last_id)
+                for e in new_events:
+                    yield "id: %d\nevent: %s\ndata: %s\n\n" % (e["id"], e["type"], json.dumps(e["data"]))
+                    last_id = e["id"]
+                if new_events:
+                    last_sent = time.time()
+                    continue
+                # Without inotify wait_for_change returns every second, so the
+                # keepalive is based on the time since something was last sent
+                if time.time() - last_sent >= EVENTS_KEEPALIVE:
+                    yield ": keepalive\n\n"
+                    last_sent = time.time()
+                wait_for_change(watch, max(0, last_sent + EVENTS_KEEPALIVE - time.time()))
+        finally:
+            watch.close()
+
+    return Response(event_stream(), mimetype="text/event-stream",
+                    headers=[("Cache-Control", "no-cache")], direct_passthrough=True)
+
+@v1_api.route("/events/poll")
+def v1_events_poll():
+    """Wait for compose and upload state changes
+
+    **/api/v1/events/poll[?since=<id>][&timeout=<seconds>]**
+
+      The long-poll version of `/events` for clients that cannot use Server-Sent Events.
+      It returns the events after the since id as soon as there are any, or an empty
+      list after timeout seconds. The default timeout is 30 seconds, the maximum is 300.
+      The next request should pass the returned last_id as since. Without since it waits
+      for the next event.
+
+      reset is true if some of the events after since have already been discarded, the
+      client should read the current state from the status routes.
+
+      Example::
+
+          {
+              "events": [
+                  {
+                      "id": 42,
+                      "time": 1591042345.2541835,
+                      "type": "compose",
+                      "data": {
+                          "id": "45502a6d-06e8-48a5-a215-2b4174b3614b",
+                          "queue_status": "RUNNING",
+                          "previous_status": "WAITING",
+                          "blueprint": "example-http-server",
+                          "version": "0.0.1",
+                          "compose_type": "tar",
+                          "image_size": 0,
+                          "image_sha256": null,
+                          "job_created": 1591042335.18,
+                          "job_started": 1591042345.21,
+                          "job_finished": null
+                      }
+                  }
+              ],
+              "last_id": 42,
+              "reset": false
+          }
+    """
+    try:
+        since = int(request.args.get("since", "-1"))
+        timeout = float(request.args.get("timeout", "30"))
+        if not math.isfinite(timeout):
+            raise ValueError("timeout must be a finite number")
+        timeout = min(max(timeout, 0), 300)
+    except ValueError as e:
+        return jsonify(status=False, errors=[{"id": BAD_LIMIT_OR_OFFSET, "msg": str(e)}]), 400
+
+    events = event_log(api.config["COMPOSER_CFG"].get("composer", "lib_dir"))
+    watch = events.watch()
+    try:
+        # The database may be locked by a writer, wait for it in a thread
+        if since < 0:
+            since = call_blocking(events.last_id)
+        deadline = time.time() + timeout
+        new_events = call_blocking(events.since, since)
+        while not new_events and time.time() < deadline:
+            wait_for_change(watch, deadline - time.time())
+            new_events = call_blocking(events.since, since)
+    finally:
+        watch.close()
+
+    last_id = new_events[-1]["id"] if new_events else since
+    return jsonify(events=new_events, last_id=last_id, reset=call_blocking(events.missed, since))
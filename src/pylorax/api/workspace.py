@@ -14,11 +14,15 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+import hashlib
 import os
 
-from pylorax.api.recipes import recipe_filename, recipe_from_toml, RecipeFileError
+from pylorax.api.recipes import recipe_filename, recipe_from_toml, RecipeFileError, RecipeCache
 from pylorax.sysutils import joinpaths
 
+# The recipes read from the workspace, by filename and the sha256 of the file
+WORKSPACE_CACHE = RecipeCache()
+
 
 def workspace_dir(repo, branch):
     """Create the workspace's path from a Repository and branch
@@ -56,7 +60,14 @@ def workspace_read(repo, branch, recipe_name):
         return None
     try:
         f = open(filename, 'rb')
-        recipe = recipe_from_toml(f.read().decode("UTF-8"))
+        content = f.read()
+
+        # Reading the file is cheap, parsing it is not
+        key = (filename, hashlib.sha256(content).hexdigest())
+        recipe = WORKSPACE_CACHE.get(key)
+        if recipe is None:
+            recipe = recipe_from_toml(content.decode("UTF-8"))
+            WORKSPACE_CACHE.put(key, recipe)
     except IOError:
         raise RecipeFileError
     return recipe
@@ -186,6 +186,12 @@ def lmc_parser(dracut_default=""):
     parser.add_argument("--armplatform",
                         help="the platform to use when creating images for ARM, "
                              "i.e., highbank, mvebu, omap, tegra, etc.")
+    parser.add_argument("--dirinstall-path", default=None, type=os.path.abspath,
+                        help="Directory anaconda installs into for no-virt "
+                             "filesystem and tar installs. Defaults to /mnt/sysimage/")
+    parser.add_argument("--anaconda-tmp", default=None, type=os.path.abspath,
+                        help="Private directory to use as anaconda's /tmp in "
+                             "no-virt mode. Defaults to using the host's /tmp")
     parser.add_argument("--location", default=None, type=os.path.abspath,
                         help="location of iso directory tree with initrd.img "
                              "and vmlinuz. Used to run qemu with a newer initrd "
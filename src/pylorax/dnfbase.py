@@ -16,13 +16,78 @@
 import logging
 log = logging.getLogger("pylorax")
 
+from concurrent.futures import ThreadPoolExecutor
 import dnf
 import os
 import shutil
+import time
 
 from pylorax import DEFAULT_PLATFORM_ID
 from pylorax.sysutils import flatconfig
 
+def load_repos(repos, max_workers=8):
+    """ Download and verify the metadata of the repositories in parallel
+
+        :param list repos: The dnf.repo.Repo objects to load
+        :param int max_workers: Maximum number of repositories to load at the same time
+        :returns: The exception for each repository id that failed to load
+        :rtype: dict
+
+        The time taken by each repository is logged.
+    """
+    def load(repo):
+        start = time.time()
+        try:
+            repo.load()
+        except dnf.exceptions.RepoError as e:
+            log.info("Loading metadata for %s failed after %.2fs", repo.id, time.time() - start)
+            return (repo.id, e)
+        log.info("Loaded metadata for %s in %.2fs", repo.id, time.time() - start)
+        return (repo.id, None)
+
+    repos = list(repos)
+    if not repos:
+        return {}
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(repos)), thread_name_prefix="load-repo") as executor:
+        results = list(executor.map(load, repos))
+    log.info("Loaded metadata for %d repositories in %.2fs", len(repos), time.time() - start)
+    return dict((repo_id, e) for repo_id, e in results if e is not None)
+
+def fill_loaded_sack(dbo, errors=None):
+    """ Fill the sack using the metadata already loaded by load_repos()
+
+        :param dbo: The dnf.Base object
+        :type dbo: dnf.Base
+        :param dict errors: The repositories that failed in load_repos()
+        :raises: dnf.exceptions.RepoError if a repository without skip_if_unavailable failed
+
+        The repositories that failed are not loaded a second time. They are disabled
+        if skip_if_unavailable is set, like dnf does, otherwise their error is raised.
+        The metadata of the others is not checked again, it does not expire while the
+        sack is being filled.
+    """
+    errors = errors or {}
+    for repo in list(dbo.repos.iter_enabled()):
+        if repo.id not in errors:
+            continue
+        if not repo.skip_if_unavailable:
+            raise errors[repo.id]
+        log.warning("Skipping %s, its metadata could not be loaded: %s", repo.id, errors[repo.id])
+        repo.disable()
+
+    expires = {}
+    for repo in dbo.repos.iter_enabled():
+        expires[repo] = repo.metadata_expire
+        repo.metadata_expire = -1
+    start = time.time()
+    try:
+        dbo.fill_sack(load_system_repo=False)
+    finally:
+        for repo, expire in expires.items():
+            repo.metadata_expire = expire
+    log.info("Filled the sack in %.2fs", time.time() - start)
+
 def get_dnf_base_object(installroot, sources, mirrorlists=None, repos=None,
                         enablerepos=None, disablerepos=None,
                         tempdir="/var/tmp", proxy=None, releasever="32",
@@ -123,7 +188,8 @@ def get_dnf_base_object(installroot, sources, mirrorlists=None, repos=None,
         conf.reposdir = [reposdir]
         dnfbase.read_all_repos()
 
-    # add the sources
+    # add the sources, their metadata is fetched after the cmdline repos are enabled
+    added = []
     for i, r in enumerate(sources):
         if "SRPM" in r or "srpm" in r:
             log.info("Skipping source repo: %s", r)
@@ -135,13 +201,8 @@ def get_dnf_base_object(installroot, sources, mirrorlists=None, repos=None,
             repo.proxy = proxy
         repo.enable()
         dnfbase.repos.add(repo)
+        added.append(repo_name)
         log.info("Added '%s': %s", repo_name, r)
-        log.info("Fetching metadata...")
-        try:
-            repo.load()
-        except dnf.exceptions.RepoError as e:
-            log.error("Error fetching metadata for %s: %s", repo_name, e)
-            return None
 
     # add the mirrorlists
     for i, r in enumerate(mirrorlists):
@@ -155,13 +216,8 @@ def get_dnf_base_object(installroot, sources, mirrorlists=None, repos=None,
             repo.proxy = proxy
         repo.enable()
         dnfbase.repos.add(repo)
+        added.append(repo_name)
         log.info("Added '%s': %s", repo_name, r)
-        log.info("Fetching metadata...")
-        try:
-            repo.load()
-        except dnf.exceptions.RepoError as e:
-            log.error("Error fetching metadata for %s: %s", repo_name, e)
-            return None
 
     # Enable repos listed on the cmdline
     for r in enablerepos:
@@ -181,7 +237,15 @@ def get_dnf_base_object(installroot, sources, mirrorlists=None, repos=None,
             repolist.disable()
             log.info("Disabled repo %s", r)
 
-    dnfbase.fill_sack(load_system_repo=False)
+    # Fetch the metadata for all of the enabled repos at the same time
+    log.info("Fetching metadata...")
+    errors = load_repos(dnfbase.repos.iter_enabled())
+    for repo_name in added:
+        if repo_name in errors:
+            log.error("Error fetching metadata for %s: %s", repo_name, errors[repo_name])
+            return None
+
+    fill_loaded_sack(dnfbase, errors)
     dnfbase.read_comps()
 
     return dnfbase
@@ -39,10 +39,56 @@ from pylorax.treebuilder import udev_escape
 
 ROOT_PATH = "/mnt/sysimage/"
 
+# Run a command with a private /tmp and /run, in a private mount namespace
+# The host's /run is bind mounted on $2 and a tmpfs is mounted over /run, with
+# everything from the host's /run bound back into it except for anaconda's pid
+# file and state directory. Then $1 is mounted over /tmp. This way anaconda can
+# still reach the host's udev, lvm, and dbus sockets, but more than one can run
+# at a time.
+PRIVATE_TMP_RUN_SCRIPT = r"""
+tmp="$1"; host_run="$2"; shift 2
+mount --rbind /run "$host_run" || exit 1
+mount -t tmpfs -o mode=0755 tmpfs /run || exit 1
+for path in "$host_run"/* "$host_run"/.[!.]*; do
+    name="${path##*/}"
+    case "$name" in
+        "*"|".[!.]*"|anaconda|anaconda.pid) continue ;;
+    esac
+    if [ -L "$path" ]; then
+        cp -P "$path" "/run/$name"
+    elif [ -d "$path" ]; then
+        mkdir -p "/run/$name" && mount --rbind "$path" "/run/$name"
+    else
+        touch "/run/$name" && mount --bind "$path" "/run/$name"
+    fi || exit 1
+done
+if [ ! -L /var/run ]; then
+    mount --bind /run /var/run || exit 1
+fi
+mount --bind "$tmp" /tmp || exit 1
+exec "$@"
+"""
+
 class InstallError(Exception):
     pass
 
 
+def private_tmp_run_args(tmp_dir, host_run_dir, cmd):
+    """Return the unshare arguments to run a command with its own /tmp and /run
+
+    :param str tmp_dir: Directory to mount over /tmp
+    :param str host_run_dir: Empty directory to mount the host's /run on, outside of /run and tmp_dir
+    :param list cmd: The command and its arguments
+    :returns: The arguments for unshare
+    :rtype: list of str
+
+    The command runs as pid 1 in its own pid and mount namespaces, so its mounts,
+    and the /run/anaconda.pid file, are not seen by the host or by other installs.
+    """
+    return ["--pid", "--kill-child", "--mount", "--propagation", "private",
+            "sh", "-c", PRIVATE_TMP_RUN_SCRIPT, "sh", tmp_dir, host_run_dir] + cmd
+
+
 def create_vagrant_metadata(path, size=0):
     """ Create a default Vagrant metadata.json file
 
@@ -296,11 +342,12 @@ def novirt_cancel_check(cancel_funcs, proc):
     return False
 
 
-def anaconda_cleanup(dirinstall_path):
+def anaconda_cleanup(dirinstall_path, pidfile=True):
     """
     Cleanup any leftover mounts from anaconda
 
     :param str dirinstall_path: Path where anaconda mounts things
+    :param bool pidfile: Remove the host's /run/anaconda.pid, False when anaconda had a private /run
     :returns: True if cleanups were successful. False if any of them failed.
 
     If anaconda crashes it may leave things mounted under this path. It will
@@ -314,7 +361,7 @@ def anaconda_cleanup(dirinstall_path):
     # Anaconda may not clean up its /var/run/anaconda.pid file
     # Make sure the process is really finished (it should be, since it was started from a subprocess call)
     # and then remove the pid file.
-    if os.path.exists("/var/run/anaconda.pid"):
+    if pidfile and os.path.exists("/var/run/anaconda.pid"):
         # lorax-composer runs anaconda using unshare so the pid is always 1
         if open("/var/run/anaconda.pid").read().strip() == "1":
             os.unlink("/var/run/anaconda.pid")
@@ -348,10 +395,20 @@ def novirt_install(opts, disk_img, disk_size, cancel_func=None, tar_img=None):
     This method runs anaconda to create the image and then based on the opts
     passed creates a qemu disk image or tarfile.
     """
-    dirinstall_path = ROOT_PATH
+    dirinstall_path = opts.dirinstall_path or ROOT_PATH
+    root_path = dirinstall_path
+
+    # Anaconda writes its logs and state to /tmp and /run, with --anaconda-tmp it
+    # is run with a private /tmp and /run so that more than one install can run at a time.
+    anaconda_tmp = opts.anaconda_tmp or "/tmp"
+    if not os.path.isdir(anaconda_tmp):
+        os.makedirs(anaconda_tmp)
+    host_run_dir = None
+    if opts.anaconda_tmp:
+        host_run_dir = tempfile.mkdtemp(prefix="lmc-run-", dir=os.path.dirname(os.path.abspath(anaconda_tmp)))
 
     # Clean up /tmp/ from previous runs to prevent stale info from being used
-    for path in ["/tmp/yum.repos.d/", "/tmp/yum.cache/"]:
+    for path in [joinpaths(anaconda_tmp, "yum.repos.d/"), joinpaths(anaconda_tmp, "yum.cache/")]:
         if os.path.isdir(path):
             shutil.rmtree(path)
 
@@ -366,11 +423,11 @@ def novirt_install(opts, disk_img, disk_size, cancel_func=None, tar_img=None):
 
     if opts.make_iso or opts.make_fsimage or opts.make_pxe_live:
         # Make a blank fs image
-        args += ["--dirinstall"]
+        args += ["--dirinstall", dirinstall_path]
 
         mkext4img(None, disk_img, label=opts.fs_label, size=disk_size * 1024**2)
         if not os.path.isdir(dirinstall_path):
-            os.mkdir(dirinstall_path)
+            os.makedirs(dirinstall_path)
         mount(disk_img, opts="loop", mnt=dirinstall_path)
     elif opts.make_tar or opts.make_oci:
         # Install under dirinstall_path, make sure it starts clean
@@ -380,9 +437,7 @@ def novirt_install(opts, disk_img, disk_size, cancel_func=None, tar_img=None):
         if opts.make_oci:
             # OCI installs under /rootfs/
             dirinstall_path = joinpaths(dirinstall_path, "rootfs")
-            args += ["--dirinstall", dirinstall_path]
-        else:
-            args += ["--dirinstall"]
+        args += ["--dirinstall", dirinstall_path]
 
         os.makedirs(dirinstall_path)
     else:
@@ -401,7 +456,11 @@ def novirt_install(opts, disk_img, disk_size, cancel_func=None, tar_img=None):
     # Preload libgomp.so.1 to workaround rhbz#1722181
     log.info("Running anaconda.")
     try:
-        unshare_args = [ "--pid", "--kill-child", "--mount", "--propagation", "unchanged", "anaconda" ] + args
+        if host_run_dir:
+            # Keep anaconda's mounts private to its namespace and give it its own /tmp and /run
+            unshare_args = private_tmp_run_args(anaconda_tmp, host_run_dir, ["anaconda"] + args)
+        else:
+            unshare_args = [ "--pid", "--kill-child", "--mount", "--propagation", "unchanged", "anaconda" ] + args
         for line in execReadlines("unshare", unshare_args, reset_lang=False,
                                   env_add={"ANACONDA_PRODUCTNAME": opts.project,
                                            "ANACONDA_PRODUCTVERSION": opts.releasever,
@@ -442,12 +501,16 @@ def novirt_install(opts, disk_img, disk_size, cancel_func=None, tar_img=None):
         log_anaconda = joinpaths(log_dir, "anaconda")
         if not os.path.isdir(log_anaconda):
             os.mkdir(log_anaconda)
-        for l in glob.glob("/tmp/*log")+glob.glob("/tmp/anaconda-tb-*"):
+        for l in glob.glob(joinpaths(anaconda_tmp, "*log"))+glob.glob(joinpaths(anaconda_tmp, "anaconda-tb-*")):
             shutil.copy2(l, log_anaconda)
             os.unlink(l)
 
+        # The mounts on it were only in anaconda's namespace
+        if host_run_dir:
+            os.rmdir(host_run_dir)
+
         # Make sure any leftover anaconda mounts have been cleaned up
-        if not anaconda_cleanup(dirinstall_path):
+        if not anaconda_cleanup(dirinstall_path, pidfile=not host_run_dir):
             raise InstallError("novirt_install cleanup of anaconda mounts failed.")
 
         if not opts.make_iso and not opts.make_fsimage and not opts.make_pxe_live:
@@ -514,9 +577,9 @@ def novirt_install(opts, disk_img, disk_size, cancel_func=None, tar_img=None):
         for arg in opts.compress_args:
             compress_args += arg.split(" ", 1)
 
-        shutil.copy2(opts.oci_config, ROOT_PATH)
-        shutil.copy2(opts.oci_runtime, ROOT_PATH)
-        rc = mktar(ROOT_PATH, disk_img, opts.compression, compress_args)
+        shutil.copy2(opts.oci_config, root_path)
+        shutil.copy2(opts.oci_runtime, root_path)
+        rc = mktar(root_path, disk_img, opts.compression, compress_args)
 
         if rc:
             raise InstallError("novirt_install mktar failed: rc=%s" % rc)
@@ -158,3 +158,28 @@ def _read_file_end(f, size):
     except UnicodeDecodeError:
         return ""
     return text
+
+def read_lines(path, offset, size, complete=True):
+    """Read up to `size` kibibytes of a file, starting at `offset`
+
+    :param path: Path to the file
+    :type path: str
+    :param offset: Offset of the first byte to read
+    :type offset: int
+    :param size: Maximum number of KiB to read
+    :type size: int
+    :param complete: Only return complete lines
+    :type complete: bool
+    :returns: The text and the offset of the next byte to read
+    :rtype: tuple of (str, int)
+
+    With complete=True a partial line at the end is left for the next read, so
+    the text does not end in the middle of a unicode character, unless the line
+    is longer than `size`. Invalid UTF-8 is replaced.
+    """
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = f.read(1024 * size)
+    if complete and len(data) < 1024 * size:
+        data = data[:data.rfind(b'\n') + 1]
+    return (data.decode("UTF-8", errors="replace"), offset + len(data))
@@ -14,9 +14,12 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+import os
+import tempfile
 import unittest
+from unittest import mock
 
-from composer.http_client import api_url, get_filename
+from composer.http_client import api_url, download_image, get_filename
 
 headers = {'content-disposition': 'attachment; filename=e7b9b9b0-5867-493d-89c3-115cfe9227d7-metadata.tar;',
            'access-control-max-age': '21600',
@@ -34,3 +37,41 @@ class HttpClientTest(unittest.TestCase):
     def test_get_filename(self):
         """Return the filename from a content-disposition header"""
         self.assertEqual(get_filename(headers), "e7b9b9b0-5867-493d-89c3-115cfe9227d7-metadata.tar")
+
+class FakeResponse(object):
+    """Response with only the parts of a urllib3 HTTPResponse that download_image() uses"""
+    def __init__(self, status, headers):
+        self.status = status
+        self.headers = headers
+
+    def read(self, _size):
+        return b""
+
+    def release_conn(self):
+        pass
+
+class DownloadImageTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.TemporaryDirectory(prefix="composer.test.download.")
+        os.chdir(self.tmp_dir.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp_dir.cleanup()
+
+    def test_complete_part(self):
+        """Test that a complete .part file is used when the server returns 416"""
+        with open("disk.img.part", "wb") as f:
+            f.write(b"0123456789")
+        image_headers = {"content-disposition": "attachment; filename=disk.img",
+                         "content-length": "10", "etag": '"image-etag"'}
+        http = mock.Mock()
+        http.request.side_effect = [FakeResponse(200, image_headers),
+                                    FakeResponse(416, {"content-range": "bytes */10"})]
+        with mock.patch("composer.http_client.UnixHTTPConnectionPool", return_value=http):
+            self.assertEqual(download_image("/run/weldr/api.socket", "/api/v1/compose/image/uuid", False), 0)
+        self.assertEqual(http.request.call_count, 2)
+        self.assertFalse(os.path.exists("disk.img.part"))
+        with open("disk.img", "rb") as f:
+            self.assertEqual(f.read(), b"0123456789")
@@ -21,7 +21,7 @@ import unittest
 
 import lifted.config
 from lifted.providers import list_providers
-from lifted.queue import _write_callback, create_upload, get_all_uploads, get_upload, get_uploads
+from lifted.queue import _write_callback, _written_status, create_upload, get_all_uploads, get_upload, get_uploads
 from lifted.queue import ready_upload, reset_upload, cancel_upload
 import pylorax.api.config
 
@@ -116,4 +116,10 @@ class QueueTestCase(unittest.TestCase):
         with self.assertRaises(RuntimeError):
             cancel_upload(self.config["upload"], self.upload_uuids[0])
 
+    def test_09_written_status(self):
+        """Test that only the status of unfinished uploads is remembered"""
+        self.assertFalse(self.upload_uuids[0] in _written_status)
+        for uuid in self.upload_uuids[1:]:
+            self.assertEqual(_written_status[uuid], "WAITING")
+
     # TODO test execute
@@ -91,6 +91,10 @@ class UploadTestCase(unittest.TestCase):
             summary = upload.summary()
             self.assertEqual(summary["status"], "READY")
             self.assertEqual(summary["image_path"], "test-image-path")
+            self.assertEqual(upload.image_sha256, None)
+
+            upload.ready("test-image-path", status_callback=None, image_sha256="0123abcd")
+            self.assertEqual(upload.image_sha256, "0123abcd")
 
     def test_reset(self):
         for p in list_providers(self.config["upload"]):
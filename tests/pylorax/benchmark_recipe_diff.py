@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+#
+# Copyright (C) 2020 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Time recipe_diff() and Recipe.freeze() with large synthetic blueprints
+
+Run it from the top of the source tree, eg.::
+
+    PYTHONPATH=./src/ ./tests/pylorax/benchmark_recipe_diff.py --sizes 1000,5000,20000
+
+Each blueprint has the given number of packages, and about a quarter of them are
+added, removed, or changed between the old and the new blueprint. The time should
+grow linearly with the size, if it grows faster than --max-ratio times the size
+it exits with an error.
+"""
+import argparse
+import time
+
+from pylorax.api.recipes import Recipe, RecipeModule, RecipePackage, RecipeGroup, recipe_diff
+
+
+def make_recipe(size, offset, version):
+    """Return a Recipe with size packages, and some modules, groups, and users"""
+    packages = [RecipePackage("package-%06d" % i, version) for i in range(offset, offset + size)]
+    modules = [RecipeModule("module-%06d" % i, version) for i in range(offset, offset + size // 10)]
+    groups = [RecipeGroup("group-%06d" % i) for i in range(offset, offset + size // 10)]
+    customizations = {"user": [{"name": "user-%06d" % i, "groups": [version]}
+                               for i in range(offset, offset + size // 10)]}
+    return Recipe("benchmark", "Benchmark blueprint", "0.0.1", modules, packages, groups, customizations)
+
+def make_deps(size):
+    """Return the depsolved NEVRAs for make_recipe()"""
+    deps = []
+    for prefix in ["package", "module", "group"]:
+        for i in range(size):
+            deps.append({"name": "%s-%06d" % (prefix, i), "epoch": 0, "version": "1.0",
+                         "release": "1", "arch": "x86_64"})
+    return deps
+
+def best_time(fn, repeat):
+    """Return the result of fn and the shortest time it took to run"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return result, min(times)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the blueprint diff")
+    parser.add_argument("--sizes", default="1000,5000,20000",
+                        help="Comma separated numbers of packages in the blueprints")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of times to run each diff")
+    parser.add_argument("--max-ratio", type=float, default=3.0,
+                        help="Maximum growth of the time per package between the smallest and largest size")
+    opts = parser.parse_args()
+
+    sizes = sorted(int(s) for s in opts.sizes.split(","))
+    per_package = {}
+    for size in sizes:
+        # A quarter are removed, a quarter are added, and the versions of the rest change
+        old = make_recipe(size, 0, "1.*")
+        new = make_recipe(size, size // 4, "2.*")
+        diffs, diff_time = best_time(lambda: recipe_diff(old, new), opts.repeat)
+
+        deps = make_deps(size)
+        frozen, freeze_time = best_time(lambda: old.freeze(deps), opts.repeat)
+        if len(frozen["packages"]) != size:
+            print("ERROR: freeze returned %d packages instead of %d" % (len(frozen["packages"]), size))
+            return 1
+
+        print("%7d packages: diff %8.3fs (%d changes)  freeze %8.3fs" % (size, diff_time, len(diffs), freeze_time))
+        per_package[size] = (diff_time + freeze_time) / size
+
+    if len(sizes) > 1 and per_package[sizes[0]] > 0:
+        ratio = per_package[sizes[-1]] / per_package[sizes[0]]
+        print("Time per package grew %.1fx from %d to %d packages" % (ratio, sizes[0], sizes[-1]))
+        if ratio > opts.max_ratio:
+            print("ERROR: The diff is not linear")
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,90 @@
+#
+# Copyright (C) 2020  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import gevent
+import threading
+import unittest
+
+from pylorax.api.blocking import call_blocking, GeventLock
+
+class CallBlockingTest(unittest.TestCase):
+    def test_result(self):
+        """Test that call_blocking returns the result, or raises the exception"""
+        self.assertEqual(call_blocking(sum, [1, 2, 3]), 6)
+        with self.assertRaises(ValueError):
+            call_blocking(int, "one")
+
+    def test_other_greenlets_run(self):
+        """Test that the other greenlets run while call_blocking waits"""
+        event = threading.Event()
+        ticks = []
+        def ticker():
+            while not event.is_set():
+                ticks.append(1)
+                gevent.sleep(0.01)
+        greenlet = gevent.spawn(ticker)
+        threading.Timer(0.2, event.set).start()
+        self.assertTrue(call_blocking(event.wait, 5))
+        greenlet.join()
+        self.assertTrue(len(ticks) > 5, "Only %d ticks while waiting" % len(ticks))
+
+    def test_undo(self):
+        """Test that the result is undone when the waiting greenlet is killed"""
+        lock = threading.Lock()
+        lock.acquire()
+        undone = []
+        def undo(result):
+            undone.append(result)
+            lock.release()
+        greenlet = gevent.spawn(call_blocking, lock.acquire, undo=undo)
+        gevent.sleep(0.1)
+        greenlet.kill()
+        lock.release()
+        for _ in range(100):
+            if undone:
+                break
+            gevent.sleep(0.01)
+        self.assertEqual(undone, [True])
+        self.assertTrue(lock.acquire(False))
+
+class GeventLockTest(unittest.TestCase):
+    def test_thread_holds_lock(self):
+        """Test that greenlets waiting for a lock held by a thread do not block the others"""
+        lock = GeventLock()
+        holding = threading.Event()
+        release = threading.Event()
+        def hold():
+            with lock:
+                holding.set()
+                release.wait(5)
+        thread = threading.Thread(target=hold)
+        thread.start()
+        holding.wait(5)
+
+        self.assertFalse(lock.acquire(False))
+        order = []
+        def waiter():
+            with lock:
+                order.append("waiter")
+        greenlet = gevent.spawn(waiter)
+        gevent.sleep(0.1)
+        # The waiter does not block this greenlet
+        order.append("main")
+        release.set()
+        greenlet.join(5)
+        thread.join(5)
+        self.assertEqual(order, ["main", "waiter"])
+        self.assertFalse(lock.locked())
@@ -19,6 +19,7 @@ import os
 import shutil
 import tempfile
 import unittest
+from unittest import mock
 
 import lifted.config
 from pylorax import get_buildarch
@@ -28,6 +29,7 @@ from pylorax.api.compose import lang_cmd, get_languages, keyboard_cmd, get_keybo
 from pylorax.api.compose import firewall_cmd, get_firewall_settings
 from pylorax.api.compose import services_cmd, get_services, get_default_services
 from pylorax.api.compose import get_kernel_append, bootloader_append, customize_ks_template
+from pylorax.api.compose import compose_cache_key, get_template_info, use_cache_repo
 from pylorax.api.config import configure, make_dnf_dirs
 from pylorax.api.dnfbase import get_base_object
 from pylorax.api.recipes import recipe_from_toml, RecipeError
@@ -838,6 +840,85 @@ class ExtraPkgsTest(unittest.TestCase):
         extra_pkgs = get_extra_pkgs(self.dbo, "./share/", "qcow2")
         self.assertEqual(extra_pkgs, [])
 
+class TemplateInfoTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="lorax.test.repo.")
+        self.config = configure(root_dir=self.tmp_dir, test_config=True)
+        lifted.config.configure(self.config)
+        make_dnf_dirs(self.config, os.getuid(), os.getgid())
+        self.dbo = get_base_object(self.config)
+
+        # Use a copy of the templates so that they can be modified
+        self.share_dir = joinpaths(self.tmp_dir, "share")
+        shutil.copytree("./share/", self.share_dir)
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_template_info(self):
+        """Test that the template details are read and reused"""
+        info = get_template_info(self.dbo, self.share_dir, "tar")
+        self.assertTrue(info.template_size > 0)
+        self.assertEqual(info.extra_pkgs, [])
+        self.assertTrue(info.ks_template.startswith("#"))
+        self.assertTrue(get_template_info(self.dbo, self.share_dir, "tar") is info)
+
+    def test_template_info_changed(self):
+        """Test that the template details are updated when the template changes"""
+        info = get_template_info(self.dbo, self.share_dir, "qcow2")
+        ks_path = joinpaths(self.share_dir, "composer", "qcow2.ks")
+        with open(ks_path, "a") as f:
+            f.write("tmux\n")
+        os.utime(ks_path, ns=(0, os.stat(ks_path).st_mtime_ns + 1))
+        new_info = get_template_info(self.dbo, self.share_dir, "qcow2")
+        self.assertFalse(new_info is info)
+        self.assertTrue(("tmux", "*") in new_info.packages)
+
+    def test_cache_repo_template_packages(self):
+        """Test that the rpm cache repo has the template's packages, and keeps the remote repos"""
+        info = get_template_info(self.dbo, self.share_dir, "qcow2")
+        dep_names = [d["name"] for d in info.template_deps]
+        # The template's packages, and @core
+        for name, _ in info.packages:
+            self.assertTrue(name in dep_names, "%s is missing from the template deps" % name)
+        self.assertTrue("bash" in dep_names)
+
+        results_dir = tempfile.mkdtemp(prefix="results.", dir=self.tmp_dir)
+        ks_path = joinpaths(results_dir, "final-kickstart.ks")
+        ks_repos = 'url --url="http://example.com/os/"\nrepo --name="composer-0" --baseurl="http://example.com/updates/"\n'
+        with open(ks_path, "w") as f:
+            f.write(ks_repos)
+            f.write(info.ks_template)
+            f.write("%end\n")
+
+        cache_repo = joinpaths(results_dir, "cache-repo/")
+        with mock.patch("pylorax.api.compose.create_cache_repo", return_value=cache_repo) as create:
+            self.assertTrue(use_cache_repo(self.config, None, info.template_deps, results_dir, ks_path, ks_repos))
+        self.assertEqual(create.call_args[0][2], info.template_deps)
+
+        ks = open(ks_path).read()
+        self.assertTrue(ks.startswith(ks_repos))
+        self.assertTrue('repo --name="rpmcache" --baseurl="file://%s" --cost=1\n' % cache_repo in ks)
+        self.assertTrue(ks.endswith(info.ks_template + "%end\n"))
+
+    def test_template_info_share_dirs(self):
+        """Test that templates with the same mtime in different share directories are not mixed up"""
+        other_share_dir = joinpaths(self.tmp_dir, "other-share")
+        shutil.copytree("./share/", other_share_dir)
+        ks_path = joinpaths(other_share_dir, "composer", "tar.ks")
+        mtime_ns = os.stat(ks_path).st_mtime_ns
+        with open(ks_path, "a") as f:
+            f.write("tmux\n")
+        os.utime(ks_path, ns=(mtime_ns, mtime_ns))
+
+        info = get_template_info(self.dbo, self.share_dir, "tar")
+        other_info = get_template_info(self.dbo, other_share_dir, "tar")
+        self.assertFalse(("tmux", "*") in info.packages)
+        self.assertTrue(("tmux", "*") in other_info.packages)
+        self.assertTrue(get_template_info(self.dbo, self.share_dir, "tar") is info)
+
 class ComposeTypesTest(unittest.TestCase):
     def test_compose_types(self):
         types = compose_types("./share/")
@@ -845,3 +926,31 @@ class ComposeTypesTest(unittest.TestCase):
 
         if os.uname().machine != 'x86_64':
             self.assertTrue(("alibaba", False) in types)
+
+class ComposeCacheKeyTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="lorax.test.cache.")
+        self.ks_path = joinpaths(self.tmp_dir, "final-kickstart.ks")
+        with open(self.ks_path, "w") as f:
+            f.write("%packages\ntmux-2.8-1.fc29.x86_64\n%end\n")
+        self.deps = [{"name": "tmux", "epoch": 0, "version": "2.8", "release": "1.fc29", "arch": "x86_64"}]
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_cache_key(self):
+        """Test that the cache key ignores the build's paths"""
+        key_1 = compose_cache_key(self.deps, self.ks_path, {"image_name": "root.tar.xz", "ks": ["/results/1/final-kickstart.ks"],
+                                                            "logfile": "/results/1/logs/"})
+        key_2 = compose_cache_key(self.deps, self.ks_path, {"image_name": "root.tar.xz", "ks": ["/results/2/final-kickstart.ks"],
+                                                            "logfile": "/results/2/logs/"})
+        self.assertEqual(key_1, key_2)
+
+    def test_cache_key_changes(self):
+        """Test that the cache key changes when the packages or settings change"""
+        key = compose_cache_key(self.deps, self.ks_path, {"image_name": "root.tar.xz"})
+        self.assertNotEqual(key, compose_cache_key(self.deps, self.ks_path, {"image_name": "disk.qcow2"}))
+        deps = [dict(self.deps[0], release="2.fc29")]
+        self.assertNotEqual(key, compose_cache_key(deps, self.ks_path, {"image_name": "root.tar.xz"}))
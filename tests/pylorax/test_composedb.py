@@ -0,0 +1,97 @@
+#
+# Copyright (C) 2020  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import hashlib
+import shutil
+import tempfile
+import unittest
+
+from pylorax.api.composedb import ComposeIndex, read_image_checksum, write_image_checksum
+from pylorax.sysutils import joinpaths
+
+def make_detail(build_id, status, created):
+    return {"id": build_id, "queue_status": status, "job_created": created,
+            "job_started": None, "job_finished": None, "compose_type": "tar",
+            "blueprint": "example", "version": "0.0.1", "image_size": 0,
+            "image_sha256": None}
+
+class ComposeIndexTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.test_dir = tempfile.mkdtemp(prefix="lorax.composedb.")
+        self.index = ComposeIndex(joinpaths(self.test_dir, "composes.db"))
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.test_dir)
+
+    def setUp(self):
+        self.index.clear()
+
+    def test_put_get(self):
+        """Test storing and reading a build's details"""
+        detail = make_detail("build-1", "WAITING", 1.0)
+        self.index.put(detail)
+        self.assertEqual(self.index.get("build-1"), detail)
+        self.assertEqual(self.index.get("missing-build"), None)
+
+    def test_replace(self):
+        """Test that replace=False does not overwrite a newer state"""
+        self.index.put(make_detail("build-1", "RUNNING", 1.0))
+        self.index.put(make_detail("build-1", "WAITING", 1.0), replace=False)
+        self.assertEqual(self.index.get("build-1")["queue_status"], "RUNNING")
+        self.index.put(make_detail("build-1", "FINISHED", 1.0))
+        self.assertEqual(self.index.get("build-1")["queue_status"], "FINISHED")
+
+    def test_list(self):
+        """Test listing builds by status, oldest first"""
+        self.index.put(make_detail("build-2", "FINISHED", 2.0))
+        self.index.put(make_detail("build-1", "FINISHED", 1.0))
+        self.index.put(make_detail("build-3", "FAILED", 3.0))
+        self.assertEqual([d["id"] for d in self.index.list(["FINISHED"])], ["build-1", "build-2"])
+        self.assertEqual([d["id"] for d in self.index.list()], ["build-1", "build-2", "build-3"])
+        self.assertEqual(self.index.ids(), set(["build-1", "build-2", "build-3"]))
+
+    def test_uploads(self):
+        """Test storing the uploads for a build"""
+        self.index.put(make_detail("build-1", "FINISHED", 1.0))
+        self.index.set_uploads("build-1", ["upload-1", "upload-2"])
+        self.assertEqual(self.index.get_uploads("build-1"), frozenset(["upload-1", "upload-2"]))
+        self.assertEqual(self.index.upload_build("upload-2"), "build-1")
+        self.index.delete("build-1")
+        self.assertEqual(self.index.get("build-1"), None)
+        self.assertEqual(self.index.get_uploads("build-1"), frozenset())
+        self.assertEqual(self.index.upload_build("upload-2"), None)
+
+    def test_find_cached(self):
+        """Test finding the newest FINISHED build with a cache key"""
+        self.index.put(make_detail("build-1", "FINISHED", 1.0))
+        self.index.put(make_detail("build-2", "FINISHED", 2.0))
+        self.index.put(make_detail("build-3", "FAILED", 3.0))
+        for build_id in ("build-1", "build-2", "build-3"):
+            self.index.set_cache_key(build_id, "KEY")
+        self.assertEqual(self.index.find_cached("KEY"), "build-2")
+        self.assertEqual(self.index.find_cached("OTHER-KEY"), None)
+
+    def test_image_checksum(self):
+        """Test storing and reading the image's SHA-256"""
+        self.assertEqual(read_image_checksum(self.test_dir), None)
+        image_path = joinpaths(self.test_dir, "disk.img")
+        with open(image_path, "wb") as f:
+            f.write(b"TEST IMAGE" * 1024**2)
+        checksum = hashlib.sha256(b"TEST IMAGE" * 1024**2).hexdigest()
+        self.assertEqual(write_image_checksum(self.test_dir, image_path), checksum)
+        self.assertEqual(read_image_checksum(self.test_dir), checksum)
@@ -0,0 +1,58 @@
+#
+# Copyright (C) 2020  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import os
+import shutil
+import tempfile
+import unittest
+
+from pylorax.api.dirwatch import DirWatch, EVENT_HEADER, IN_CREATE, parse_events
+from pylorax.sysutils import joinpaths
+
+class DirWatchTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.test_dir = tempfile.mkdtemp(prefix="lorax.dirwatch.")
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_parse_events(self):
+        """Test parsing the names from inotify events"""
+        buf = EVENT_HEADER.pack(1, IN_CREATE, 0, 8) + b"abcd\0\0\0\0"
+        buf += EVENT_HEADER.pack(1, IN_CREATE, 0, 0)
+        buf += EVENT_HEADER.pack(1, IN_CREATE, 0, 4) + b"efg\0"
+        self.assertEqual(parse_events(buf), set(["abcd", "efg"]))
+
+    def test_timeout(self):
+        """Test that wait returns None when nothing changes"""
+        watch = DirWatch(self.test_dir)
+        try:
+            self.assertEqual(watch.wait(0.1), None)
+        finally:
+            watch.close()
+
+    def test_symlink(self):
+        """Test that a new symlink wakes up the watch"""
+        watch = DirWatch(self.test_dir)
+        try:
+            if watch.polling:
+                self.skipTest("inotify is not available")
+            os.symlink(self.test_dir, joinpaths(self.test_dir, "new-link"))
+            self.assertEqual(watch.wait(5), set(["new-link"]))
+        finally:
+            watch.close()
@@ -16,14 +16,22 @@
 #
 import os
 import shutil
+import signal
+import subprocess
 import tempfile
+from threading import Thread
+import time
 import unittest
 
 import configparser
+import dnf
+import gevent
 
 import lifted.config
 from pylorax.api.config import configure, make_dnf_dirs
-from pylorax.api.dnfbase import get_base_object
+from pylorax.api.dnfbase import get_base_object, DNFLock
+from pylorax.api.projects import DEPSOLVE_CACHE, ProjectsError
+from pylorax.dnfbase import get_dnf_base_object
 
 
 class DnfbaseNoSystemReposTest(unittest.TestCase):
@@ -97,6 +105,105 @@ class DnfbaseSystemReposTest(unittest.TestCase):
         self.assertTrue(len(self.dbo.repos) > 0)
 
 
+def _query_pid(dbo, secs=0):
+    """Return the pid of the process that ran the query, after secs"""
+    time.sleep(secs)
+    return os.getpid()
+
+def _query_error(dbo):
+    raise ProjectsError("No such project")
+
+def _query_cache(dbo, key):
+    DEPSOLVE_CACHE.put(key, ["result"])
+    return None
+
+class DNFLockTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="lorax.test.dnfbase.")
+        conf_file = os.path.join(self.tmp_dir, 'test.conf')
+        open(conf_file, 'w').write("""[composer]
+[repos]
+use_system_repos = False
+""")
+        config = configure(conf_file=conf_file, root_dir=self.tmp_dir)
+        lifted.config.configure(config)
+        make_dnf_dirs(config, os.getuid(), os.getgid())
+        self.dnflock = DNFLock(config)
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_refresh_unchanged(self):
+        """Test that refresh() keeps the dnf.Base object when the metadata has not changed"""
+        dbo = self.dnflock.dbo
+        self.assertFalse(self.dnflock.refresh())
+        self.assertTrue(self.dnflock.dbo is dbo)
+
+    def test_sources_changed_elsewhere(self):
+        """Test that a DNFLock reloads the metadata when another one changes the sources"""
+        other = DNFLock(self.dnflock._conf)
+        dbo = self.dnflock.dbo
+        with other.lock:
+            other.invalidate()
+        with self.dnflock.lock:
+            self.assertFalse(self.dnflock.dbo is dbo)
+
+        # Its own changes do not reload it
+        dbo = self.dnflock.dbo
+        with self.dnflock.lock:
+            self.dnflock.invalidate()
+        with self.dnflock.lock:
+            self.assertTrue(self.dnflock.dbo is dbo)
+
+    def test_query_workers(self):
+        """Test that the queries are run by worker processes at the same time"""
+        start = time.time()
+        greenlets = [gevent.spawn(self.dnflock.query, _query_pid, 1) for _ in range(2)]
+        gevent.joinall(greenlets, timeout=10)
+        self.assertTrue(time.time() - start < 1.9, "The queries did not run at the same time")
+        pids = set(g.value for g in greenlets)
+        self.assertEqual(len(pids), 2)
+        self.assertTrue(os.getpid() not in pids)
+
+        # The workers are reused
+        self.assertTrue(self.dnflock.query(_query_pid) in pids)
+
+    def test_query_error(self):
+        """Test that the exception raised by a query is raised by query()"""
+        with self.assertRaises(ProjectsError):
+            self.dnflock.query(_query_error)
+
+    def test_query_cache(self):
+        """Test that the results cached by a worker are added to DEPSOLVE_CACHE"""
+        key = ("test_query_cache",)
+        self.dnflock.query(_query_cache, key)
+        self.assertEqual(DEPSOLVE_CACHE.get(key), ["result"])
+
+    def test_query_new_workers(self):
+        """Test that the workers are replaced when the sources change"""
+        pid = self.dnflock.query(_query_pid)
+        with self.dnflock.lock:
+            self.dnflock.invalidate()
+        self.assertNotEqual(self.dnflock.query(_query_pid), pid)
+        with self.assertRaises(ProcessLookupError):
+            os.kill(pid, 0)
+
+    def test_query_dead_worker(self):
+        """Test that a worker that has been killed is replaced"""
+        pid = self.dnflock.query(_query_pid)
+        os.kill(pid, signal.SIGKILL)
+        self.assertNotEqual(self.dnflock.query(_query_pid), pid)
+
+    def test_query_thread(self):
+        """Test that queries from other threads are run in the process"""
+        pids = []
+        thread = Thread(target=lambda: pids.append(self.dnflock.query(_query_pid)))
+        thread.start()
+        thread.join(10)
+        self.assertEqual(pids, [os.getpid()])
+
 class CreateDnfDirsTest(unittest.TestCase):
     @classmethod
     def setUpClass(self):
@@ -114,3 +221,58 @@ class CreateDnfDirsTest(unittest.TestCase):
         make_dnf_dirs(config, os.getuid(), os.getgid())
 
         self.assertTrue(os.path.exists(self.tmp_dir + '/var/tmp/composer/dnf/root'))
+
+class LoadReposTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="lorax.test.dnfbase.")
+        self.repos = []
+        for i in range(4):
+            repo_dir = os.path.join(self.tmp_dir, "repo-%d" % i)
+            os.makedirs(repo_dir)
+            subprocess.check_call(["createrepo_c", repo_dir])
+            self.repos.append("file://" + repo_dir)
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_load_repos(self):
+        """Test that all of the sources are loaded"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as root_dir:
+            dbo = get_dnf_base_object(root_dir, self.repos, enablerepos=[], disablerepos=[])
+            self.assertTrue(dbo is not None)
+            self.assertEqual(sorted(r.id for r in dbo.repos.iter_enabled()),
+                             ["lorax-repo-%d" % i for i in range(4)])
+
+    def test_missing_repo(self):
+        """Test that a source that cannot be loaded returns None"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as root_dir:
+            missing = "file://" + os.path.join(self.tmp_dir, "missing-repo")
+            dbo = get_dnf_base_object(root_dir, self.repos + [missing], enablerepos=[], disablerepos=[])
+            self.assertEqual(dbo, None)
+
+    def _broken_repo(self, root_dir, skip_if_unavailable):
+        """Write a .repo file for a repository that cannot be loaded"""
+        repo_path = os.path.join(root_dir, "broken.repo")
+        with open(repo_path, "w") as f:
+            f.write("[broken]\nname=Broken\nbaseurl=file://%s\nskip_if_unavailable=%d\n"
+                    % (os.path.join(self.tmp_dir, "missing-repo"), skip_if_unavailable))
+        return repo_path
+
+    def test_skip_broken_repo(self):
+        """Test that a failed repo with skip_if_unavailable is disabled"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as root_dir:
+            dbo = get_dnf_base_object(root_dir, self.repos, repos=[self._broken_repo(root_dir, 1)],
+                                      enablerepos=[], disablerepos=[], tempdir=root_dir)
+            self.assertTrue(dbo is not None)
+            self.assertFalse(dbo.repos["broken"].enabled)
+            self.assertEqual(sorted(r.id for r in dbo.repos.iter_enabled()),
+                             ["lorax-repo-%d" % i for i in range(4)])
+
+    def test_broken_repo(self):
+        """Test that a failed repo without skip_if_unavailable raises an error"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.") as root_dir:
+            with self.assertRaises(dnf.exceptions.RepoError):
+                get_dnf_base_object(root_dir, self.repos, repos=[self._broken_repo(root_dir, 0)],
+                                    enablerepos=[], disablerepos=[], tempdir=root_dir)
@@ -0,0 +1,169 @@
+#
+# Copyright (C) 2020  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import gzip
+from io import BytesIO
+import os
+import tarfile
+import tempfile
+import unittest
+from unittest import mock
+
+from flask import Flask, request
+
+from pylorax.api.download import file_etag, parse_range, send_file_range, send_tar
+from pylorax.api.utils import tar_file_members
+
+class ParseRangeTest(unittest.TestCase):
+    def test_ranges(self):
+        """Test parsing single ranges"""
+        self.assertEqual(parse_range("bytes=0-99", 1000), (0, 99))
+        self.assertEqual(parse_range("bytes=500-", 1000), (500, 999))
+        self.assertEqual(parse_range("bytes=900-2000", 1000), (900, 999))
+        self.assertEqual(parse_range("bytes=-100", 1000), (900, 999))
+        self.assertEqual(parse_range("bytes=-2000", 1000), (0, 999))
+
+    def test_whole_file(self):
+        """Test that missing, multiple, and invalid ranges return the whole file"""
+        self.assertEqual(parse_range(None, 1000), None)
+        self.assertEqual(parse_range("bytes=0-9,20-29", 1000), None)
+        self.assertEqual(parse_range("items=0-9", 1000), None)
+        self.assertEqual(parse_range("bytes=9-0", 1000), None)
+        self.assertEqual(parse_range("bytes=a-b", 1000), None)
+
+    def test_unsatisfiable(self):
+        """Test that ranges after the end of the file raise an error"""
+        with self.assertRaises(ValueError):
+            parse_range("bytes=1000-", 1000)
+        with self.assertRaises(ValueError):
+            parse_range("bytes=-0", 1000)
+
+class SendFileRangeTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.tmp_dir = tempfile.TemporaryDirectory(prefix="lorax.test.download.")
+        self.path = os.path.join(self.tmp_dir.name, "disk.img")
+        with open(self.path, "wb") as f:
+            f.write(b"0123456789")
+
+        app = Flask("test_download")
+        @app.route("/image")
+        def image():
+            return send_file_range(request, self.path, "disk.img")
+        self.client = app.test_client()
+
+    @classmethod
+    def tearDownClass(self):
+        self.tmp_dir.cleanup()
+
+    def test_get(self):
+        """Test getting the whole file"""
+        resp = self.client.get("/image")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, b"0123456789")
+        self.assertEqual(resp.headers["ETag"], file_etag(self.path))
+        self.assertEqual(resp.headers["Content-Disposition"], "attachment; filename=disk.img")
+
+    def test_range(self):
+        """Test getting part of the file"""
+        resp = self.client.get("/image", headers={"Range": "bytes=2-4"})
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.data, b"234")
+        self.assertEqual(resp.headers["Content-Range"], "bytes 2-4/10")
+        self.assertEqual(resp.headers["Content-Length"], "3")
+
+    def test_if_range(self):
+        """Test that a Range with an old ETag returns the whole file"""
+        resp = self.client.get("/image", headers={"Range": "bytes=2-", "If-Range": file_etag(self.path)})
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.data, b"23456789")
+
+        resp = self.client.get("/image", headers={"Range": "bytes=2-", "If-Range": '"old-etag"'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, b"0123456789")
+
+    def test_unsatisfiable(self):
+        """Test that a Range after the end of the file returns 416"""
+        resp = self.client.get("/image", headers={"Range": "bytes=10-"})
+        self.assertEqual(resp.status_code, 416)
+        self.assertEqual(resp.headers["Content-Range"], "bytes */10")
+
+    def test_head(self):
+        """Test that HEAD returns the headers without the file"""
+        resp = self.client.head("/image")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, b"")
+        self.assertEqual(resp.headers["Content-Length"], "10")
+
+    def test_head_not_opened(self):
+        """Test that HEAD does not open the file, nothing would close it"""
+        with mock.patch("pylorax.api.download.open", side_effect=AssertionError("opened"), create=True):
+            resp = self.client.head("/image", headers={"Range": "bytes=2-4"})
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.headers["Content-Length"], "3")
+
+    def test_not_modified(self):
+        """Test that If-None-Match with the ETag returns 304"""
+        resp = self.client.get("/image", headers={"If-None-Match": file_etag(self.path)})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, b"")
+
+class SendTarTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.tmp_dir = tempfile.TemporaryDirectory(prefix="lorax.test.download.")
+        os.makedirs(os.path.join(self.tmp_dir.name, "logs"))
+        with open(os.path.join(self.tmp_dir.name, "logs", "combined.log"), "w") as f:
+            f.write("log\n" * 1000)
+        with open(os.path.join(self.tmp_dir.name, "disk.img"), "wb") as f:
+            f.write(os.urandom(1024**2 + 1))
+        members = tar_file_members(self.tmp_dir.name, ["disk.img", "logs"])
+
+        app = Flask("test_download")
+        @app.route("/tar")
+        def tar():
+            try:
+                return send_tar(request, members, "results")
+            except ValueError as e:
+                return str(e), 400
+        self.client = app.test_client()
+
+    @classmethod
+    def tearDownClass(self):
+        self.tmp_dir.cleanup()
+
+    def test_tar(self):
+        """Test the uncompressed tar and its size"""
+        resp = self.client.get("/tar")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers["Content-Length"], str(len(resp.data)))
+        self.assertEqual(resp.headers["Content-Disposition"], "attachment; filename=results.tar;")
+        with tarfile.open(fileobj=BytesIO(resp.data)) as tar:
+            self.assertEqual(tar.getnames(), ["disk.img", "logs", "logs/combined.log"])
+            self.assertEqual(tar.extractfile("logs/combined.log").read(), b"log\n" * 1000)
+
+    def test_gzip(self):
+        """Test the gzip compressed tar"""
+        resp = self.client.get("/tar?compression=gzip")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers["Content-Disposition"], "attachment; filename=results.tar.gz;")
+        self.assertEqual(resp.mimetype, "application/gzip")
+        self.assertEqual(gzip.decompress(resp.data), self.client.get("/tar").data)
+
+    def test_unknown_compression(self):
+        """Test that an unknown compression is an error"""
+        resp = self.client.get("/tar?compression=bzip2")
+        self.assertEqual(resp.status_code, 400)
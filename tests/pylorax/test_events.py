@@ -0,0 +1,72 @@
+#
+# Copyright (C) 2020  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from pylorax.api.events import EventLog, publish_event
+from pylorax.sysutils import joinpaths
+
+class EventLogTest(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(prefix="lorax.events.")
+        self.events = EventLog(joinpaths(self.test_dir, "events"))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_publish(self):
+        """Test reading the events after an id"""
+        self.assertEqual(self.events.last_id(), 0)
+        first = self.events.publish("compose", {"id": "build-1", "queue_status": "WAITING"})
+        second = self.events.publish("upload", {"uuid": "upload-1", "status": "READY"})
+        self.assertEqual(self.events.last_id(), second)
+
+        events = self.events.since(0)
+        self.assertEqual([(e["id"], e["type"]) for e in events], [(first, "compose"), (second, "upload")])
+        self.assertEqual(events[1]["data"], {"uuid": "upload-1", "status": "READY"})
+        self.assertEqual(self.events.since(second), [])
+
+    def test_missed(self):
+        """Test that only the most recent events are kept"""
+        with mock.patch("pylorax.api.events.MAX_EVENTS", 5):
+            for i in range(10):
+                self.events.publish("compose", {"id": "build-%d" % i})
+        self.assertEqual([e["data"]["id"] for e in self.events.since(0)],
+                         ["build-%d" % i for i in range(5, 10)])
+        self.assertTrue(self.events.missed(0))
+        self.assertFalse(self.events.missed(5))
+
+    def test_watch(self):
+        """Test that publishing an event wakes up the watch"""
+        watch = self.events.watch()
+        try:
+            if watch.polling:
+                self.skipTest("inotify is not available")
+            publish_event(self.events.path, "compose", {"id": "build-1"})
+            self.assertNotEqual(watch.wait(5), None)
+            # Reading the events does not wake it up
+            self.events.since(0)
+            self.assertEqual(watch.wait(0.1), None)
+        finally:
+            watch.close()
+
+    def test_publish_disabled(self):
+        """Test that publishing without an events directory does nothing"""
+        publish_event(None, "compose", {"id": "build-1"})
+        self.assertEqual(self.events.last_id(), 0)
@@ -0,0 +1,87 @@
+#
+# Copyright (C) 2020 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from pylorax.api.gitmaint import count_objects, git_dir_path, maintain_repo, start_repo_maintenance
+import pylorax.api.recipes as recipes
+from pylorax.sysutils import joinpaths
+
+class RecordingLock(object):
+    """Test class for the git lock that records when it is held"""
+    held = False
+
+    def __enter__(self):
+        self.held = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.held = False
+
+class GitMaintenanceTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.repo_dir = tempfile.mkdtemp(prefix="lorax.test.repo.")
+        self.repo = recipes.open_or_create_repo(self.repo_dir)
+        recipes.commit_recipe_directory(self.repo, "master", "./tests/pylorax/blueprints/")
+        recipes.tag_recipe_commit(self.repo, "master", "example-http-server")
+        self.git_dir = git_dir_path(self.repo)
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.repo_dir)
+
+    def test_01_maintain_repo(self):
+        """Test that the objects and refs are packed"""
+        commits = recipes.list_commits(self.repo, "master", "example-http-server.toml")
+        (before, after) = maintain_repo(self.git_dir)
+        self.assertTrue(before["loose_objects"] > 0)
+        self.assertEqual(after["loose_objects"], 0)
+        self.assertEqual(after["loose_refs"], 0)
+        self.assertTrue(after["packed_objects"] >= before["loose_objects"])
+        self.assertTrue(os.path.exists(joinpaths(self.git_dir, "objects/info/commit-graph")))
+
+        # The open repository still reads the packed history and tags
+        recipe = recipes.read_recipe_commit(self.repo, "master", "example-http-server")
+        self.assertEqual(recipe["name"], "example-http-server")
+        index = recipes.commit_index(self.repo)
+        index.add("master", "0" * 40, 1, [], replace=True)
+        self.assertEqual(recipes.list_commits(self.repo, "master", "example-http-server.toml"), commits)
+
+    def test_02_commit_after_maintenance(self):
+        """Test that new commits work after the repository is packed"""
+        recipe = recipes.read_recipe_commit(self.repo, "master", "example-http-server")
+        recipe["description"] = "Changed after packing"
+        recipes.commit_recipe(self.repo, "master", recipe)
+        self.assertEqual(count_objects(self.git_dir)["loose_refs"], 1)
+        self.assertEqual(len(recipes.list_commits(self.repo, "master", "example-http-server.toml")), 2)
+
+    def test_03_lock(self):
+        """Test that the lock is only held while the refs are packed"""
+        lock = RecordingLock()
+        calls = []
+        with mock.patch("pylorax.api.gitmaint.run_git", side_effect=lambda git_dir, args: calls.append((args[0], lock.held))):
+            maintain_repo(self.git_dir, lock)
+        self.assertEqual(calls, [("pack-refs", True), ("repack", False), ("prune", False), ("commit-graph", False)])
+        self.assertFalse(lock.held)
+
+    def test_disabled(self):
+        """Test that an interval of 0 disables the maintenance"""
+        self.assertEqual(start_repo_maintenance(None, 0), None)
@@ -0,0 +1,66 @@
+#
+# Copyright (C) 2020  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from pylorax.installer import private_tmp_run_args
+from pylorax.sysutils import joinpaths
+
+# Stand-in for anaconda, it refuses to start if there is a pid file, like anaconda does,
+# and checks that its pid file and /tmp have not been changed by the other install.
+FAKE_ANACONDA = """
+test -e /run/anaconda.pid && exit 2
+echo "$1" > /run/anaconda.pid
+echo "$1" > /tmp/install
+sleep 1
+test "$(cat /run/anaconda.pid)" = "$1" || exit 3
+test "$(cat /tmp/install)" = "$1" || exit 4
+test -e "/run/$2" || exit 5
+"""
+
+@unittest.skipUnless(os.getuid() == 0 and shutil.which("unshare"), "Needs to run as root with unshare")
+class PrivateTmpRunTest(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(prefix="lorax.installer.")
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_concurrent_installs(self):
+        """Test running two installs at once with a private /tmp and /run"""
+        # Something from the host's /run that the installs should still see
+        host_entry = sorted(n for n in os.listdir("/run") if not n.startswith("anaconda"))[0]
+
+        procs = []
+        for name in ["first", "second"]:
+            tmp_dir = joinpaths(self.test_dir, name, "tmp")
+            host_run_dir = joinpaths(self.test_dir, name, "run")
+            os.makedirs(tmp_dir)
+            os.makedirs(host_run_dir)
+            cmd = ["sh", "-c", FAKE_ANACONDA, "sh", name, host_entry]
+            procs.append((name, subprocess.Popen(["unshare"] + private_tmp_run_args(tmp_dir, host_run_dir, cmd))))
+
+        for name, proc in procs:
+            self.assertEqual(proc.wait(), 0, "%s install failed" % name)
+            self.assertEqual(open(joinpaths(self.test_dir, name, "tmp", "install")).read(), name + "\n")
+            # Nothing was left mounted on the host
+            self.assertEqual(os.listdir(joinpaths(self.test_dir, name, "run")), [])
+
+        self.assertFalse(os.path.exists("/run/anaconda.pid"))
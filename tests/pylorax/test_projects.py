@@ -16,6 +16,7 @@
 #
 import dnf
 from glob import glob
+import json
 import os
 import shutil
 import tempfile
@@ -27,9 +28,12 @@ from pylorax.sysutils import joinpaths
 from pylorax.api.config import configure, make_dnf_dirs
 from pylorax.api.projects import api_time, api_changelog, pkg_to_project, pkg_to_project_info, pkg_to_dep
 from pylorax.api.projects import proj_to_module, projects_list, projects_info, projects_depsolve
+from pylorax.api.projects import projects_page, project_index
 from pylorax.api.projects import modules_list, modules_info, ProjectsError, dep_evra, dep_nevra
 from pylorax.api.projects import repo_to_source, get_repo_sources, delete_repo_source, source_to_repo
 from pylorax.api.projects import source_to_repodict, dnf_repo_to_file_repo
+from pylorax.api.projects import DepsolveCache, DEPSOLVE_CACHE, depsolve_cache_key
+from pylorax.api.projects import FileCountCache, estimate_size
 from pylorax.api.dnfbase import get_base_object
 
 class Package(object):
@@ -151,6 +155,48 @@ class ProjectsTest(unittest.TestCase):
         projects = projects_list(self.dbo)
         self.assertEqual(len(projects) > 10, True)
 
+    def test_projects_page(self):
+        projects, total = projects_page(self.dbo, 0, 5)
+        self.assertEqual(len(projects), 5)
+        self.assertEqual(total, len(projects_list(self.dbo)))
+        self.assertEqual(projects, projects_list(self.dbo)[:5])
+
+        projects, _ = projects_page(self.dbo, 5, 5)
+        self.assertEqual(projects, projects_list(self.dbo)[5:10])
+
+    def test_projects_page_search(self):
+        projects, total = projects_page(self.dbo, 0, 100, "BAS")
+        self.assertEqual(len(projects), total)
+        self.assertTrue(all("bas" in p["name"].lower() for p in projects))
+        self.assertEqual(projects[0]["name"], "bash")
+
+        # The projects starting with the search string are listed first
+        starts = [p["name"].lower().startswith("bas") for p in projects]
+        self.assertEqual(starts, sorted(starts, reverse=True))
+
+        projects, total = projects_page(self.dbo, 0, 20, "nada-package")
+        self.assertEqual((projects, total), ([], 0))
+
+    def test_projects_index_shared(self):
+        """Test that the index is only built once for the same metadata"""
+        self.assertTrue(project_index(self.dbo) is project_index(self.dbo))
+
+    def test_projects_info_copy(self):
+        """Test that changing the returned projects does not change the index"""
+        projects = projects_info(self.dbo, ["bash"])
+        projects[0]["dependencies"] = []
+        projects[0]["builds"].append({})
+        projects = projects_info(self.dbo, ["bash"])
+        self.assertTrue("dependencies" not in projects[0])
+        self.assertTrue({} not in projects[0]["builds"])
+
+    def test_projects_info_glob(self):
+        projects = projects_info(self.dbo, ["bas*", "tar"])
+        names = [p["name"] for p in projects]
+        self.assertTrue("bash" in names)
+        self.assertTrue("tar" in names)
+        self.assertEqual(names, sorted(names, key=lambda n: n.lower()))
+
     def test_projects_info(self):
         projects = projects_info(self.dbo, ["bash"])
 
@@ -180,6 +226,21 @@ class ProjectsTest(unittest.TestCase):
         with self.assertRaises(ProjectsError):
             projects_depsolve(self.dbo, [("nada-package", "*.*")], [])
 
+    def test_estimate_size_file_counts(self):
+        """Test that the saved file counts are used, and give the same size as counting the files"""
+        pkgs = list(self.dbo.sack.query().available().filter(name=["bash", "filesystem", "glibc"], latest=1))
+        self.assertTrue(len(pkgs) >= 3)
+        size = estimate_size(pkgs)
+
+        path = joinpaths(self.tmp_dir, "file-counts.json")
+        file_counts = FileCountCache(path)
+        self.assertEqual(estimate_size(pkgs, file_counts=file_counts), size)
+        file_counts.save(self.dbo)
+
+        # The file lists are not used again
+        no_files = [NoFilesPackage(str(p), p.installsize) for p in pkgs]
+        self.assertEqual(estimate_size(no_files, file_counts=FileCountCache(path)), size)
+
     def test_shim_depsolve(self):
         """Test that requesting shim pulls in shim-*"""
         deps = projects_depsolve(self.dbo, [("shim", "*")], [])
@@ -216,6 +277,170 @@ class ProjectsTest(unittest.TestCase):
         self.assertTrue("ctags" in names)               # default package
         self.assertFalse("cmake" in names)              # optional package
 
+    def test_projects_depsolve_cached(self):
+        """Test that repeating a depsolve uses the cache"""
+        DEPSOLVE_CACHE.clear()
+        deps = projects_depsolve(self.dbo, [("bash", "*"), ("bash", "*")], [])
+        hits = DEPSOLVE_CACHE.stats()["hits"]
+        cached = projects_depsolve(self.dbo, [("bash", "*")], [])
+        self.assertEqual(DEPSOLVE_CACHE.stats()["hits"], hits + 1)
+        self.assertEqual(deps, cached)
+
+        # Changing the returned list must not change the cached copy
+        cached[0]["name"] = "changed"
+        self.assertEqual(projects_depsolve(self.dbo, [("bash", "*")], []), deps)
+
+    def test_depsolve_cache_key(self):
+        """Test that the cache key does not depend on the order of the request"""
+        self.assertEqual(depsolve_cache_key(self.dbo, "depsolve", [("tmux", "*"), ("bash", "*")], ["a", "b"]),
+                         depsolve_cache_key(self.dbo, "depsolve", [("bash", "*"), ("tmux", "*")], ["b", "a"]))
+        self.assertNotEqual(depsolve_cache_key(self.dbo, "depsolve", [("bash", "*")], []),
+                            depsolve_cache_key(self.dbo, "depsolve", [("bash", "5.*")], []))
+        self.assertNotEqual(depsolve_cache_key(self.dbo, "depsolve_with_size", [("bash", "*")], [], True),
+                            depsolve_cache_key(self.dbo, "depsolve_with_size", [("bash", "*")], [], False))
+
+class DepsolveCacheTest(unittest.TestCase):
+    def test_lru(self):
+        """Test that the least recently used result is removed"""
+        cache = DepsolveCache(max_size=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("c", 3)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(cache.stats(), {"hits": 3, "misses": 1, "size": 2, "max_size": 2})
+
+    def test_clear(self):
+        """Test that clear removes the results and keeps the statistics"""
+        cache = DepsolveCache()
+        cache.put("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        cache.clear()
+        self.assertEqual(cache.get("a"), None)
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 1, "size": 0, "max_size": 128})
+
+class FilesPackage(object):
+    """Test class for a hawkey.Package with files"""
+    def __init__(self, nevra, files, installsize):
+        self.nevra = nevra
+        self.files = files
+        self.installsize = installsize
+
+    def __str__(self):
+        return self.nevra
+
+class NoFilesPackage(FilesPackage):
+    """Test class for a hawkey.Package that must not have its files listed"""
+    def __init__(self, nevra, installsize):
+        super().__init__(nevra, None, installsize)
+
+    @property
+    def files(self):
+        raise AssertionError("The files of %s were listed" % self.nevra)
+
+    @files.setter
+    def files(self, value):
+        pass
+
+class AvailableBase(object):
+    """Test class for a dnf.Base with the available packages"""
+    def __init__(self, pkgs):
+        self.sack = self
+        self._pkgs = pkgs
+
+    def query(self):
+        return self
+
+    def available(self):
+        return self._pkgs
+
+class FileCountCacheTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="lorax.test.filecounts.")
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_estimate_size(self):
+        """Test that the saved file counts give the same size as counting the files"""
+        pkgs = [FilesPackage("a-1.0-1.noarch", ["/a", "/b"], 100),
+                FilesPackage("b-1.0-1.noarch", ["/c"], 10)]
+        path = joinpaths(self.tmp_dir, "estimate.json")
+        file_counts = FileCountCache(path)
+        self.assertEqual(estimate_size(pkgs), 3 * 6144 + 110)
+        self.assertEqual(estimate_size(pkgs, file_counts=file_counts), estimate_size(pkgs))
+        self.assertEqual(estimate_size(pkgs, 4096, file_counts), 3 * 4096 + 110)
+
+    def test_saved(self):
+        """Test that the counts are read back from the file instead of counting the files"""
+        path = joinpaths(self.tmp_dir, "saved.json")
+        file_counts = FileCountCache(path)
+        self.assertEqual(file_counts.count(FilesPackage("a-1.0-1.noarch", ["/a", "/b"], 100)), 2)
+        file_counts.save()
+        self.assertTrue(os.path.exists(path))
+
+        file_counts = FileCountCache(path)
+        self.assertEqual(file_counts.count(FilesPackage("a-1.0-1.noarch", [], 100)), 2)
+        self.assertEqual(file_counts.count(FilesPackage("a-1.0-2.noarch", [], 100)), 0)
+
+    def test_bad_file(self):
+        """Test that a broken file is ignored"""
+        path = joinpaths(self.tmp_dir, "bad.json")
+        open(path, "w").write("{not json")
+        file_counts = FileCountCache(path)
+        self.assertEqual(file_counts.count(FilesPackage("a-1.0-1.noarch", ["/a"], 100)), 1)
+        file_counts.save()
+        self.assertEqual(FileCountCache(path).count(FilesPackage("a-1.0-1.noarch", [], 100)), 1)
+
+    def test_not_saved(self):
+        """Test that the file is only written when there are new counts"""
+        path = joinpaths(self.tmp_dir, "not-saved.json")
+        file_counts = FileCountCache(path)
+        file_counts.count(FilesPackage("a-1.0-1.noarch", ["/a"], 100))
+        file_counts.save()
+
+        file_counts = FileCountCache(path)
+        self.assertEqual(file_counts.count(NoFilesPackage("a-1.0-1.noarch", 100)), 1)
+        os.unlink(path)
+        file_counts.save()
+        self.assertFalse(os.path.exists(path))
+
+    def test_merged(self):
+        """Test that the counts saved by another process are kept"""
+        path = joinpaths(self.tmp_dir, "merged.json")
+        first = FileCountCache(path)
+        second = FileCountCache(path)
+        first.count(FilesPackage("a-1.0-1.noarch", ["/a"], 100))
+        second.count(FilesPackage("b-1.0-1.noarch", ["/b", "/c"], 100))
+        first.save()
+        second.save()
+
+        file_counts = FileCountCache(path)
+        self.assertEqual(file_counts.counts([NoFilesPackage("a-1.0-1.noarch", 100),
+                                             NoFilesPackage("b-1.0-1.noarch", 100)]), [1, 2])
+
+    def test_pruned(self):
+        """Test that the counts of packages that are not available are removed"""
+        path = joinpaths(self.tmp_dir, "pruned.json")
+        pkgs = [FilesPackage("a-1.0-%d.noarch" % i, ["/a"], 100) for i in range(3)]
+        file_counts = FileCountCache(path)
+        file_counts.counts(pkgs)
+        file_counts.save(AvailableBase(pkgs[1:]))
+        self.assertEqual(sorted(json.load(open(path))), ["a-1.0-1.noarch", "a-1.0-2.noarch"])
+
+    def test_max_size(self):
+        """Test that the oldest counts are removed when there are more than max_size"""
+        path = joinpaths(self.tmp_dir, "max-size.json")
+        file_counts = FileCountCache(path, max_size=2)
+        for i in range(3):
+            file_counts.count(FilesPackage("a-1.0-%d.noarch" % i, ["/a"], 100))
+            file_counts.save()
+        self.assertEqual(sorted(json.load(open(path))), ["a-1.0-1.noarch", "a-1.0-2.noarch"])
+
 class ConfigureTest(unittest.TestCase):
     @classmethod
     def setUpClass(self):
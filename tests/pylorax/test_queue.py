@@ -21,8 +21,9 @@ import unittest
 from uuid import uuid4
 
 import lifted.config
+from pylorax.api.compose import fail_prepares
 from pylorax.api.config import configure, make_queue_dirs
-from pylorax.api.queue import check_queues
+from pylorax.api.queue import check_queues, compose_tmp_dir
 from pylorax.base import DataHolder
 from pylorax.sysutils import joinpaths
 
@@ -99,6 +100,16 @@ class QueueTestCase(unittest.TestCase):
         status = open(joinpaths(self.monitor_cfg.composer_dir, "results", uuid, "STATUS")).read().strip()
         self.assertEqual(status, "FAILED")
 
+    def test_pending_status(self):
+        """Create a results dir with STATUS set to PENDING and confirm it is set to FAILED"""
+        uuid = str(uuid4())
+        os.makedirs(joinpaths(self.monitor_cfg.composer_dir, "results", uuid))
+        open(joinpaths(self.monitor_cfg.composer_dir, "results", uuid, "STATUS"), "w").write("PENDING\n")
+        check_queues(self.monitor_cfg)
+        status = open(joinpaths(self.monitor_cfg.composer_dir, "results", uuid, "STATUS")).read().strip()
+        self.assertEqual(status, "FAILED")
+        self.assertFalse(os.path.islink(joinpaths(self.monitor_cfg.composer_dir, "queue/new", uuid)))
+
     def test_missing_new_symlink(self):
         """Create a results dir with STATUS set to WAITING and confirm a symlink is created in queue/new"""
         uuid = str(uuid4())
@@ -108,3 +119,37 @@ class QueueTestCase(unittest.TestCase):
         status = open(joinpaths(self.monitor_cfg.composer_dir, "results", uuid, "STATUS")).read().strip()
         self.assertEqual(status, "WAITING")
         self.assertTrue(os.path.islink(joinpaths(self.monitor_cfg.composer_dir, "queue/new", uuid)))
+
+    def test_fail_prepares(self):
+        """Make sure the PENDING builds of an exited worker are set to FAILED"""
+        uuids = {}
+        for pid in [os.getpid(), os.getpid() + 1]:
+            uuid = str(uuid4())
+            results_dir = joinpaths(self.monitor_cfg.composer_dir, "results", uuid)
+            os.makedirs(results_dir)
+            open(joinpaths(results_dir, "STATUS"), "w").write("PENDING")
+            open(joinpaths(results_dir, "PREPARE_PID"), "w").write(str(pid))
+            open(joinpaths(results_dir, "blueprint.toml"), "w").write('name = "example"\nversion = "0.0.1"\n')
+            open(joinpaths(results_dir, "tar.ks"), "w").write("")
+            uuids[pid] = uuid
+
+        fail_prepares(self.config["COMPOSER_CFG"], os.getpid())
+        results_dir = joinpaths(self.monitor_cfg.composer_dir, "results", uuids[os.getpid()])
+        self.assertEqual(open(joinpaths(results_dir, "STATUS")).read().strip(), "FAILED")
+        self.assertTrue("exited" in open(joinpaths(results_dir, "logs", "combined.log")).read())
+        results_dir = joinpaths(self.monitor_cfg.composer_dir, "results", uuids[os.getpid() + 1])
+        self.assertEqual(open(joinpaths(results_dir, "STATUS")).read().strip(), "PENDING")
+
+    def test_compose_tmp_dir(self):
+        """Make sure each compose gets its own temporary directory"""
+        uuid_1 = str(uuid4())
+        uuid_2 = str(uuid4())
+        tmp_1 = compose_tmp_dir(self.monitor_cfg.tmp, uuid_1)
+        tmp_2 = compose_tmp_dir(self.monitor_cfg.tmp, uuid_2)
+        self.assertNotEqual(tmp_1, tmp_2)
+        self.assertTrue(tmp_1.startswith(self.monitor_cfg.tmp))
+        self.assertTrue(tmp_1.endswith(uuid_1))
+
+    def test_max_concurrent_composes(self):
+        """Make sure the default is to run 1 compose at a time"""
+        self.assertEqual(self.config["COMPOSER_CFG"].getint("composer", "max_concurrent_composes"), 1)
@@ -16,6 +16,7 @@
 #
 import os
 import shutil
+import subprocess
 import tempfile
 import unittest
 from unittest import mock
@@ -619,6 +620,26 @@ class BasicRecipeTest(unittest.TestCase):
         self.assertTrue(php_module is not None)
         self.assertEqual(php_module["version"], "5.4.2-1.el7.x86_64")
 
+    def test_recipe_freeze_groups(self):
+        """Test that freeze() keeps all of the groups"""
+        recipe = recipes.Recipe("freeze-groups", "", "0.0.1", [], [],
+                                [recipes.RecipeGroup("core"), recipes.RecipeGroup("base")])
+        deps = [{"name": name, "epoch": 0, "version": "1.0", "release": "1", "arch": "noarch"}
+                for name in ["core", "base"]]
+        self.assertEqual(recipe.freeze(deps)["groups"], [{"name": "base"}, {"name": "core"}])
+
+    def test_diff_lists_large(self):
+        """Test diffing lists with thousands of entries"""
+        old_items = [{"name": "package-%05d" % i, "version": "1.*"} for i in range(10000)]
+        new_items = [{"name": "package-%05d" % i, "version": "2.*" if i % 2 else "1.*"} for i in range(5000, 15000)]
+        diffs = recipes.diff_lists("Package", "name", old_items, new_items)
+        self.assertEqual(len([d for d in diffs if d["old"] is None]), 5000)
+        self.assertEqual(len([d for d in diffs if d["new"] is None]), 5000)
+        changed = [d for d in diffs if d["old"] and d["new"]]
+        self.assertEqual(len(changed), 2500)
+        self.assertEqual(changed[0], {"old": {"Package": {"name": "package-05001", "version": "1.*"}},
+                                      "new": {"Package": {"name": "package-05001", "version": "2.*"}}})
+
 
 class GitRecipesTest(unittest.TestCase):
     @classmethod
@@ -818,6 +839,126 @@ hostname = "testing-bad-recipe"
         self.assertEqual(len(commits), 3, "Wrong number of commits: %s" % commits)
         self.assertEqual(commits[0].revision, 2)
 
+    def test_11_list_commits_page(self):
+        """Test listing a page of the commits"""
+        commits = recipes.list_commits(self.repo, "master", "example-http-server.toml")
+        self.assertEqual(recipes.count_commits(self.repo, "master", "example-http-server.toml"), len(commits))
+        self.assertEqual(recipes.list_commits(self.repo, "master", "example-http-server.toml", 1), commits[:1])
+        self.assertEqual(recipes.list_commits(self.repo, "master", "example-http-server.toml", 1, 1), commits[1:2])
+        self.assertEqual(recipes.list_commits(self.repo, "master", "example-http-server.toml", 0, 1), commits[1:])
+        self.assertEqual(recipes.count_commits(self.repo, "master", "not-a-file.toml"), 0)
+
+    def test_12_rebuild_commit_index(self):
+        """Test that the index is rebuilt when the indexed head is not on the branch"""
+        commits = recipes.list_commits(self.repo, "master", "example-http-server.toml")
+        index = recipes.commit_index(self.repo)
+        index.add("master", "0" * 40, 1, [], replace=True)
+        self.assertEqual(index.count("master", "example-http-server.toml"), 0)
+
+        # The revisions of the tags are read again too
+        self.assertEqual(recipes.list_commits(self.repo, "master", "example-http-server.toml"), commits)
+        self.assertEqual(commits[0].revision, 2)
+
+    def test_13_read_recipe_cached(self):
+        """Test that reading a recipe again returns an independent copy"""
+        recipe = recipes.read_recipe_commit(self.repo, "master", "example-http-server")
+        hits = recipes.RECIPE_CACHE.stats()["hits"]
+        recipe["description"] = "Changed by the caller"
+
+        cached = recipes.read_recipe_commit(self.repo, "master", "example-http-server")
+        self.assertEqual(recipes.RECIPE_CACHE.stats()["hits"], hits + 1)
+        self.assertEqual(cached["description"], "A modified description")
+        self.assertTrue(cached is not recipe)
+
+    def test_14_commit_recipes(self):
+        """Test committing several recipes at once"""
+        new_recipes = [recipes.Recipe("bulk-one", "", "", [], [], []),
+                       recipes.Recipe("bulk-two", "", "1.0.0", [], [], [])]
+        commit_id = recipes.commit_recipes(self.repo, "bulk", new_recipes)
+        self.assertNotEqual(commit_id, None)
+        for filename in ["bulk-one.toml", "bulk-two.toml"]:
+            commits = recipes.list_commits(self.repo, "bulk", filename)
+            self.assertEqual([c.commit for c in commits], [commit_id.to_string()])
+
+        branch_recipes = recipes.read_branch_recipes(self.repo, "bulk")
+        self.assertEqual([r["version"] for r in branch_recipes if r["name"].startswith("bulk-")], ["0.0.1", "1.0.0"])
+
+        # Unchanged recipes are not committed again, changed ones have their version bumped
+        unchanged = [recipes.Recipe("bulk-one", "", "", [], [], [])]
+        self.assertEqual(recipes.commit_recipes(self.repo, "bulk", unchanged), None)
+        changed = [recipes.Recipe("bulk-one", "", "", [], [], []),
+                   recipes.Recipe("bulk-two", "Changed", "", [], [], [])]
+        self.assertNotEqual(recipes.commit_recipes(self.repo, "bulk", changed), None)
+        self.assertEqual(len(recipes.list_commits(self.repo, "bulk", "bulk-one.toml")), 1)
+        self.assertEqual(recipes.read_recipe_commit(self.repo, "bulk", "bulk-two")["version"], "1.0.1")
+
+
+    def _reset_branch(self, branch, commit_id):
+        """Move a branch to another commit, without updating the commit index"""
+        subprocess.check_call(["git", "--git-dir", self.repo.get_location().get_path(),
+                               "update-ref", "refs/heads/%s" % branch, commit_id])
+
+    def _commit_ids(self, branch, recipe):
+        return [c.commit for c in recipes.list_commits(self.repo, branch, recipes.recipe_filename(recipe["name"]))]
+
+    def test_15_reset_to_ancestor(self):
+        """Test that the index is rebuilt when the branch is reset to an ancestor of the indexed head"""
+        # The subclass runs this again with the same repository
+        branch = "reset-" + self.__class__.__name__
+        recipe = recipes.Recipe("reset-test", "First", "0.0.1", [], [], [])
+        first_id = recipes.commit_recipe(self.repo, branch, recipe).to_string()
+        recipe["description"] = "Second"
+        second_id = recipes.commit_recipe(self.repo, branch, recipe).to_string()
+        self.assertEqual(self._commit_ids(branch, recipe), [second_id, first_id])
+
+        self._reset_branch(branch, first_id)
+        self.assertEqual(self._commit_ids(branch, recipe), [first_id])
+        self.assertEqual(recipes.count_commits(self.repo, branch, "reset-test.toml"), 1)
+
+    def test_16_diverged_branch(self):
+        """Test that the index is rebuilt when the branch has diverged from the indexed head"""
+        branch = "diverged-" + self.__class__.__name__
+        recipe = recipes.Recipe("diverged-test", "First", "0.0.1", [], [], [])
+        first_id = recipes.commit_recipe(self.repo, branch, recipe).to_string()
+        recipe["description"] = "Second"
+        second_id = recipes.commit_recipe(self.repo, branch, recipe).to_string()
+        self.assertEqual(self._commit_ids(branch, recipe), [second_id, first_id])
+
+        # Commit something else on top of the first commit, the second is no longer on the branch
+        self._reset_branch(branch, first_id)
+        recipe["description"] = "Third"
+        third_id = recipes.commit_recipe(self.repo, branch, recipe).to_string()
+        self.assertEqual(self._commit_ids(branch, recipe), [third_id, first_id])
+
+    def test_17_tag_commit_twice(self):
+        """Test that the next revision follows the highest tag when a commit is tagged twice"""
+        branch = "tagged-" + self.__class__.__name__
+        recipe = recipes.Recipe("tagged-test", "First", "0.0.1", [], [], [])
+        recipes.commit_recipe(self.repo, branch, recipe)
+        self.assertNotEqual(recipes.tag_recipe_commit(self.repo, branch, "tagged-test"), None)
+        self.assertNotEqual(recipes.tag_recipe_commit(self.repo, branch, "tagged-test"), None)
+        commits = recipes.list_commits(self.repo, branch, "tagged-test.toml")
+        self.assertEqual(commits[0].revision, 2)
+
+        recipe["description"] = "Second"
+        recipes.commit_recipe(self.repo, branch, recipe)
+        self.assertNotEqual(recipes.tag_recipe_commit(self.repo, branch, "tagged-test"), None)
+        commits = recipes.list_commits(self.repo, branch, "tagged-test.toml")
+        self.assertEqual([c.revision for c in commits], [3, 2])
+
+        # Reading the tags again gives the same revisions
+        recipes.commit_index(self.repo).add(branch, "0" * 40, 1, [], replace=True)
+        self.assertEqual(recipes.list_commits(self.repo, branch, "tagged-test.toml"), commits)
+
+    def test_18_read_indexed(self):
+        """Test that reading the commits does not update the index after a commit"""
+        branch = "indexed-" + self.__class__.__name__
+        recipe = recipes.Recipe("indexed-test", "", "0.0.1", [], [], [])
+        recipes.commit_recipe(self.repo, branch, recipe)
+        with mock.patch("pylorax.api.recipes.update_commit_index", side_effect=AssertionError("updated")):
+            self.assertEqual(len(recipes.list_commits(self.repo, branch, "indexed-test.toml")), 1)
+            self.assertEqual(recipes.count_commits(self.repo, branch, "indexed-test.toml"), 1)
+
 
 class ExistingGitRepoRecipesTest(GitRecipesTest):
     @classmethod
@@ -830,6 +971,29 @@ class ExistingGitRepoRecipesTest(GitRecipesTest):
         self.repo = recipes.open_or_create_repo(self.repo_dir)
 
 
+class RecipeCacheTest(unittest.TestCase):
+    def test_lru(self):
+        """Test that the least recently used recipes are removed"""
+        cache = recipes.RecipeCache(max_size=2)
+        for key in ["a", "b", "c"]:
+            cache.put(key, recipes.Recipe(key, "", "0.0.1", [], [], []))
+        self.assertEqual(cache.get("a"), None)
+        self.assertEqual(cache.get("b")["name"], "b")
+
+        cache.put("d", recipes.Recipe("d", "", "0.0.1", [], [], []))
+        self.assertEqual(cache.get("c"), None)
+        self.assertEqual(cache.get("b")["name"], "b")
+        self.assertEqual(cache.stats(), {"hits": 2, "misses": 2, "size": 2, "max_size": 2})
+
+    def test_copies(self):
+        """Test that changing a stored or returned recipe does not change the cache"""
+        cache = recipes.RecipeCache()
+        recipe = recipes.Recipe("a", "", "0.0.1", [], [recipes.RecipePackage("tmux", "*")], [])
+        cache.put("a", recipe)
+        recipe["packages"].append(recipes.RecipePackage("vim", "*"))
+        cache.get("a")["packages"].clear()
+        self.assertEqual(cache.get("a")["packages"], [recipes.RecipePackage("tmux", "*")])
+
 class GetRevisionFromTagTests(unittest.TestCase):
     def test_01_valid_tag(self):
         revision = recipes.get_revision_from_tag('branch/filename/r123')
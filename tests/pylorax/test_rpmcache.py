@@ -0,0 +1,151 @@
+#
+# Copyright (C) 2020  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import os
+import shutil
+import tempfile
+from threading import Lock
+import time
+import unittest
+from unittest import mock
+
+from pylorax.api.config import configure
+from pylorax.api.rpmcache import RPMCache, create_cache_repo, rpm_cache
+from pylorax.base import DataHolder
+from pylorax.sysutils import joinpaths
+
+class Package(object):
+    """Test class for a downloaded dnf.package.Package"""
+    def __init__(self, chksum, path):
+        self.chksum = chksum
+        self.path = path
+
+    def returnIdSum(self):
+        return ("sha256", self.chksum)
+
+    def localPkg(self):
+        return self.path
+
+class Base(object):
+    """Test class for dnf.Base that downloads a package by writing its checksum"""
+    def __init__(self, cachedir):
+        self.conf = DataHolder(cachedir=cachedir)
+        self.downloaded = []
+
+    def download_packages(self, pkgs):
+        for pkg in pkgs:
+            open(pkg.path, "w").write(pkg.chksum)
+            self.downloaded.append(pkg.chksum)
+
+class RPMCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(prefix="lorax.rpmcache.")
+        self.dnf_cache = joinpaths(self.test_dir, "dnf")
+        os.makedirs(self.dnf_cache)
+        self.cache = RPMCache(joinpaths(self.test_dir, "rpmcache"), 10)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def package(self, chksum):
+        return Package(chksum, joinpaths(self.dnf_cache, chksum + ".rpm"))
+
+    def test_fetch(self):
+        """Test that only the missing packages are downloaded"""
+        dbo = Base(self.dnf_cache)
+        paths = self.cache.fetch(dbo, [self.package("aaaa"), self.package("bbbb")])
+        self.assertEqual(paths, [joinpaths(self.test_dir, "rpmcache", "sha256-aaaa.rpm"),
+                                 joinpaths(self.test_dir, "rpmcache", "sha256-bbbb.rpm")])
+        self.assertEqual(open(paths[0]).read(), "aaaa")
+        self.assertFalse(os.path.exists(self.package("aaaa").path))
+
+        self.cache.fetch(dbo, [self.package("aaaa"), self.package("cccc")])
+        self.assertEqual(dbo.downloaded, ["aaaa", "bbbb", "cccc"])
+        self.assertEqual(self.cache.size(), 12)
+
+    def test_evict(self):
+        """Test that the least recently used rpms are removed"""
+        dbo = Base(self.dnf_cache)
+        self.cache.fetch(dbo, [self.package("aaaa")])
+        self.cache.fetch(dbo, [self.package("bbbb")])
+        self.cache.fetch(dbo, [self.package("cccc")])
+
+        # Make bbbb the least recently used
+        old = time.time() - 60
+        os.utime(joinpaths(self.test_dir, "rpmcache", "sha256-bbbb.rpm"), (old, old))
+        os.utime(joinpaths(self.test_dir, "rpmcache", "sha256-cccc.rpm"), (old + 1, old + 1))
+
+        self.assertEqual(self.cache.evict(), 1)
+        self.assertEqual(sorted(os.listdir(joinpaths(self.test_dir, "rpmcache"))),
+                         ["sha256-aaaa.rpm", "sha256-cccc.rpm"])
+        self.assertEqual(self.cache.evict(), 0)
+
+    def test_touch(self):
+        """Test that touch() only marks the rpms as used when they are all cached"""
+        dbo = Base(self.dnf_cache)
+        paths = self.cache.fetch(dbo, [self.package("aaaa")])
+        old = time.time() - 60
+        os.utime(paths[0], (old, old))
+
+        self.assertFalse(self.cache.touch(paths + [self.cache.pkg_path(self.package("bbbb"))]))
+        self.assertEqual(os.stat(paths[0]).st_mtime, old)
+        self.assertTrue(self.cache.touch(paths))
+        self.assertTrue(os.stat(paths[0]).st_mtime > old)
+
+    def test_create_cache_repo(self):
+        """Test that the packages are downloaded without holding the DNF lock"""
+        config = configure(root_dir=self.test_dir, test_config=True)
+        dnflock = DataHolder(lock=Lock(), dbo=Base(self.dnf_cache))
+        download_dbo = Base(self.dnf_cache)
+        locked = []
+        def download_packages(pkgs):
+            locked.append(dnflock.lock.locked())
+            Base.download_packages(download_dbo, pkgs)
+        download_dbo.download_packages = download_packages
+
+        pkgs = [self.package("aaaa"), self.package("bbbb")]
+        results_dir = joinpaths(self.test_dir, "results")
+        with mock.patch("pylorax.api.rpmcache.find_packages", return_value=pkgs), \
+             mock.patch("pylorax.api.rpmcache.get_base_object", return_value=download_dbo) as get_base_object, \
+             mock.patch("pylorax.api.rpmcache.link_rpms"):
+            create_cache_repo(config, dnflock, [], results_dir)
+            self.assertEqual(locked, [False])
+            self.assertEqual(download_dbo.downloaded, ["aaaa", "bbbb"])
+
+            # Nothing is downloaded when they are all cached
+            create_cache_repo(config, dnflock, [], results_dir)
+            self.assertEqual(get_base_object.call_count, 1)
+
+    def test_disabled(self):
+        """Test that setting rpm_cache_size to 0 disables the cache"""
+        config = configure(root_dir=self.test_dir, test_config=True)
+        self.assertTrue(rpm_cache(config) is not None)
+        config.set("composer", "rpm_cache_size", "0")
+        self.assertEqual(rpm_cache(config), None)
+
+    def test_shared(self):
+        """Test that the same RPMCache is returned for the same cache directory"""
+        config = configure(root_dir=self.test_dir, test_config=True)
+        cache = rpm_cache(config)
+        self.assertTrue(rpm_cache(config) is cache)
+        self.assertTrue(rpm_cache(configure(root_dir=self.test_dir, test_config=True)) is cache)
+
+        config.set("composer", "rpm_cache_size", "1")
+        self.assertTrue(rpm_cache(config) is cache)
+        self.assertEqual(cache.max_size, 1024**2)
+
+        other_dir = joinpaths(self.test_dir, "other")
+        self.assertFalse(rpm_cache(configure(root_dir=other_dir, test_config=True)) is cache)
@@ -19,13 +19,20 @@ import os
 from configparser import ConfigParser, NoOptionError
 from contextlib import contextmanager
 import dnf
+import fcntl
+import gevent
 from glob import glob
+import gzip
+import hashlib
+from io import BytesIO
 from rpmfluff import SimpleRpmBuild, expectedArch
 import shutil
+import tarfile
 import tempfile
+from threading import Barrier, BrokenBarrierError, Event, Thread
 import time
-from threading import Lock
 import unittest
+from unittest import mock
 
 from flask import json
 from ..lib import create_git_repo
@@ -34,7 +41,7 @@ from pylorax.api.config import configure, make_dnf_dirs, make_queue_dirs
 from pylorax.api.errors import *                               # pylint: disable=wildcard-import
 from pylorax.api.queue import start_queue_monitor
 from pylorax.api.recipes import open_or_create_repo, commit_recipe_directory
-from pylorax.api.server import server, GitLock
+from pylorax.api.server import server, GitLock, RWLock
 import pylorax.api.toml as toml
 from pylorax.api.dnfbase import DNFLock
 from pylorax.sysutils import joinpaths
@@ -112,7 +119,7 @@ class ServerAPIV0TestCase(unittest.TestCase):
         repo_dir = tempfile.mkdtemp(prefix="lorax.test.repo.")
         server.config["REPO_DIR"] = repo_dir
         repo = open_or_create_repo(server.config["REPO_DIR"])
-        server.config["GITLOCK"] = GitLock(repo=repo, lock=Lock(), dir=repo_dir)
+        server.config["GITLOCK"] = GitLock(repo=repo, lock=RWLock(), dir=repo_dir)
 
         server.config["COMPOSER_CFG"] = configure(root_dir=repo_dir, test_config=True)
         lifted.config.configure(server.config["COMPOSER_CFG"])
@@ -641,6 +648,16 @@ class ServerAPIV0TestCase(unittest.TestCase):
         data = json.loads(resp.data)
         self.assertEqual(data["total"], expected_total)
 
+    def test_projects_list_search(self):
+        """Test /api/v0/projects/list?search=<string>"""
+        resp = self.server.get("/api/v0/projects/list?search=bash&limit=100")
+        data = json.loads(resp.data)
+        self.assertNotEqual(data, None)
+        projects = data.get("projects")
+        self.assertEqual(len(projects), data["total"])
+        self.assertEqual(projects[0]["name"], "bash")
+        self.assertTrue(all("bash" in p["name"].lower() for p in projects))
+
     def test_projects_info(self):
         """Test /api/v0/projects/info/<project_names>"""
         resp = self.server.get("/api/v0/projects/info/bash")
@@ -1191,6 +1208,7 @@ class ServerAPIV0TestCase(unittest.TestCase):
         data = json.loads(resp.data)
         self.assertNotEqual(data, None)
         self.assertEqual(data["queue_status"], "FINISHED", "Build not in FINISHED state")
+        self.assertEqual(data["image_sha256"], hashlib.sha256(b"TEST IMAGE").hexdigest())
 
         # Test the /api/v0/compose/finished route
         resp = self.server.get("/api/v0/compose/finished")
@@ -1229,6 +1247,22 @@ class ServerAPIV0TestCase(unittest.TestCase):
         resp = self.server.get("/api/v0/compose/results/%s" % build_id)
         self.assertEqual(resp.status_code, 200)
         self.assertEqual(len(resp.data) > 1024, True)
+        self.assertEqual(resp.headers["Content-Length"], str(len(resp.data)))
+        with tarfile.open(fileobj=BytesIO(resp.data)) as tar:
+            self.assertTrue("final-kickstart.ks" in tar.getnames())
+            self.assertTrue("logs" in tar.getnames())
+
+        # The compressed results are the same tar
+        tar_data = resp.data
+        resp = self.server.get("/api/v0/compose/results/%s?compression=gzip" % build_id)
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue("%s.tar.gz" % build_id in resp.headers["Content-Disposition"])
+        self.assertEqual(gzip.decompress(resp.data), tar_data)
+
+        resp = self.server.get("/api/v0/compose/results/%s?compression=bzip2" % build_id)
+        self.assertEqual(resp.status_code, 400)
+        data = json.loads(resp.data)
+        self.assertEqual(data["errors"][0]["id"], COMPOSE_ERROR)
 
         # Test the /api/v0/compose/image/<uuid> route
         resp = self.server.get("/api/v0/compose/image/%s" % build_id)
@@ -1236,6 +1270,23 @@ class ServerAPIV0TestCase(unittest.TestCase):
         self.assertEqual(len(resp.data) > 0, True)
         self.assertEqual(resp.data, b"TEST IMAGE")
 
+        # Resume the download of the image
+        etag = resp.headers["ETag"]
+        self.assertEqual(etag, '"%s"' % hashlib.sha256(b"TEST IMAGE").hexdigest())
+        self.assertEqual(resp.headers["Accept-Ranges"], "bytes")
+        resp = self.server.get("/api/v0/compose/image/%s" % build_id,
+                               headers={"Range": "bytes=5-", "If-Range": etag})
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.data, b"IMAGE")
+        self.assertEqual(resp.headers["Content-Range"], "bytes 5-9/10")
+
+        # HEAD only returns the headers
+        resp = self.server.head("/api/v0/compose/image/%s" % build_id)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, b"")
+        self.assertEqual(resp.headers["Content-Length"], "10")
+        self.assertEqual(resp.headers["ETag"], etag)
+
         # Examine the final-kickstart.ks for the customizations
         # A bit kludgy since it examines the filesystem directly, but that's better than unpacking the metadata
         final_ks = open(joinpaths(self.repo_dir, "var/lib/lorax/composer/results/", build_id, "final-kickstart.ks")).read()
@@ -1772,6 +1823,189 @@ class ServerAPIV0TestCase(unittest.TestCase):
             "errors": [{ "id": "HTTPError", "code": 405, "msg": "Method Not Allowed" }]
         })
 
+    def test_blueprints_reads_wait(self):
+        """Test that blueprint reads in another thread wait for the git lock"""
+        results = []
+        def info():
+            resp = server.test_client().get("/api/v0/blueprints/info/example-glusterfs")
+            results.append(resp.status_code)
+
+        # The repository is not used by more than one thread at a time
+        with server.config["GITLOCK"].lock.read():
+            t = Thread(target=info)
+            t.start()
+            t.join(0.5)
+            self.assertTrue(t.is_alive())
+        t.join(60)
+        self.assertEqual(results, [200])
+
+        # A writer holding the lock blocks the readers until it is released
+        with server.config["GITLOCK"].lock:
+            t = Thread(target=info)
+            t.start()
+            t.join(0.5)
+            self.assertTrue(t.is_alive())
+        t.join(60)
+        self.assertEqual(results, [200, 200])
+
+    def test_blueprints_threaded_reads(self):
+        """Test blueprint reads from several threads at the same time"""
+        routes = ["/api/v0/blueprints/list",
+                  "/api/v0/blueprints/info/example-glusterfs,example-http-server",
+                  "/api/v0/blueprints/changes/example-glusterfs",
+                  "/api/v0/blueprints/diff/example-glusterfs/NEWEST/WORKSPACE"]
+        errors = []
+        def reader(count):
+            client = server.test_client()
+            for i in range(count):
+                resp = client.get(routes[i % len(routes)])
+                if resp.status_code != 200:
+                    errors.append(resp.data)
+
+        for threads in [1, 4, 8]:
+            workers = [Thread(target=reader, args=(40 // threads,)) for _ in range(threads)]
+            for t in workers:
+                t.start()
+            for t in workers:
+                t.join()
+        self.assertEqual(errors, [])
+
+    def test_blueprints_shared_read(self):
+        """Test that blueprints can be read while another thread holds the shared lock"""
+        resp = []
+        def reader():
+            resp.append(server.test_client().get("/api/v0/blueprints/list"))
+
+        with server.config["GITLOCK"].lock.read():
+            t = Thread(target=reader)
+            t.start()
+            t.join(30)
+            self.assertFalse(t.is_alive(), "The request waited for the other reader")
+        self.assertEqual(resp[0].status_code, 200)
+
+class RWLockTestCase(unittest.TestCase):
+    def test_readers_share(self):
+        """Test that the shared lock is held by several threads at the same time"""
+        lock = RWLock()
+        # Each reader waits for the other one while holding the lock
+        barrier = Barrier(2, timeout=10)
+        errors = []
+        def reader():
+            with lock.read():
+                try:
+                    barrier.wait()
+                except BrokenBarrierError as e:
+                    errors.append(e)
+
+        threads = [Thread(target=reader) for _ in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(20)
+        self.assertEqual(errors, [])
+
+    def test_writer_waits(self):
+        """Test that a writer waits for the readers, and new readers wait for the writer"""
+        lock = RWLock()
+        order = []
+        def writer():
+            with lock:
+                order.append("writer")
+        def reader():
+            with lock.read():
+                order.append("reader")
+
+        lock.acquire_read()
+        threads = [Thread(target=writer), Thread(target=reader)]
+        for t in threads:
+            t.start()
+            t.join(0.5)
+            self.assertTrue(t.is_alive())
+        self.assertEqual(order, [])
+        lock.release_read()
+        for t in threads:
+            t.join(10)
+        self.assertEqual(order, ["writer", "reader"])
+
+    def test_gevent_readers(self):
+        """Test that greenlets share the lock, and wait for a writer without blocking the others"""
+        lock = RWLock()
+        held = Event()
+        done = Event()
+        def holder():
+            with lock:
+                held.set()
+                done.wait(10)
+        t = Thread(target=holder)
+        t.start()
+        self.assertTrue(held.wait(10))
+
+        order = []
+        def reader():
+            with lock.read():
+                order.append("in")
+                # Let the other reader take the lock while this one holds it
+                gevent.sleep(0.1)
+                order.append("out")
+        greenlets = [gevent.spawn(reader) for _ in range(2)]
+
+        # The greenlets waiting for the lock do not block this one
+        gevent.sleep(0.2)
+        self.assertEqual(order, [])
+        done.set()
+        gevent.joinall(greenlets, timeout=10)
+        t.join(10)
+        self.assertEqual(order, ["in", "in", "out", "out"])
+
+    def test_gevent_wait(self):
+        """Test that waiting for the lock in the main thread lets the other greenlets run"""
+        lock = RWLock()
+        held = Event()
+        done = Event()
+        def holder():
+            with lock:
+                held.set()
+                done.wait(10)
+        t = Thread(target=holder)
+        t.start()
+        self.assertTrue(held.wait(10))
+
+        # The lock is only released after the greenlet has run
+        g = gevent.spawn(done.set)
+        with lock.read():
+            self.assertTrue(g.dead)
+        t.join(10)
+
+    def test_processes(self):
+        """Test that the lock file is held between processes"""
+        with tempfile.TemporaryDirectory(prefix="lorax.test.rwlock.") as tmp_dir:
+            path = joinpaths(tmp_dir, "git.lock")
+            lock = RWLock(path)
+            with lock.read():
+                # Another process can read, but cannot write
+                pid = os.fork()
+                if pid == 0:
+                    other = RWLock(path)
+                    try:
+                        other.acquire_read()
+                        other.release_read()
+                        fcntl.flock(os.open(path, os.O_RDWR), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        os._exit(1)
+                    except BlockingIOError:
+                        os._exit(0)
+                    except Exception:
+                        os._exit(2)
+                self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+            # After it is released another process can write
+            pid = os.fork()
+            if pid == 0:
+                other = RWLock(path)
+                with other:
+                    pass
+                os._exit(0)
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
 class ServerAPIV1TestCase(unittest.TestCase):
     @classmethod
     def setUpClass(self):
@@ -1781,7 +2015,7 @@ class ServerAPIV1TestCase(unittest.TestCase):
         repo_dir = tempfile.mkdtemp(prefix="lorax.test.repo.")
         server.config["REPO_DIR"] = repo_dir
         repo = open_or_create_repo(server.config["REPO_DIR"])
-        server.config["GITLOCK"] = GitLock(repo=repo, lock=Lock(), dir=repo_dir)
+        server.config["GITLOCK"] = GitLock(repo=repo, lock=RWLock(), dir=repo_dir)
 
         server.config["COMPOSER_CFG"] = configure(root_dir=repo_dir, test_config=True)
         lifted.config.configure(server.config["COMPOSER_CFG"])
@@ -2004,6 +2238,91 @@ class ServerAPIV1TestCase(unittest.TestCase):
 
         self.assertEqual(blueprints[0], test_blueprint)
 
+    def test_blueprints_bulk_json(self):
+        """Test the /api/v1/blueprints/bulk route with a list of json blueprints"""
+        test_blueprints = [{"name": "example-bulk-1", "description": "First bulk blueprint", "version": "0.1.0",
+                            "modules": [], "packages": [TMUX_GLOB], "groups": []},
+                           {"name": "example-bulk-2", "description": "Second bulk blueprint", "version": "0.0.1",
+                            "modules": [], "packages": [RSYNC_GLOB], "groups": []}]
+        resp = self.server.post("/api/v1/blueprints/bulk?branch=bulk",
+                                data=json.dumps(test_blueprints),
+                                content_type="application/json")
+        data = json.loads(resp.data)
+        self.assertEqual(data["status"], True)
+        self.assertEqual(data["blueprints"], ["example-bulk-1", "example-bulk-2"])
+        self.assertNotEqual(data["commit"], None)
+
+        # Both are in the same commit
+        resp = self.server.get("/api/v1/blueprints/changes/example-bulk-1,example-bulk-2?branch=bulk")
+        data = json.loads(resp.data)
+        self.assertEqual(len(set(b["changes"][0]["commit"] for b in data["blueprints"])), 1)
+
+        resp = self.server.get("/api/v1/blueprints/info/example-bulk-1,example-bulk-2?branch=bulk")
+        data = json.loads(resp.data)
+        self.assertEqual(data["blueprints"], test_blueprints)
+
+        # Importing them again does not make a new commit
+        resp = self.server.post("/api/v1/blueprints/bulk?branch=bulk",
+                                data=json.dumps(test_blueprints),
+                                content_type="application/json")
+        data = json.loads(resp.data)
+        self.assertEqual(data["status"], True)
+        self.assertEqual(data["commit"], None)
+
+    def test_blueprints_bulk_errors(self):
+        """Test that /api/v1/blueprints/bulk commits nothing if there are errors"""
+        test_blueprints = [{"name": "example-bulk-ok", "description": "", "version": "0.0.1",
+                            "modules": [], "packages": [], "groups": []},
+                           {"name": "example bulk bad", "description": "", "version": "0.0.1",
+                            "modules": [], "packages": [], "groups": []},
+                           {"name": "example-bulk-ok", "description": "", "version": "0.0.2",
+                            "modules": [], "packages": [], "groups": []}]
+        resp = self.server.post("/api/v1/blueprints/bulk?branch=bulk-errors",
+                                data=json.dumps(test_blueprints),
+                                content_type="application/json")
+        self.assertEqual(resp.status_code, 400)
+        data = json.loads(resp.data)
+        self.assertEqual(data["status"], False)
+        self.assertEqual(len(data["errors"]), 2)
+        self.assertTrue(data["errors"][0]["msg"].startswith("blueprint 1:"))
+        self.assertTrue(data["errors"][1]["msg"].startswith("blueprint 2:"))
+
+        resp = self.server.get("/api/v1/blueprints/info/example-bulk-ok?branch=bulk-errors")
+        data = json.loads(resp.data)
+        self.assertEqual(data["blueprints"], [])
+
+        resp = self.server.post("/api/v1/blueprints/bulk",
+                                data=json.dumps({"name": "example-bulk-ok"}),
+                                content_type="application/json")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_blueprints_export_tar(self):
+        """Test exporting the blueprints as a tar and importing it to a new branch"""
+        resp = self.server.get("/api/v1/blueprints/export?format=tar")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, "application/x-tar")
+        tar = tarfile.open(fileobj=BytesIO(resp.data))
+        self.assertTrue("example-glusterfs.toml" in tar.getnames())
+
+        resp = self.server.post("/api/v1/blueprints/bulk?branch=bulk-tar",
+                                data=resp.data,
+                                content_type="application/x-tar")
+        data = json.loads(resp.data)
+        self.assertEqual(data["status"], True)
+        self.assertEqual(len(data["blueprints"]), len(tar.getnames()))
+
+        resp = self.server.get("/api/v1/blueprints/export")
+        master = json.loads(resp.data)["blueprints"]
+        resp = self.server.get("/api/v1/blueprints/export?branch=bulk-tar")
+        self.assertEqual(json.loads(resp.data)["blueprints"], master)
+
+        names = [b["name"] for b in master]
+        resp = self.server.get("/api/v1/blueprints/info/%s" % ",".join(names))
+        self.assertEqual(json.loads(resp.data)["blueprints"], master)
+
+        resp = self.server.get("/api/v1/blueprints/export?format=zip")
+        self.assertEqual(resp.status_code, 400)
+
     def test_07_blueprints_ws_json(self):
         """Test the /api/v1/blueprints/workspace route with json blueprint"""
         test_blueprint = {"description": "An example GlusterFS server with samba, ws version",
@@ -2885,6 +3204,13 @@ class ServerAPIV1TestCase(unittest.TestCase):
 
     def test_compose_12_create_finished(self):
         """Test the /api/v1/compose routes with a finished test compose"""
+        # The id of the last event before the compose
+        resp = self.server.get("/api/v1/events/poll?timeout=0")
+        data = json.loads(resp.data)
+        self.assertNotEqual(data, None)
+        self.assertEqual(data["events"], [])
+        last_id = data["last_id"]
+
         test_compose = {"blueprint_name": "example-custom-base",
                         "compose_type": "tar",
                         "branch": "master"}
@@ -2919,6 +3245,23 @@ class ServerAPIV1TestCase(unittest.TestCase):
         data = json.loads(resp.data)
         self.assertNotEqual(data, None)
         self.assertEqual(data["queue_status"], "FINISHED", "Build not in FINISHED state")
+        self.assertEqual(data["image_sha256"], hashlib.sha256(b"TEST IMAGE").hexdigest())
+
+        # Test the /api/v1/events/poll route
+        resp = self.server.get("/api/v1/events/poll?since=%d&timeout=0" % last_id)
+        data = json.loads(resp.data)
+        self.assertNotEqual(data, None)
+        self.assertEqual(data["reset"], False)
+        changes = [(e["data"]["previous_status"], e["data"]["queue_status"]) for e in data["events"]
+                   if e["type"] == "compose" and e["data"]["id"] == build_id]
+        self.assertTrue(("WAITING", "RUNNING") in changes, "RUNNING event not in /events/poll: %s" % changes)
+        self.assertTrue(("RUNNING", "FINISHED") in changes, "FINISHED event not in /events/poll: %s" % changes)
+        self.assertEqual(data["last_id"], data["events"][-1]["id"])
+
+        # Nothing has changed since the last event
+        resp = self.server.get("/api/v1/events/poll?since=%d&timeout=0" % data["last_id"])
+        data = json.loads(resp.data)
+        self.assertEqual(data["events"], [])
 
         # Test the /api/v1/compose/finished route
         resp = self.server.get("/api/v1/compose/finished")
@@ -2957,6 +3300,22 @@ class ServerAPIV1TestCase(unittest.TestCase):
         resp = self.server.get("/api/v1/compose/results/%s" % build_id)
         self.assertEqual(resp.status_code, 200)
         self.assertEqual(len(resp.data) > 1024, True)
+        self.assertEqual(resp.headers["Content-Length"], str(len(resp.data)))
+        with tarfile.open(fileobj=BytesIO(resp.data)) as tar:
+            self.assertTrue("final-kickstart.ks" in tar.getnames())
+            self.assertTrue("logs" in tar.getnames())
+
+        # The compressed results are the same tar
+        tar_data = resp.data
+        resp = self.server.get("/api/v1/compose/results/%s?compression=gzip" % build_id)
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue("%s.tar.gz" % build_id in resp.headers["Content-Disposition"])
+        self.assertEqual(gzip.decompress(resp.data), tar_data)
+
+        resp = self.server.get("/api/v1/compose/results/%s?compression=bzip2" % build_id)
+        self.assertEqual(resp.status_code, 400)
+        data = json.loads(resp.data)
+        self.assertEqual(data["errors"][0]["id"], COMPOSE_ERROR)
 
         # Test the /api/v1/compose/image/<uuid> route
         resp = self.server.get("/api/v1/compose/image/%s" % build_id)
@@ -2964,6 +3323,23 @@ class ServerAPIV1TestCase(unittest.TestCase):
         self.assertEqual(len(resp.data) > 0, True)
         self.assertEqual(resp.data, b"TEST IMAGE")
 
+        # Resume the download of the image
+        etag = resp.headers["ETag"]
+        self.assertEqual(etag, '"%s"' % hashlib.sha256(b"TEST IMAGE").hexdigest())
+        self.assertEqual(resp.headers["Accept-Ranges"], "bytes")
+        resp = self.server.get("/api/v1/compose/image/%s" % build_id,
+                               headers={"Range": "bytes=5-", "If-Range": etag})
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.data, b"IMAGE")
+        self.assertEqual(resp.headers["Content-Range"], "bytes 5-9/10")
+
+        # HEAD only returns the headers
+        resp = self.server.head("/api/v1/compose/image/%s" % build_id)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, b"")
+        self.assertEqual(resp.headers["Content-Length"], "10")
+        self.assertEqual(resp.headers["ETag"], etag)
+
         # Examine the final-kickstart.ks for the customizations
         # A bit kludgy since it examines the filesystem directly, but that's better than unpacking the metadata
         final_ks = open(joinpaths(self.repo_dir, "var/lib/lorax/composer/results/", build_id, "final-kickstart.ks")).read()
@@ -2992,6 +3368,30 @@ class ServerAPIV1TestCase(unittest.TestCase):
         self.assertNotEqual(data, None)
         self.assertEqual(data["finished"], [], "Failed to delete the failed build: %s" % data)
 
+    def test_events_poll_bad_timeout(self):
+        """Test the /api/v1/events/poll route with timeouts that are not numbers"""
+        for timeout in ["nan", "inf", "-inf", "soon"]:
+            resp = self.server.get("/api/v1/events/poll?timeout=%s" % timeout)
+            self.assertEqual(resp.status_code, 400, "timeout=%s was accepted" % timeout)
+            data = json.loads(resp.data)
+            self.assertEqual(data["status"], False)
+
+    def test_events_keepalive_polling(self):
+        """Test that /api/v1/events sends a keepalive when the watch is polling"""
+        def polling_wait(watch, timeout):
+            gevent.sleep(min(timeout, 0.01))
+            return True
+
+        with mock.patch("pylorax.api.v1.EVENTS_KEEPALIVE", 0.1), \
+             mock.patch("pylorax.api.v1.wait_for_change", side_effect=polling_wait):
+            resp = self.server.get("/api/v1/events", buffered=False)
+            self.assertEqual(resp.status_code, 200)
+            try:
+                chunk = next(iter(resp.response))
+            finally:
+                resp.close()
+        self.assertEqual(chunk, b": keepalive\n\n")
+
     def test_compose_13_status_filter(self):
         """Test filter arguments on the /api/v1/compose/status route"""
         # Get a couple compose results going so we have something to filter
@@ -3655,6 +4055,77 @@ class ServerAPIV1TestCase(unittest.TestCase):
         self.assertEqual(data["status"], True)
         self.assertEqual(data["upload_id"], upload_id)
 
+    def test_upload_04_cached_compose(self):
+        """Test reusing the image of an identical compose, and readying its upload"""
+        test_compose = {"blueprint_name": "example-custom-base",
+                        "compose_type": "ami",
+                        "branch": "master"}
+
+        resp = self.server.post("/api/v1/compose?test=2",
+                                data=json.dumps(test_compose),
+                                content_type="application/json")
+        data = json.loads(resp.data)
+        self.assertNotEqual(data, None)
+        self.assertEqual(data["status"], True, "Failed to start test compose: %s" % data)
+        first_id = data["build_id"]
+        self.assertEqual(_wait_for_status(self, first_id, ["FINISHED"], api=1), True, "Failed to finish test compose")
+
+        # The identical compose, with an upload, reuses the image
+        test_compose["upload"] = {
+            "image_name": "AWS custom-base",
+            "provider": "aws",
+            "settings": test_profiles["aws"][1]
+        }
+        resp = self.server.post("/api/v1/compose?test=2&cache=1",
+                                data=json.dumps(test_compose),
+                                content_type="application/json")
+        data = json.loads(resp.data)
+        self.assertNotEqual(data, None)
+        self.assertEqual(data["status"], True, "Failed to start test compose: %s" % data)
+        build_id = data["build_id"]
+        upload_id = data["upload_id"]
+        self.assertEqual(_wait_for_status(self, build_id, ["FINISHED"], api=1), True, "Failed to finish cached compose")
+
+        resp = self.server.get("/api/v1/compose/info/%s" % build_id)
+        data = json.loads(resp.data)
+        self.assertNotEqual(data, None)
+        cached_from = data["cached_from"]
+        self.assertNotEqual(cached_from, None, "Compose did not reuse an image")
+        self.assertEqual(data["image_sha256"], hashlib.sha256(b"TEST IMAGE").hexdigest())
+
+        resp = self.server.get("/api/v1/compose/info/%s" % cached_from)
+        data = json.loads(resp.data)
+        self.assertTrue(data["cache_hits"] > 0)
+
+        # The image is the one from the first compose
+        resp = self.server.get("/api/v1/compose/image/%s" % build_id)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, b"TEST IMAGE")
+
+        # The upload was readied when the compose finished
+        resp = self.server.get("/api/v1/upload/info/%s" % upload_id)
+        data = json.loads(resp.data)
+        self.assertNotEqual(data, None)
+        self.assertEqual(data["status"], True)
+        self.assertNotEqual(data["upload"]["status"], "WAITING")
+
+        # Without ?cache=1 the test compose is run again
+        del test_compose["upload"]
+        resp = self.server.post("/api/v1/compose?test=2",
+                                data=json.dumps(test_compose),
+                                content_type="application/json")
+        data = json.loads(resp.data)
+        build_id = data["build_id"]
+        self.assertEqual(_wait_for_status(self, build_id, ["FINISHED"], api=1), True, "Failed to finish test compose")
+        resp = self.server.get("/api/v1/compose/info/%s" % build_id)
+        data = json.loads(resp.data)
+        self.assertEqual(data["cached_from"], None)
+
+        # Cancel the upload
+        resp = self.server.delete("/api/v1/upload/cancel/%s" % upload_id)
+        data = json.loads(resp.data)
+        self.assertNotEqual(data, None)
+
     def test_upload_05_uploads_schedule(self):
         """Test schedule upload and upload delete"""
 
@@ -3788,7 +4259,7 @@ class RepoCacheAPIV0TestCase(unittest.TestCase):
         repo_dir = tempfile.mkdtemp(prefix="lorax.test.repo.")
         server.config["REPO_DIR"] = repo_dir
         repo = open_or_create_repo(server.config["REPO_DIR"])
-        server.config["GITLOCK"] = GitLock(repo=repo, lock=Lock(), dir=repo_dir)
+        server.config["GITLOCK"] = GitLock(repo=repo, lock=RWLock(), dir=repo_dir)
 
         server.config["COMPOSER_CFG"] = configure(root_dir=repo_dir, test_config=True)
         lifted.config.configure(server.config["COMPOSER_CFG"])
@@ -3880,17 +4351,20 @@ class RepoCacheAPIV0TestCase(unittest.TestCase):
         makeFakeRPM("/tmp/lorax-test-repo/", "fake-milhouse", 0, "1.0.1", "1")
         os.system("createrepo_c /tmp/lorax-test-repo/")
 
-        # Expire time has been set to 10 seconds, so wait 11 and try it.
-        time.sleep(11)
-
-        resp = self.server.get("/api/v0/blueprints/depsolve/milhouse-test")
-        data = json.loads(resp.data)
-        self.assertNotEqual(data, None)
-        blueprints = data.get("blueprints")
-        self.assertNotEqual(blueprints, None)
-        self.assertEqual(len(blueprints), 1)
-        self.assertEqual(blueprints[0]["blueprint"]["name"], "milhouse-test")
-        deps = blueprints[0]["dependencies"]
+        # Expire time has been set to 10 seconds, the new metadata is loaded in the background
+        # after that, so wait up to 60 seconds for it to be used.
+        for _ in range(60):
+            time.sleep(1)
+            resp = self.server.get("/api/v0/blueprints/depsolve/milhouse-test")
+            data = json.loads(resp.data)
+            self.assertNotEqual(data, None)
+            blueprints = data.get("blueprints")
+            self.assertNotEqual(blueprints, None)
+            self.assertEqual(len(blueprints), 1)
+            self.assertEqual(blueprints[0]["blueprint"]["name"], "milhouse-test")
+            deps = blueprints[0]["dependencies"]
+            if any([True for d in deps if d["name"] == "fake-milhouse" and d["version"] == "1.0.1"]):
+                break
         print(deps)
         self.assertTrue(any([True for d in deps if d["name"] == "fake-milhouse" and d["version"] == "1.0.1"]))
         self.assertFalse(data.get("errors"))
@@ -3912,6 +4386,10 @@ class RepoCacheAPIV0TestCase(unittest.TestCase):
 
         build_id = data["build_id"]
 
+        # Wait for the compose to be depsolved
+        self.assertEqual(_wait_for_status(self, build_id, ["WAITING", "RUNNING", "FINISHED"], api=0), True,
+                         "Failed to prepare test compose")
+
         # Check to see which version was used for the compose, should be 1.0.2
         resp = self.server.get("/api/v0/compose/info/%s" % build_id)
         data = json.loads(resp.data)
@@ -3927,7 +4405,7 @@ class RepoCacheAPIV1TestCase(unittest.TestCase):
         repo_dir = tempfile.mkdtemp(prefix="lorax.test.repo.")
         server.config["REPO_DIR"] = repo_dir
         repo = open_or_create_repo(server.config["REPO_DIR"])
-        server.config["GITLOCK"] = GitLock(repo=repo, lock=Lock(), dir=repo_dir)
+        server.config["GITLOCK"] = GitLock(repo=repo, lock=RWLock(), dir=repo_dir)
 
         server.config["COMPOSER_CFG"] = configure(root_dir=repo_dir, test_config=True)
         lifted.config.configure(server.config["COMPOSER_CFG"])
@@ -4019,17 +4497,20 @@ class RepoCacheAPIV1TestCase(unittest.TestCase):
         makeFakeRPM("/tmp/lorax-test-repo/", "fake-milhouse", 0, "1.0.1", "1")
         os.system("createrepo_c /tmp/lorax-test-repo/")
 
-        # Expire time has been set to 10 seconds, so wait 11 and try it.
-        time.sleep(11)
-
-        resp = self.server.get("/api/v1/blueprints/depsolve/milhouse-test")
-        data = json.loads(resp.data)
-        self.assertNotEqual(data, None)
-        blueprints = data.get("blueprints")
-        self.assertNotEqual(blueprints, None)
-        self.assertEqual(len(blueprints), 1)
-        self.assertEqual(blueprints[0]["blueprint"]["name"], "milhouse-test")
-        deps = blueprints[0]["dependencies"]
+        # Expire time has been set to 10 seconds, the new metadata is loaded in the background
+        # after that, so wait up to 60 seconds for it to be used.
+        for _ in range(60):
+            time.sleep(1)
+            resp = self.server.get("/api/v1/blueprints/depsolve/milhouse-test")
+            data = json.loads(resp.data)
+            self.assertNotEqual(data, None)
+            blueprints = data.get("blueprints")
+            self.assertNotEqual(blueprints, None)
+            self.assertEqual(len(blueprints), 1)
+            self.assertEqual(blueprints[0]["blueprint"]["name"], "milhouse-test")
+            deps = blueprints[0]["dependencies"]
+            if any([True for d in deps if d["name"] == "fake-milhouse" and d["version"] == "1.0.1"]):
+                break
         print(deps)
         self.assertTrue(any([True for d in deps if d["name"] == "fake-milhouse" and d["version"] == "1.0.1"]))
         self.assertFalse(data.get("errors"))
@@ -4051,6 +4532,10 @@ class RepoCacheAPIV1TestCase(unittest.TestCase):
 
         build_id = data["build_id"]
 
+        # Wait for the compose to be depsolved
+        self.assertEqual(_wait_for_status(self, build_id, ["WAITING", "RUNNING", "FINISHED"], api=1), True,
+                         "Failed to prepare test compose")
+
         # Check to see which version was used for the compose, should be 1.0.2
         resp = self.server.get("/api/v1/compose/info/%s" % build_id)
         data = json.loads(resp.data)
@@ -4068,7 +4553,7 @@ class GitRPMBlueprintTestCase(unittest.TestCase):
         repo_dir = tempfile.mkdtemp(prefix="lorax.test.repo.")
         server.config["REPO_DIR"] = repo_dir
         repo = open_or_create_repo(server.config["REPO_DIR"])
-        server.config["GITLOCK"] = GitLock(repo=repo, lock=Lock(), dir=repo_dir)
+        server.config["GITLOCK"] = GitLock(repo=repo, lock=RWLock(), dir=repo_dir)
 
         server.config["COMPOSER_CFG"] = configure(root_dir=repo_dir, test_config=True)
         lifted.config.configure(server.config["COMPOSER_CFG"])
@@ -4191,7 +4676,7 @@ class GitRPMBlueprintTestCase(unittest.TestCase):
         self.assertTrue("git-rpm-test-1.0.0-1" in final_ks)
 
     def test_03_compose_badref_gitrpm(self):
-        """Make sure that compose with a bad reference returns an error"""
+        """Make sure that compose with a bad reference fails"""
         test_blueprint = """
             name = "git-rpm-blueprint-test"
             description = "A test blueprint including a rpm created from git"
@@ -4225,12 +4710,17 @@ class GitRPMBlueprintTestCase(unittest.TestCase):
                                 content_type="application/json")
         data = json.loads(resp.data)
         self.assertNotEqual(data, None)
-        self.assertEqual(data["status"], False)
-        self.assertTrue("errors" in data and len(data["errors"]) > 0)
-        self.assertEqual(data["errors"][0]["id"], "BuildFailed")
+        self.assertEqual(data["status"], True, "Failed to start test compose: %s" % data)
+        build_id = data["build_id"]
+
+        # The git rpm is created after the compose has been started, it should fail
+        self.assertEqual(_wait_for_status(self, build_id, ["FAILED"]), True, "Bad reference did not fail")
+
+        resp = self.server.get("/api/v0/compose/log/%s" % build_id)
+        self.assertTrue(b"Preparing the build failed" in resp.data)
 
     def test_04_compose_badrepo_gitrpm(self):
-        """Make sure that compose with a bad repo returns an error"""
+        """Make sure that compose with a bad repo fails"""
         test_blueprint = """
             name = "git-rpm-blueprint-test"
             description = "A test blueprint including a rpm created from git"
@@ -4264,6 +4754,59 @@ class GitRPMBlueprintTestCase(unittest.TestCase):
                                 content_type="application/json")
         data = json.loads(resp.data)
         self.assertNotEqual(data, None)
-        self.assertEqual(data["status"], False)
-        self.assertTrue("errors" in data and len(data["errors"]) > 0)
-        self.assertEqual(data["errors"][0]["id"], "BuildFailed")
+        self.assertEqual(data["status"], True, "Failed to start test compose: %s" % data)
+        build_id = data["build_id"]
+
+        # The git rpm is created after the compose has been started, it should fail
+        self.assertEqual(_wait_for_status(self, build_id, ["FAILED"]), True, "Bad repo did not fail")
+
+        resp = self.server.get("/api/v0/compose/log/%s" % build_id)
+        self.assertTrue(b"Preparing the build failed" in resp.data)
+
+    def test_05_compose_failed_prepare_log(self):
+        """Make sure the log of a build that failed while being prepared can be read"""
+        test_blueprint = """
+            name = "failed-prepare-test"
+            description = "A test blueprint with a package that does not exist"
+            version = "0.0.1"
+
+            [[packages]]
+            name="no-such-package-for-lorax-testing"
+            version="*"
+        """
+        resp = self.server.post("/api/v0/blueprints/new",
+                                data=test_blueprint,
+                                content_type="text/x-toml")
+        data = json.loads(resp.data)
+        self.assertEqual(data, {"status":True})
+
+        test_compose = {"blueprint_name": "failed-prepare-test",
+                        "compose_type": "tar",
+                        "branch": "master"}
+
+        resp = self.server.post("/api/v0/compose?test=2",
+                                data=json.dumps(test_compose),
+                                content_type="application/json")
+        data = json.loads(resp.data)
+        self.assertNotEqual(data, None)
+        self.assertEqual(data["status"], True, "Failed to start test compose: %s" % data)
+        build_id = data["build_id"]
+
+        # The depsolve is done after the compose has been started, it should fail
+        self.assertEqual(_wait_for_status(self, build_id, ["FAILED"]), True, "Missing package did not fail")
+
+        resp = self.server.get("/api/v0/compose/log/%s" % build_id)
+        self.assertTrue(b"Preparing the build failed" in resp.data)
+        self.assertEqual(resp.headers["X-Log-Name"], "combined.log")
+
+        # Nothing new after the offset
+        resp = self.server.get("/api/v0/compose/log/%s?log=combined.log&offset=%s" % (build_id, resp.headers["X-Log-Offset"]))
+        self.assertEqual(resp.data, b"")
+
+        # The end of the log again if the offset is for a different log
+        resp = self.server.get("/api/v0/compose/log/%s?log=anaconda.log&offset=0" % build_id)
+        self.assertTrue(b"Preparing the build failed" in resp.data)
+
+        # Following the log of a failed build returns the end of it and stops
+        resp = self.server.get("/api/v0/compose/log/%s?follow=1" % build_id)
+        self.assertTrue(b"Preparing the build failed" in resp.data)
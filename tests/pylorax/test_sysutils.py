@@ -20,7 +20,7 @@ import tempfile
 import os
 
 from pylorax.sysutils import joinpaths, touch, replace, chown_, chmod_, remove, linktree
-from pylorax.sysutils import _read_file_end
+from pylorax.sysutils import _read_file_end, read_lines
 
 class SysUtilsTest(unittest.TestCase):
     def test_joinpaths(self):
@@ -144,3 +144,29 @@ class SysUtilsTest(unittest.TestCase):
         # Test for UnicodeDecodeError returning an empty string
         f = io.BytesIO(b"\xff\xff\xffHere is a string with invalid unicode in it.")
         self.assertEqual(_read_file_end(f, 1), "")
+
+    def test_read_lines(self):
+        """Test reading the lines after an offset"""
+        with tempfile.NamedTemporaryFile(prefix="lorax.test.") as f:
+            f.write(b"first line\nsecond line\npartial")
+            f.flush()
+
+            # Only the complete lines, and the offset of the partial line
+            self.assertEqual(read_lines(f.name, 0, 1), ("first line\nsecond line\n", 23))
+            self.assertEqual(read_lines(f.name, 23, 1), ("", 23))
+
+            # The rest of the line once it has been written
+            f.write(b" line \xc3\xb2\n")
+            f.flush()
+            self.assertEqual(read_lines(f.name, 23, 1), ("partial line \u00f2\n", 39))
+            self.assertEqual(read_lines(f.name, 39, 1), ("", 39))
+
+            # Everything when the lines do not need to be complete
+            f.write(b"last")
+            f.flush()
+            self.assertEqual(read_lines(f.name, 39, 1, complete=False), ("last", 43))
+
+            # A line longer than size is returned in parts
+            f.write(b"x" * 2048 + b"\n")
+            f.flush()
+            self.assertEqual(read_lines(f.name, 39, 1), ("last" + "x" * 1020, 1063))
@@ -21,7 +21,7 @@ import unittest
 from unittest import mock
 
 import pylorax.api.recipes as recipes
-from pylorax.api.workspace import workspace_dir, workspace_read, workspace_write, workspace_delete
+from pylorax.api.workspace import WORKSPACE_CACHE, workspace_dir, workspace_read, workspace_write, workspace_delete
 from pylorax.sysutils import joinpaths
 
 class WorkspaceTest(unittest.TestCase):
@@ -69,11 +69,25 @@ class WorkspaceTest(unittest.TestCase):
 
     def test_04_workspace_read_ioerror(self):
         """Test the workspace_read function dealing with internal IOError"""
-        # The recipe was written by the workspace_write test.
+        # The recipe was written by the workspace_write test, make sure it is parsed again
+        WORKSPACE_CACHE.clear()
         with self.assertRaises(recipes.RecipeFileError):
             with mock.patch('pylorax.api.workspace.recipe_from_toml', side_effect=IOError('TESTING')):
                 workspace_read(self.repo, "master", "example-http-server")
 
+    def test_04_workspace_read_cached(self):
+        """Test that workspace_read only parses a file again when it changes"""
+        WORKSPACE_CACHE.clear()
+        recipe = workspace_read(self.repo, "master", "example-http-server")
+        recipe["description"] = "Changed by the caller"
+        self.assertEqual(workspace_read(self.repo, "master", "example-http-server"), self.example_recipe)
+        self.assertEqual(WORKSPACE_CACHE.stats()["hits"] > 0, True)
+
+        changed = recipes.recipe_from_dict(dict(self.example_recipe, description="A new description"))
+        workspace_write(self.repo, "master", changed)
+        self.assertEqual(workspace_read(self.repo, "master", "example-http-server"), changed)
+        workspace_write(self.repo, "master", self.example_recipe)
+
     def test_05_workspace_delete(self):
         """Test the workspace_delete function"""
         ws_recipe_path = joinpaths(self.repo_dir, "git", "workspace", "master", "example-http-server.toml")